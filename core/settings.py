@@ -124,12 +124,33 @@ CORS_ORIGIN_ALLOW_ALL = True
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'public', 'static')
 
+# gtfs feed archives, see gtfs.feedcache
+
+GTFS_FEED_CACHE_DIR = os.environ.get(
+    "APP_FEED_CACHE_DIR", os.path.join(BASE_DIR, 'feed-cache'))
+GTFS_FEED_CACHE_SIZE = int(
+    os.environ.get("APP_FEED_CACHE_SIZE", 1024 * 1024 * 1024))
+
+# shapes.txt points within this many metres of the line are dropped,
+# see gtfs.shapes
+
+GTFS_SHAPE_TOLERANCE = float(os.environ.get("APP_SHAPE_TOLERANCE", 0))
+
+# largest ?limit= of the /v1/ lists, see gtfs.pagination
+
+GTFS_MAX_PAGE_SIZE = int(os.environ.get("APP_MAX_PAGE_SIZE", 1000))
+
+# serve the stop, trip and stop time lists from an in-memory copy of the
+# timetable, see gtfs.snapshot
+
+GTFS_TIMETABLE_SNAPSHOT = os.environ.get("APP_TIMETABLE_SNAPSHOT") == "1"
+
 # django restframework
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework_jwt.authentication.JSONWebTokenAuthentication',
+        'people.authentication.JSONWebTokenAuthentication',
     ),
     'DEFAULT_RENDERER_CLASSES': (
         # 'rest_framework.renderers.YAMLRenderer',
@@ -140,7 +161,7 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
     ),
     'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',),
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
+    'DEFAULT_PAGINATION_CLASS': 'gtfs.pagination.HybridPagination',
     'PAGE_SIZE': 15,
     'DEFAULT_THROTTLE_CLASSES': (
         'rest_framework.throttling.AnonRateThrottle',
@@ -148,7 +169,8 @@ REST_FRAMEWORK = {
     ),
     'DEFAULT_THROTTLE_RATES': {
         'anon': '35/minute',
-        'user': '500/minute'
+        'user': '500/minute',
+        'tiles': '1200/minute',
     },
     'DEFAULT_PARSER_CLASSES': (
         'rest_framework.parsers.JSONParser',
@@ -166,7 +188,7 @@ JWT_AUTH = {
     'rest_framework_jwt.utils.jwt_decode_handler',
 
     'JWT_PAYLOAD_HANDLER':
-    'rest_framework_jwt.utils.jwt_payload_handler',
+    'people.authentication.jwt_payload_handler',
 
     'JWT_PAYLOAD_GET_USER_ID_HANDLER':
     'rest_framework_jwt.utils.jwt_get_user_id_from_payload_handler',
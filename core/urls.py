@@ -20,6 +20,7 @@ from rest_framework_jwt.views import (
     obtain_jwt_token, refresh_jwt_token, verify_jwt_token)
 
 from .routers import router
+from gtfs.views import FeedView, PlanView, TileView
 from web.views import HomeView
 
 urlpatterns = [
@@ -29,6 +30,10 @@ urlpatterns = [
     url('^api-token-verify/', verify_jwt_token),
 
     url(r'^admin/', admin.site.urls),
+    url(r'^v1/feed/$', FeedView.as_view(), name='feed'),
+    url(r'^v1/plan/?$', PlanView.as_view(), name='plan'),
+    url(r'^v1/tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.mvt$',
+        TileView.as_view(), name='tiles'),
     url(r'^v1/', include(router.urls)),
     url(r'^$', HomeView.as_view()),
 ]
@@ -0,0 +1 @@
+default_app_config = 'gtfs.apps.GtfsConfig'
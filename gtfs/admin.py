@@ -3,12 +3,23 @@ from __future__ import unicode_literals
 from django.contrib.gis import admin
 from django.contrib.gis.admin import OSMGeoAdmin
 from .models import Agency, Stop, Route, Trip, Calendar, CalendarDate, \
-    FareAttribute, FareRule, StopTime, Frequency
+    FareAttribute, FareRule, StopTime, Frequency, TableVersion, \
+    TripSummary, StopSearch
+
+
+def set_agency(routes, target):
+    """Move `routes` to `target`; update() sends no signals, so the route
+    version and the search rows of the stops served are kept here"""
+    pks = list(routes.values_list('pk', flat=True))
+    routes.update(agency=target)
+    TableVersion.bump(target.company_id, Route.gtfs_table)
+    StopSearch.refresh(StopTime.objects.filter(trip__route__in=pks)
+                       .values_list('stop', flat=True).order_by().distinct())
 
 
 def pk_nakhon_agency_action(modeladmin, request, queryset):
     target = Agency.objects.get(agency_id='phuket-nakhon')
-    queryset.update(agency=target)
+    set_agency(queryset, target)
 
 
 pk_nakhon_agency_action.short_description = 'Apply PK-nakhon as agency'
@@ -17,7 +28,7 @@ pk_nakhon_agency_action.short_description = 'Apply PK-nakhon as agency'
 def bmta_agency_action(modeladmin, request, queryset):
     user = request.user
     target = Agency.objects.get(agency_id='bmta', company=user.company)
-    queryset.update(agency=target)
+    set_agency(queryset, target)
 
 
 bmta_agency_action.short_description = 'Apply BMTA as agency'
@@ -66,7 +77,24 @@ class FrequencyAdmin(OSMGeoAdmin):
 class TripAdmin(OSMGeoAdmin):
     list_filter = ('route', 'service')
     list_display = ('trip_id', 'route', 'service', 'short_name',
-                    'trip_headsign', 'direction_id')
+                    'trip_headsign', 'direction_id', 'stop_count',
+                    'first_departure', 'last_arrival')
+    list_select_related = ('route', 'service', 'summary')
+
+    def summary_of(self, obj, field):
+        try:
+            return getattr(obj.summary, field)
+        except TripSummary.DoesNotExist:
+            return None
+
+    def stop_count(self, obj):
+        return self.summary_of(obj, 'stop_count')
+
+    def first_departure(self, obj):
+        return self.summary_of(obj, 'first_departure')
+
+    def last_arrival(self, obj):
+        return self.summary_of(obj, 'last_arrival')
 
 
 class StopTimeAdmin(OSMGeoAdmin):
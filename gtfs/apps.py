@@ -6,3 +6,7 @@ from django.apps import AppConfig
 
 class GtfsConfig(AppConfig):
     name = 'gtfs'
+
+    def ready(self):
+        from . import signals
+        signals.connect()
@@ -0,0 +1,467 @@
+# -*- coding: utf-8 -*-
+"""Synthetic feeds and benchmarks
+
+`SyntheticFeed` fills a company with a generated feed of a given size,
+`Benchmark` times the export, the `/v1/` list endpoints, the journey
+planner and the import on whatever database the settings point at
+(sqlite/spatialite or postgis) and records seconds, query counts, rows/s
+and peak memory.
+
+    SyntheticFeed(company, **SIZES['medium']).generate()
+    results = Benchmark(company).run()
+
+Results are plain dicts that `compare` can diff between two runs, see the
+`gtfs_bench` command.
+"""
+from __future__ import unicode_literals
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from datetime import date, time as daytime, timedelta
+
+import django
+from django.conf import settings
+from django.contrib.gis.geos import Point, LineString
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from . import planner, snapshot
+from .export import FeedExporter
+from .importer import FeedImporter
+from .models import (
+    Agency, Route, FareRule, Frequency, Calendar, CalendarDate,
+    StopTime, Stop, FareAttribute, Trip, TableVersion, TripSummary,
+    StopSearch
+)
+
+# agencies, routes, trips per route, stops per trip, shape points per route
+SIZES = {
+    'small': dict(agencies=1, routes=10, trips=20, stops=20,
+                  shape_points=500),
+    'medium': dict(agencies=2, routes=50, trips=100, stops=40,
+                   shape_points=5000),
+    'large': dict(agencies=5, routes=200, trips=200, stops=50,
+                  shape_points=20000),
+}
+BATCH_SIZE = 5000
+# where the synthetic city is, roughly Bangkok
+CENTER = (100.5, 13.75)
+# /v1/ list endpoints timed by Benchmark
+LIST_ENDPOINTS = (
+    'agency', 'stop', 'route', 'trip', 'stoptime', 'calendar',
+    'calendar-date', 'frequency', 'fare-attribute', 'fare-rule',
+)
+# journeys planned by Benchmark, between random stops at 08:00
+PLAN_QUERIES = 100
+
+
+def peak_rss():
+    """Peak resident memory of this process in KiB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB everywhere else
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def _clock(seconds):
+    return daytime((seconds // 3600) % 24, (seconds // 60) % 60,
+                   seconds % 60)
+
+
+class SyntheticFeed(object):
+    """Generate a feed into `company`
+
+    Every route serves `stops` stops and shares half of them with the
+    previous route, so there are transfers to plan with. Trips run every
+    few minutes from 05:00 over the day, two minutes between stops, and
+    the route shape is a wiggly line of `shape_points` vertices through
+    its stops.
+    """
+
+    def __init__(self, company, agencies=1, routes=10, trips=20, stops=20,
+                 shape_points=500, seed=0, batch_size=BATCH_SIZE, log=None):
+        self.company = company
+        self.agencies = agencies
+        self.routes = routes
+        self.trips = trips
+        self.stops = stops
+        self.shape_points = shape_points
+        self.random = random.Random(seed)
+        self.batch_size = batch_size
+        self.log = log
+        self.counts = {}
+
+    def prefix(self, value):
+        # service_id is unique across companies
+        return '%s-%s' % (self.company.slug, value)
+
+    def create(self, model, objs):
+        count, batch = 0, []
+        for obj in objs:
+            batch.append(obj)
+            if len(batch) >= self.batch_size:
+                model.objects.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            model.objects.bulk_create(batch)
+            count += len(batch)
+        self.counts[model.gtfs_table] = \
+            self.counts.get(model.gtfs_table, 0) + count
+        if self.log:
+            self.log('%-20s %10d rows' % (model.gtfs_table, count))
+        return count
+
+    def keys(self, model, field):
+        return dict(model.objects.filter(company=self.company)
+                    .values_list(field, 'pk'))
+
+    def stop_locations(self):
+        """A random walk of stops, route r serves a window of them"""
+        x, y = CENTER
+        count = (self.routes + 1) * self.stops // 2 + self.stops
+        locations = []
+        for i in range(count):
+            x += self.random.uniform(-0.004, 0.006)
+            y += self.random.uniform(-0.004, 0.004)
+            locations.append((x, y))
+        return locations
+
+    def route_stops(self, route):
+        start = route * self.stops // 2
+        return range(start, start + self.stops)
+
+    def shape(self, points):
+        """`shape_points` vertices along `points` with some jitter"""
+        per_leg = max(self.shape_points // max(len(points) - 1, 1), 1)
+        coords = []
+        for (x1, y1), (x2, y2) in zip(points, points[1:]):
+            for i in range(per_leg):
+                f = float(i) / per_leg
+                coords.append((
+                    x1 + (x2 - x1) * f + self.random.gauss(0, 0.00003),
+                    y1 + (y2 - y1) * f + self.random.gauss(0, 0.00003)))
+        coords.append(points[-1])
+        return LineString(coords, srid=4326)
+
+    def generate(self):
+        """Create the feed, returns {table: rows}"""
+        company = self.company.pk
+        self.counts = {}
+        with transaction.atomic():
+            self.create(Agency, (
+                Agency(company_id=company, agency_id='A%d' % a,
+                       name='Agency %d' % a, url='http://example.com',
+                       timezone=settings.TIME_ZONE, lang='en')
+                for a in range(self.agencies)))
+            agencies = self.keys(Agency, 'agency_id')
+
+            locations = self.stop_locations()
+            self.create(Stop, (
+                Stop(company_id=company, stop_id='S%d' % i,
+                     name='Stop %d' % i, location=Point(x, y, srid=4326))
+                for i, (x, y) in enumerate(locations)))
+            stops = self.keys(Stop, 'stop_id')
+
+            self.create(Route, (
+                Route(company_id=company, route_id='R%d' % r,
+                      short_name='%d' % r, long_name='Route %d' % r,
+                      route_type='3',
+                      agency_id=agencies['A%d' % (r % self.agencies)],
+                      route_color='%06x' % self.random.randrange(0xffffff),
+                      route_text_color='ffffff',
+                      shapes=self.shape(
+                          [locations[i] for i in self.route_stops(r)]))
+                for r in range(self.routes)))
+            routes = self.keys(Route, 'route_id')
+
+            today = date.today()
+            self.create(Calendar, [
+                Calendar(company_id=company,
+                         service_id=self.prefix('weekday'),
+                         start_date=today, end_date=today + timedelta(365),
+                         monday=True, tuesday=True, wednesday=True,
+                         thursday=True, friday=True),
+                Calendar(company_id=company,
+                         service_id=self.prefix('weekend'),
+                         start_date=today, end_date=today + timedelta(365),
+                         saturday=True, sunday=True),
+            ])
+            services = self.keys(Calendar, 'service_id')
+            self.create(CalendarDate, (
+                CalendarDate(company_id=company,
+                             service_id=services[self.prefix('weekday')],
+                             date=today + timedelta(days), exception_type='2')
+                for days in range(30, 365, 30)))
+
+            def trip_objs():
+                for r in range(self.routes):
+                    for t in range(self.trips):
+                        service = 'weekend' if t % 5 == 4 else 'weekday'
+                        yield Trip(company_id=company,
+                                   route_id=routes['R%d' % r],
+                                   service_id=services[self.prefix(service)],
+                                   trip_id='R%d-T%d' % (r, t),
+                                   trip_headsign='Route %d' % r,
+                                   direction_id=str(t % 2))
+            self.create(Trip, trip_objs())
+            trips = self.keys(Trip, 'trip_id')
+
+            headway = max(18 * 3600 // max(self.trips, 1), 60)
+
+            def stoptime_objs():
+                for r in range(self.routes):
+                    serves = self.route_stops(r)
+                    for t in range(self.trips):
+                        trip = trips['R%d-T%d' % (r, t)]
+                        start = 5 * 3600 + t * headway
+                        for seq, s in enumerate(serves, 1):
+                            at = _clock(start + (seq - 1) * 120)
+                            yield StopTime(company_id=company, trip_id=trip,
+                                           stop_id=stops['S%d' % s],
+                                           arrival=at, departure=at,
+                                           sequence=seq)
+            self.create(StopTime, stoptime_objs())
+
+            self.create(Frequency, (
+                Frequency(company_id=company, trip_id=trips['R%d-T0' % r],
+                          start_time=daytime(5), end_time=daytime(22),
+                          headway_secs=headway)
+                for r in range(0, self.routes, 10)))
+
+            self.create(FareAttribute, [
+                FareAttribute(company_id=company, fare_id='F%d' % a,
+                              price='15.00', currency_type='THB',
+                              transfer_duration='')
+                for a in range(self.agencies)])
+            fares = self.keys(FareAttribute, 'fare_id')
+            self.create(FareRule, (
+                FareRule(company_id=company,
+                         fare_id=fares['F%d' % (r % self.agencies)],
+                         route_id=routes['R%d' % r])
+                for r in range(self.routes)))
+
+            # bulk inserts skip signals
+            TableVersion.bump(company, TableVersion.ALL)
+            TripSummary.rebuild(Trip.objects.filter(company=company))
+            StopSearch.rebuild(Stop.objects.filter(company=company))
+        return self.counts
+
+    def delete(self):
+        with transaction.atomic():
+            FeedImporter(self.company, None).delete_existing()
+            # deleted without signals
+            TableVersion.bump(self.company.pk, TableVersion.ALL)
+
+
+class Benchmark(object):
+    """Time the export, the API and the import of `company`
+
+    Every measurement is a dict of seconds, queries, rows, rows_per_sec
+    and peak_rss_kb. Peak memory is the high-water mark of the process,
+    it only grows from one measurement to the next, run a single step to
+    see the peak of that step alone.
+    """
+
+    def __init__(self, company, repeat=1, log=None):
+        self.company = company
+        self.repeat = repeat
+        self.log = log
+        self.results = {}
+        self.client = Client(HTTP_HOST=self.host())
+
+    @staticmethod
+    def host():
+        for host in settings.ALLOWED_HOSTS:
+            if host != '*':
+                return host.lstrip('.') or 'localhost'
+        return 'localhost'
+
+    def routes(self):
+        return Route.objects.filter(company=self.company)
+
+    def measure(self, name, func):
+        """Best of `repeat` runs of `func`, which returns the rows it did"""
+        best = None
+        for i in range(self.repeat):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.time()
+                rows = func()
+                seconds = time.time() - start
+            if best is None or seconds < best['seconds']:
+                best = {
+                    'seconds': round(seconds, 4),
+                    'queries': len(queries),
+                    'rows': rows,
+                    'rows_per_sec': round(rows / seconds, 1)
+                    if rows and seconds else None,
+                }
+        best['peak_rss_kb'] = peak_rss()
+        self.results[name] = best
+        if self.log:
+            self.log(self.format_result(name, best))
+        return best
+
+    def feed_rows(self):
+        return sum(model.objects.filter(company=self.company).count()
+                   for model in (Agency, Route, Trip, StopTime, Stop,
+                                 Calendar, CalendarDate, Frequency,
+                                 FareAttribute, FareRule))
+
+    def export_zip(self, path, jobs=1):
+        with open(path, 'wb') as f:
+            FeedExporter(self.routes()).write_zip(f, jobs=jobs)
+
+    def get(self, url):
+        """Bytes of the response to `url`, which has to be 200 OK"""
+        # keep the throttles out of the numbers
+        cache.clear()
+        response = self.client.get(url)
+        if response.status_code != 200:
+            raise AssertionError('%s: HTTP %s' % (url, response.status_code))
+        if response.streaming:
+            return sum(len(chunk) for chunk in response.streaming_content)
+        return len(response.content)
+
+    def import_feed(self, path):
+        """Import into the same company and roll it back"""
+        with transaction.atomic():
+            report = FeedImporter(self.company, path).run(replace=True)
+            transaction.set_rollback(True)
+        return sum(count for filename, count, seconds in report)
+
+    def steps(self, jobs=1):
+        """[(name, func)] of everything `run` measures"""
+        tmp = os.path.join(self.tmpdir, 'feed.zip')
+        rows = self.feed_rows()
+        agencies = ','.join(Agency.objects.filter(company=self.company)
+                            .values_list('agency_id', flat=True))
+
+        def export():
+            self.export_zip(tmp)
+            return rows
+
+        def export_parallel():
+            self.export_zip(tmp, jobs=jobs)
+            return rows
+
+        def feed():
+            self.get('/v1/feed/?agency=%s&company=%s' % (
+                agencies, self.company.slug))
+            return rows
+
+        def api(endpoint):
+            def get():
+                self.get('/v1/%s/' % endpoint)
+            return get
+
+        steps = [('export', export)]
+        if jobs > 1:
+            steps.append(('export_jobs_%d' % jobs, export_parallel))
+        steps.append(('api_feed', feed))
+        steps.extend(('api_%s' % e.replace('-', '_'), api(e))
+                     for e in LIST_ENDPOINTS)
+        steps.extend(self.plan_steps())
+        steps.append(('import', lambda: self.import_feed(tmp)))
+        return steps
+
+    def plan_steps(self):
+        """Build of the timetable snapshot and of the planner of today,
+        `PLAN_QUERIES` journeys through the planner and one through
+        /v1/plan"""
+        company, today = self.company.pk, date.today()
+        stops = list(Stop.objects.filter(company=company)
+                     .values_list('pk', flat=True))
+        pairs = [tuple(random.Random(i).sample(stops, 2))
+                 for i in range(PLAN_QUERIES)] if len(stops) > 1 else []
+
+        def snapshot_build():
+            snapshot.clear()
+            return len(snapshot.timetable_snapshot(company).st_pk)
+
+        def plan_build():
+            planner.clear()
+            return planner.day_planner(company, today).stats()['trips']
+
+        def plan_query():
+            plan = planner.day_planner(company, today)
+            index = plan.snapshot.stop_index
+            for origin, destination in pairs:
+                plan.plan(plan.network.around_stop(index[origin]),
+                          plan.network.around_stop(index[destination]),
+                          8 * 3600)
+            return len(pairs)
+
+        def api_plan():
+            if pairs:
+                self.get('/v1/plan?from=%d&to=%d&date=%s&time=08:00'
+                         '&company=%s' % (pairs[0] + (today.isoformat(),
+                                                      self.company.slug)))
+            return len(pairs[:1])
+
+        return [('snapshot_build', snapshot_build),
+                ('plan_build', plan_build),
+                ('plan_query', plan_query),
+                ('api_plan', api_plan)]
+
+    def run(self, only=None, jobs=1):
+        """Measure every step (or those in `only`), returns the results"""
+        self.tmpdir = tempfile.mkdtemp()
+        try:
+            for name, func in self.steps(jobs):
+                if only and name not in only:
+                    continue
+                self.measure(name, func)
+        finally:
+            for name in os.listdir(self.tmpdir):
+                os.remove(os.path.join(self.tmpdir, name))
+            os.rmdir(self.tmpdir)
+        return {
+            'meta': self.meta(),
+            'results': self.results,
+        }
+
+    def meta(self):
+        return {
+            'company': self.company.slug,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'database': connection.vendor,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'repeat': self.repeat,
+            'stop_times': StopTime.objects.filter(
+                company=self.company).count(),
+        }
+
+    @staticmethod
+    def format_result(name, result):
+        return '%-24s %9.3fs %7d queries %12s rows/s %9d KiB' % (
+            name, result['seconds'], result['queries'],
+            result['rows_per_sec'] or '-', result['peak_rss_kb'])
+
+
+def compare(old, new, threshold=0.1):
+    """[(name, metric, old, new, change, regression)] of two result dicts
+
+    `change` is relative, a regression is a step that got slower, used
+    more queries or more memory by more than `threshold`.
+    """
+    lines = []
+    for name in sorted(set(old['results']) | set(new['results'])):
+        a = old['results'].get(name)
+        b = new['results'].get(name)
+        if a is None or b is None:
+            lines.append((name, None, a, b, None, False))
+            continue
+        for metric in ('seconds', 'queries', 'peak_rss_kb'):
+            x, y = a.get(metric), b.get(metric)
+            if x is None or y is None:
+                continue
+            change = float(y - x) / x if x else (1.0 if y else 0.0)
+            lines.append((name, metric, x, y, change, change > threshold))
+    return lines
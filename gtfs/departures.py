@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Departure board of a stop
+
+    board = stop_departures(stop, date(2018, 12, 25), after=8 * 3600)
+
+With GTFS_TIMETABLE_SNAPSHOT on the departures come from the departure
+index of the `TimetableSnapshot` of the company, otherwise straight from
+the database, in a handful of queries over the stop times at the stop.
+Both give the same board: trips of the day before still running after
+midnight are in, frequency based trips are expanded, and nobody boards
+at the last stop of a trip or where pickup_type is 1.
+"""
+from __future__ import unicode_literals
+from datetime import timedelta
+from itertools import groupby
+from operator import itemgetter
+
+from .frequencies import (
+    DAY, departures, forward_offsets, format_time, frequency_trip_id, seconds
+)
+from .models import StopTime, Frequency
+from .services import ServiceDays
+from .snapshot import timetable_snapshot, enabled as snapshot_enabled
+
+
+def departure(value, trip, trip_id, start, route, route_id, headsign,
+              sequence):
+    """A departure as the API shows it, `value` in seconds"""
+    if start >= 0:
+        trip_id = frequency_trip_id(trip_id, start)
+    return {
+        'departure': format_time(value),
+        'trip': trip,
+        'trip_id': trip_id,
+        'route': route,
+        'route_id': route_id,
+        'headsign': headsign,
+        'sequence': sequence,
+    }
+
+
+def stop_departures(stop, day, after=0, limit=10):
+    """Next `limit` departures at `stop` (a Stop) on `day` from `after`
+    seconds, in time order"""
+    days = ServiceDays.of_company(stop.company_id)
+    if snapshot_enabled():
+        return snapshot_departures(stop, days, day, after, limit)
+    return database_departures(stop, days, day, after, limit)
+
+
+def snapshot_departures(stop, days, day, after, limit):
+    snapshot = timetable_snapshot(stop.company_id)
+    result = []
+    for row, value, start in snapshot.departures(
+            snapshot.stop_index[stop.pk], days, day, after, limit):
+        trip = snapshot.st_trip[row]
+        route = snapshot.trip_route[trip]
+        result.append(departure(
+            value, snapshot.trip_pk[trip], snapshot.trip_text['trip_id'][trip],
+            start, route, snapshot.route_ids.get(route),
+            (snapshot.st_text['stop_headsign'][row] or
+             snapshot.trip_text['trip_headsign'][trip]),
+            snapshot.st_sequence[row]))
+    return result
+
+
+def database_departures(stop, days, day, after, limit):
+    rows = list(StopTime.objects.filter(stop=stop)
+                .exclude(pickup_type='1')
+                .values_list('trip', 'sequence', 'stop_headsign',
+                             'trip__trip_id', 'trip__trip_headsign',
+                             'trip__route', 'trip__route__route_id',
+                             'trip__service'))
+    trips = set(row[0] for row in rows)
+    periods = {}
+    for trip, start, end, headway in Frequency.objects \
+            .filter(trip__in=trips) \
+            .values_list('trip', 'start_time', 'end_time', 'headway_secs'):
+        periods.setdefault(trip, []).append((start, end, headway))
+    # times are stored within a day, a trip running past midnight goes on
+    # from its first departure
+    firsts, offsets, last = {}, {}, {}
+    times = StopTime.objects.filter(trip__in=trips) \
+        .order_by('trip', 'sequence', 'pk') \
+        .values_list('trip', 'sequence', 'arrival', 'departure')
+    for trip, group in groupby(times.iterator(), key=itemgetter(0)):
+        group = list(group)
+        values = forward_offsets([(seconds(row[2]), seconds(row[3]))
+                                  for row in group])[1]
+        for row, offset in zip(group, values):
+            offsets[(trip, row[1])] = offset
+        firsts[trip] = seconds(group[0][3])
+        last[trip] = group[-1][1]
+
+    entries = []
+    # the previous service day goes on past its 24:00:00
+    service_days = ((day - timedelta(days=1), -DAY), (day, 0))
+    for (trip, sequence, stop_headsign, trip_id, trip_headsign, route,
+         route_id, service) in rows:
+        if sequence >= last[trip]:
+            continue
+        offset = offsets[(trip, sequence)]
+        if trip in periods:
+            runs = [(start + offset, start)
+                    for start in departures(periods[trip])]
+        else:
+            runs = [(firsts[trip] + offset, -1)]
+        for service_day, shift in service_days:
+            if not days.runs(service, service_day):
+                continue
+            for value, start in runs:
+                if value + shift >= after:
+                    entries.append((
+                        value + shift, trip, sequence, start, trip_id,
+                        route, route_id, stop_headsign or trip_headsign))
+    entries.sort()
+    return [departure(value, trip, trip_id, start, route, route_id,
+                      headsign, sequence)
+            for (value, trip, sequence, start, trip_id, route, route_id,
+                 headsign) in entries[:limit]]
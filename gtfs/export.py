@@ -0,0 +1,609 @@
+# -*- coding: utf-8 -*-
+"""Streaming GTFS feed exporter
+
+Every table of the feed is pulled with a single `values_list()` query and
+streamed straight to csv, so the number of queries depends on the number of
+tables rather than on the number of rows. Nothing goes through model
+instances, which means no lazy `ForeignKey` dereference per row either.
+
+    exporter = FeedExporter(Route.objects.filter(agency__agency_id='bmta'))
+    exporter.write_dir('/tmp/feed')
+
+or in one pass, without any scratch directory
+
+    with open('feed.zip', 'wb') as f:
+        exporter.write_zip(f, compresslevel=9)
+
+Tables are independent of each other once the route set is fixed, so they
+can also be exported by a pool of processes, each with its own database
+connection. The big tables are split further into key-range shards and all
+the parts are merged back into the archive in order.
+
+    with open('feed.zip', 'wb') as f:
+        exporter.write_zip(f, jobs=16)
+
+`IncrementalFeedExporter` keeps every table, and every route of the
+tables in PARTITIONED_TABLES, as a csv fragment on disk together with the
+`TableVersion` counters it was built from. Only fragments whose counters
+moved are queried again.
+
+With `expand_frequencies` every trip with frequencies.txt rows is
+written out as one trip per departure, with its own stop times, and
+frequencies.txt is left out (see `gtfs.frequencies`).
+"""
+from __future__ import unicode_literals
+import csv
+import hashlib
+import itertools
+import json
+import os
+import tempfile
+from multiprocessing import Pool
+from operator import itemgetter
+from shutil import rmtree
+
+import django
+from django.db import connections
+from django.utils import six
+
+from .models import (
+    CompanyBoundModel, Agency, Route, FareRule, Frequency, Calendar,
+    CalendarDate, StopTime, Stop, FareAttribute, Trip, TableVersion
+)
+from .frequencies import departures, expand_stoptimes, frequency_trip_id
+from .shapes import shape_points, default_tolerance
+from .zipstream import ZipStream
+
+# rows fetched from the database per round trip
+CHUNK_SIZE = 2000
+# bytes of csv kept in memory before being handed to the writer
+BUFFER_SIZE = 64 * 1024
+# rows passed to csv.writer.writerows() at once
+BATCH_ROWS = 500
+# shapes.txt rows come from Route.shapes, not from a model of their own
+SHAPE_COLUMNS = ('shape_id', 'shape_pt_lat', 'shape_pt_lon',
+                 'shape_pt_sequence', 'shape_dist_traveled')
+# tables that can be split into key-range shards for parallel export
+SHARDED_TABLES = ('shapes.txt', 'stop_times.txt')
+# tables cached per route by IncrementalFeedExporter
+PARTITIONED_TABLES = ('shapes.txt', 'stop_times.txt')
+# tables whose rows change with expand_frequencies
+EXPANDED_TABLES = ('trips.txt', 'frequencies.txt', 'stop_times.txt')
+# TableVersion tables the rows of every feed table are built from
+TABLE_DEPENDENCIES = {
+    'agency.txt': ('agency.txt', 'routes.txt'),
+    'routes.txt': ('routes.txt', 'agency.txt'),
+    'shapes.txt': ('shapes.txt', ),
+    'fare_rules.txt': ('fare_rules.txt', 'fare_attributes.txt',
+                       'routes.txt'),
+    'fare_attributes.txt': ('fare_attributes.txt', 'fare_rules.txt'),
+    'trips.txt': ('trips.txt', 'routes.txt', 'calendar.txt'),
+    'frequencies.txt': ('frequencies.txt', 'trips.txt'),
+    'stop_times.txt': ('stop_times.txt', ),
+    'stops.txt': ('stops.txt', 'stop_times.txt'),
+    'calendar.txt': ('calendar.txt', 'trips.txt'),
+    'calendar_dates.txt': ('calendar_dates.txt', 'calendar.txt',
+                           'trips.txt'),
+}
+
+
+def _text(value):
+    """csv in python2 only understands bytes, None becomes an empty cell"""
+    if value is None:
+        return ''
+    if six.PY2 and isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return value
+
+
+def select_routes(route_ids=None, agency_ids=None, company=None):
+    """Routes to export, by route_id or else by agency_id
+
+    `company` (a slug) limits both to one company. None when neither
+    route_ids nor agency_ids are given.
+    """
+    if route_ids:
+        routes = Route.objects.filter(route_id__in=route_ids)
+    elif agency_ids:
+        routes = Route.objects.filter(agency__agency_id__in=agency_ids)
+    else:
+        return None
+    if company:
+        routes = routes.filter(company__slug=company)
+    return routes
+
+
+def iterate(queryset, chunk_size=CHUNK_SIZE):
+    """Stream a queryset without caching it
+
+    `chunk_size` is only understood by django>=2.0, 1.11 streams through a
+    server-side cursor on postgresql already.
+    """
+    if django.VERSION >= (2, 0):
+        return queryset.iterator(chunk_size=chunk_size)
+    return queryset.iterator()
+
+
+def csv_chunks(header, rows, buffer_size=BUFFER_SIZE, batch_size=BATCH_ROWS):
+    """Encode `rows` as csv and yield it as bytes of about `buffer_size`
+
+    Rows are plain tuples in header order, handed to the csv writer
+    `batch_size` at a time. Nothing is yielded when there is no row at all,
+    so empty tables can be left out of the feed the same way the old
+    exporter did. A `header` of None writes the rows only.
+    """
+    buf = six.BytesIO() if six.PY2 else six.StringIO()
+    writer = csv.writer(buf)
+    rows = iter(rows)
+    if six.PY2:
+        rows = (map(_text, row) for row in rows)
+    wrote_header = header is None
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        if not wrote_header:
+            writer.writerow([_text(i) for i in header])
+            wrote_header = True
+        writer.writerows(batch)
+        if buf.tell() >= buffer_size:
+            yield _drain(buf)
+    if buf.tell():
+        yield _drain(buf)
+
+
+def non_empty(tables):
+    """Drop (filename, chunks) pairs that have no chunk at all"""
+    for filename, chunks in tables:
+        chunks = iter(chunks)
+        first = next(chunks, None)
+        if first is None:
+            continue
+        yield filename, itertools.chain([first], chunks)
+
+
+def file_chunks(path, buffer_size=BUFFER_SIZE):
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(buffer_size)
+            if not data:
+                break
+            yield data
+
+
+def split_keys(keys, shards):
+    """Split sorted `keys` into at most `shards` inclusive (low, high) ranges
+    """
+    keys = list(keys)
+    if not keys:
+        return []
+    size = -(-len(keys) // max(shards, 1))
+    return [(keys[i], keys[min(i + size, len(keys)) - 1])
+            for i in range(0, len(keys), size)]
+
+
+def _export_part(args):
+    """Pool worker, write one table or shard of a table without header"""
+    (route_pks, chunk_size, simplify, expand_frequencies, filename, shard,
+     path) = args
+    exporter = FeedExporter(Route.objects.filter(pk__in=route_pks),
+                            chunk_size=chunk_size, simplify=simplify,
+                            expand_frequencies=expand_frequencies)
+    return path if exporter.write_part(filename, shard, path) else None
+
+
+def _drain(buf):
+    data = buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    if not six.PY2:
+        data = data.encode('utf-8')
+    return data
+
+
+class FeedExporter(object):
+    """Export the feed for `routes` (a Route queryset)
+
+    All dependent tables are expressed as subqueries of `routes`, so the
+    route selection itself is never evaluated in python. Shapes are
+    simplified within `simplify` metres, GTFS_SHAPE_TOLERANCE by default.
+    """
+
+    def __init__(self, routes, chunk_size=CHUNK_SIZE, simplify=None,
+                 expand_frequencies=False):
+        self.routes = routes
+        self.chunk_size = chunk_size
+        if simplify is None:
+            simplify = default_tolerance()
+        self.simplify = simplify
+        self.expand_frequencies = expand_frequencies
+        self._departures = None
+
+    def iterate(self, queryset):
+        return iterate(queryset, self.chunk_size)
+
+    # querysets
+
+    def trips(self):
+        return Trip.objects.filter(route__in=self.routes)
+
+    def calendars(self):
+        return Calendar.objects.filter(pk__in=self.trips().values('service'))
+
+    def stoptimes(self):
+        return StopTime.objects.filter(trip__route__in=self.routes)
+
+    def departures(self):
+        """{trip pk: start seconds} of the trips with frequencies"""
+        if self._departures is None:
+            frequencies = {}
+            qs = Frequency.objects.filter(trip__route__in=self.routes) \
+                .values_list('trip', 'start_time', 'end_time',
+                             'headway_secs')
+            for trip, start, end, headway in qs:
+                frequencies.setdefault(trip, []).append((start, end, headway))
+            self._departures = dict(
+                (trip, departures(rows))
+                for trip, rows in frequencies.items())
+        return self._departures
+
+    # rows
+
+    def rows(self, model, queryset):
+        """`queryset` as `model` rows, see CompanyBoundModel.gtfs_tuple"""
+        values = self.iterate(model.gtfs_values(queryset))
+        if model.gtfs_tuple is CompanyBoundModel.gtfs_tuple:
+            return values
+        return six.moves.map(model.gtfs_tuple, values)
+
+    def agency_rows(self):
+        qs = Agency.objects.filter(route__in=self.routes).distinct() \
+            .order_by('agency_id')
+        return self.rows(Agency, qs)
+
+    def route_rows(self):
+        return self.rows(Route, self.routes.distinct())
+
+    def shape_rows(self, shard=None):
+        qs = self.routes.filter(shapes__isnull=False)
+        if shard is not None:
+            qs = qs.filter(pk__gte=shard[0], pk__lte=shard[1])
+        qs = qs.order_by('pk').values_list('route_id', 'shapes')
+        for route_id, shapes in self.iterate(qs):
+            for point in shape_points(shapes, self.simplify):
+                yield (route_id, ) + point
+
+    def fare_rule_rows(self):
+        return self.rows(FareRule,
+                         FareRule.objects.filter(route__in=self.routes))
+
+    def fare_attribute_rows(self):
+        qs = FareAttribute.objects.filter(farerule__route__in=self.routes) \
+            .distinct() \
+            .order_by('fare_id')
+        return self.rows(FareAttribute, qs)
+
+    def trip_rows(self):
+        if self.expand_frequencies:
+            return self.expanded_trip_rows()
+        return self.rows(Trip, self.trips())
+
+    def expanded_trip_rows(self):
+        starts = self.departures()
+        column = Trip.gtfs_columns.index('trip_id')
+        qs = Trip.gtfs_values(self.trips(), 'pk')
+        for values in self.iterate(qs):
+            row = Trip.gtfs_tuple(values[1:])
+            if values[0] not in starts:
+                yield row
+                continue
+            for start in starts[values[0]]:
+                yield row[:column] + \
+                    (frequency_trip_id(row[column], start), ) + \
+                    row[column + 1:]
+
+    def frequency_rows(self):
+        if self.expand_frequencies:
+            return []
+        qs = Frequency.objects.filter(trip__route__in=self.routes) \
+            .order_by('trip', 'start_time')
+        return self.rows(Frequency, qs)
+
+    def stoptime_rows(self, shard=None):
+        qs = self.stoptimes()
+        if shard is not None:
+            qs = qs.filter(trip__gte=shard[0], trip__lte=shard[1])
+        qs = qs.order_by('trip', 'sequence')
+        if self.expand_frequencies:
+            return self.expanded_stoptime_rows(qs)
+        return self.rows(StopTime, qs)
+
+    def expanded_stoptime_rows(self, queryset):
+        """Stop times of `queryset`, those of a trip with frequencies once
+        per departure"""
+        starts = self.departures()
+        values = self.iterate(StopTime.gtfs_values(queryset, 'trip'))
+        for trip, group in itertools.groupby(values, key=itemgetter(0)):
+            template = [row[1:] for row in group]
+            if trip in starts:
+                for row in expand_stoptimes(template, starts[trip]):
+                    yield row
+            else:
+                for row in template:
+                    yield row
+
+    def stop_rows(self):
+        qs = Stop.objects.filter(pk__in=self.stoptimes().values('stop')) \
+            .order_by('stop_id')
+        return self.rows(Stop, qs)
+
+    def calendar_rows(self):
+        return self.rows(Calendar, self.calendars().order_by('service_id'))
+
+    def calendar_date_rows(self):
+        qs = CalendarDate.objects.filter(service__in=self.calendars()) \
+            .order_by('service', 'date')
+        return self.rows(CalendarDate, qs)
+
+    def tables(self):
+        """(filename, header, rows) of every table in the feed"""
+        return [
+            ('agency.txt', Agency.gtfs_columns, self.agency_rows),
+            ('routes.txt', Route.gtfs_columns, self.route_rows),
+            ('shapes.txt', SHAPE_COLUMNS, self.shape_rows),
+            ('fare_rules.txt', FareRule.gtfs_columns, self.fare_rule_rows),
+            ('fare_attributes.txt', FareAttribute.gtfs_columns,
+             self.fare_attribute_rows),
+            ('trips.txt', Trip.gtfs_columns, self.trip_rows),
+            ('frequencies.txt', Frequency.gtfs_columns, self.frequency_rows),
+            ('stop_times.txt', StopTime.gtfs_columns, self.stoptime_rows),
+            ('stops.txt', Stop.gtfs_columns, self.stop_rows),
+            ('calendar.txt', Calendar.gtfs_columns, self.calendar_rows),
+            ('calendar_dates.txt', CalendarDate.gtfs_columns,
+             self.calendar_date_rows),
+        ]
+
+    def iter_tables(self, jobs=1, shards=None):
+        """Yield (filename, chunks) for every table, chunks are csv bytes
+
+        With `jobs` > 1 the tables are exported by a process pool instead,
+        see `iter_tables_parallel`.
+        """
+        if jobs > 1:
+            for table in self.iter_tables_parallel(jobs, shards):
+                yield table
+            return
+        for filename, header, rows in self.tables():
+            yield filename, csv_chunks(header, rows())
+
+    def shard_keys(self, filename):
+        """Sorted keys the shards of `filename` are ranges of"""
+        if filename == 'stop_times.txt':
+            qs = self.trips()
+        elif filename == 'shapes.txt':
+            qs = self.routes.filter(shapes__isnull=False)
+        else:
+            raise ValueError('%s can not be sharded' % filename)
+        return qs.order_by('pk').values_list('pk', flat=True)
+
+    def parts(self, shards):
+        """(filename, shard) work units, shard is None for a whole table"""
+        units = []
+        for filename, header, rows in self.tables():
+            if filename in SHARDED_TABLES and shards > 1:
+                bounds = split_keys(self.shard_keys(filename), shards)
+            else:
+                bounds = [None]
+            units.extend((filename, shard) for shard in bounds)
+        return units
+
+    def write_part(self, filename, shard, path):
+        """Write the rows of one table (or one shard of it) without header
+
+        Returns False, without creating `path`, when there is no row.
+        """
+        rows = dict((f, r) for f, h, r in self.tables())[filename]
+        rows = rows(shard) if shard is not None else rows()
+        wrote = False
+        with open(path, 'wb') as f:
+            for chunk in csv_chunks(None, rows):
+                f.write(chunk)
+                wrote = True
+        if not wrote:
+            os.remove(path)
+        return wrote
+
+    def iter_tables_parallel(self, jobs, shards=None):
+        """Like `iter_tables` but with `jobs` processes
+
+        Every table, or every one of `shards` key ranges of the tables in
+        SHARDED_TABLES, is written to a scratch file by a worker. They are
+        yielded back in table order as soon as all parts of a table are
+        done, so the archive is assembled while later tables are still
+        being exported.
+        """
+        shards = shards or jobs
+        route_pks = list(self.routes.values_list('pk', flat=True))
+        headers = dict((f, h) for f, h, r in self.tables())
+        units = self.parts(shards)
+        tmpdir = tempfile.mkdtemp()
+        args = [
+            (route_pks, self.chunk_size, self.simplify,
+             self.expand_frequencies, filename, shard,
+             os.path.join(tmpdir, '%s.%d' % (filename, i)))
+            for i, (filename, shard) in enumerate(units)
+        ]
+        # every worker has to open its own connection after the fork
+        connections.close_all()
+        pool = Pool(jobs)
+        try:
+            results = six.moves.zip(
+                (f for f, s in units), pool.imap(_export_part, args))
+            for filename, group in itertools.groupby(
+                    results, key=lambda r: r[0]):
+                paths = [path for f, path in group if path]
+                if not paths:
+                    continue
+                yield filename, itertools.chain(
+                    csv_chunks(None, [headers[filename]]),
+                    *[file_chunks(path) for path in paths])
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            rmtree(tmpdir)
+
+    def write_dir(self, dir, jobs=1, shards=None):
+        """Write every non-empty table as `dir`/<filename>"""
+        for filename, chunks in self.iter_tables(jobs, shards):
+            f = None
+            try:
+                for chunk in chunks:
+                    if f is None:
+                        f = open(os.path.join(dir, filename), 'wb')
+                    f.write(chunk)
+            finally:
+                if f is not None:
+                    f.close()
+
+    def iter_zip(self, jobs=1, shards=None, **kwargs):
+        """Yield the feed as zip bytes, see `gtfs.zipstream.ZipStream`"""
+        return ZipStream(**kwargs).stream(
+            non_empty(self.iter_tables(jobs, shards)))
+
+    def write_zip(self, fileobj, jobs=1, shards=None, **kwargs):
+        """Write the feed as a zip into `fileobj` in a single pass"""
+        for data in self.iter_zip(jobs, shards, **kwargs):
+            fileobj.write(data)
+
+
+class FragmentStore(object):
+    """Directory of csv fragments, each with the version it was built at"""
+
+    def __init__(self, dir):
+        self.dir = dir
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        self.manifest_path = os.path.join(dir, 'manifest.json')
+        try:
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        except (IOError, ValueError):
+            self.manifest = {}
+        self.reused = 0
+        self.rebuilt = 0
+
+    def save(self):
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f)
+        os.rename(tmp, self.manifest_path)
+
+    def fetch(self, name, version, build):
+        """Path of fragment `name` at `version`, None when it is empty
+
+        `build` returns the chunks of the fragment, it is only called when
+        the stored one is missing or at another version.
+        """
+        path = os.path.join(self.dir, name)
+        entry = self.manifest.get(name)
+        if entry and entry['version'] == version and \
+                (entry['empty'] or os.path.exists(path)):
+            self.reused += 1
+            return None if entry['empty'] else path
+
+        self.rebuilt += 1
+        tmp = path + '.tmp'
+        empty = True
+        with open(tmp, 'wb') as f:
+            for chunk in build():
+                f.write(chunk)
+                empty = False
+        if empty:
+            os.remove(tmp)
+            if os.path.exists(path):
+                os.remove(path)
+        else:
+            os.rename(tmp, path)
+        self.manifest[name] = {'version': version, 'empty': empty}
+        self.save()
+        return None if empty else path
+
+
+class IncrementalFeedExporter(FeedExporter):
+    """FeedExporter rebuilding only what changed since the last export
+
+    Fragments are stored in `cache_dir`. Tables in PARTITIONED_TABLES are
+    kept per route and shared by every route selection, the others per
+    selection. A fragment is rebuilt when a `TableVersion` counter of one
+    of its TABLE_DEPENDENCIES moved.
+    """
+
+    def __init__(self, routes, cache_dir, chunk_size=CHUNK_SIZE,
+                 simplify=None, expand_frequencies=False):
+        super(IncrementalFeedExporter, self).__init__(
+            routes, chunk_size, simplify, expand_frequencies)
+        self.store = FragmentStore(cache_dir)
+
+    @staticmethod
+    def version(versions, filename, route=None):
+        """Version of a table, or of one of its route partitions"""
+        parts = [versions.get((TableVersion.ALL, 0), 0)]
+        for table in TABLE_DEPENDENCIES[filename]:
+            if route is not None and table == filename:
+                parts.append(versions.get((table, route), 0))
+            else:
+                parts.append(sum(v for (t, r), v in versions.items()
+                                 if t == table))
+        return '-'.join(str(i) for i in parts)
+
+    def table_version(self, versions, filename, route=None):
+        """`version()` together with the options the rows depend on"""
+        version = self.version(versions, filename, route)
+        if filename == 'shapes.txt':
+            # the same geometry gives other points at another tolerance
+            version = '%s@%s' % (version, self.simplify)
+        if self.expand_frequencies and filename in EXPANDED_TABLES:
+            version = '%s+%s' % (
+                version, self.version(versions, 'frequencies.txt'))
+        return version
+
+    def partition_rows(self, filename, route_pk):
+        exporter = FeedExporter(Route.objects.filter(pk=route_pk),
+                                chunk_size=self.chunk_size,
+                                simplify=self.simplify,
+                                expand_frequencies=self.expand_frequencies)
+        rows = dict((f, r) for f, h, r in exporter.tables())[filename]
+        return rows()
+
+    def iter_tables(self, jobs=1, shards=None):
+        """Yield (filename, chunks) like FeedExporter, from fragments
+
+        Fragments are rebuilt one after another, `jobs` is ignored.
+        """
+        versions = TableVersion.versions(self.routes.values('company'))
+        route_pks = list(self.routes.order_by('pk')
+                         .values_list('pk', flat=True).distinct())
+        selection = hashlib.sha1(
+            ','.join(str(pk) for pk in route_pks).encode('ascii')
+        ).hexdigest()[:16]
+
+        for filename, header, rows in self.tables():
+            if filename in PARTITIONED_TABLES:
+                paths = [self.store.fetch(
+                    '%s.%s' % (filename, pk),
+                    self.table_version(versions, filename, pk),
+                    lambda: csv_chunks(None,
+                                       self.partition_rows(filename, pk)))
+                    for pk in route_pks]
+            else:
+                paths = [self.store.fetch(
+                    '%s.%s' % (filename, selection),
+                    self.table_version(versions, filename),
+                    lambda: csv_chunks(None, rows()))]
+            paths = [path for path in paths if path]
+            if not paths:
+                continue
+            yield filename, itertools.chain(
+                csv_chunks(None, [header]),
+                *[file_chunks(path) for path in paths])
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Cache of finished feed archives
+
+A feed is addressed by the routes it was exported for, the `TableVersion`
+counters of their companies and the export options. As long as none of
+them changes the same zip is served again from disk, the database is only
+asked for the counters.
+
+    cache = FeedCache()
+    entry = cache.entry(routes, compresslevel=6)
+    path = cache.get(entry) or cache.put(entry, exporter.write_zip)
+
+Archives live in `settings.GTFS_FEED_CACHE_DIR`, the least recently used
+ones are removed once they add up to more than `GTFS_FEED_CACHE_SIZE`
+bytes.
+"""
+from __future__ import unicode_literals
+import hashlib
+import json
+import os
+import tempfile
+from collections import namedtuple
+
+from django.conf import settings
+
+from .models import TableVersion
+
+DEFAULT_SIZE = 1024 * 1024 * 1024
+
+FeedEntry = namedtuple('FeedEntry', ['key', 'path', 'last_modified'])
+
+
+class FeedCache(object):
+
+    def __init__(self, dir=None, max_size=None):
+        self.dir = dir or getattr(
+            settings, 'GTFS_FEED_CACHE_DIR',
+            os.path.join(settings.BASE_DIR, 'feed-cache'))
+        self.max_size = max_size or getattr(
+            settings, 'GTFS_FEED_CACHE_SIZE', DEFAULT_SIZE)
+
+    def entry(self, routes, **options):
+        """FeedEntry of the feed of `routes` exported with `options`
+
+        Two queries, the route selection and the version counters.
+        """
+        route_pks = sorted(routes.order_by()
+                           .values_list('pk', flat=True).distinct())
+        qs = TableVersion.objects.filter(company__in=routes.values('company'))
+        versions, last_modified = [], None
+        for company, table, route, version, updated_at in qs.values_list(
+                'company', 'table', 'route', 'version', 'updated_at'):
+            versions.append((company, table, route, version))
+            if last_modified is None or updated_at > last_modified:
+                last_modified = updated_at
+        source = json.dumps({
+            'routes': route_pks,
+            'versions': sorted(versions),
+            'options': options,
+        }, sort_keys=True)
+        key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        return FeedEntry(key, os.path.join(self.dir, '%s.zip' % key),
+                         last_modified)
+
+    def get(self, entry):
+        """Path of the cached archive or None, marks it as recently used"""
+        try:
+            os.utime(entry.path, None)
+        except OSError:
+            return None
+        return entry.path
+
+    def put(self, entry, write):
+        """Store the archive `write(fileobj)` produces, returns its path"""
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        fd, tmp = tempfile.mkstemp(dir=self.dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.rename(tmp, entry.path)
+        except Exception:
+            os.remove(tmp)
+            raise
+        self.evict(keep=entry.path)
+        return entry.path
+
+    def tee(self, entry, chunks):
+        """Yield `chunks` while storing them as the archive of `entry`
+
+        The archive only enters the cache once `chunks` ran to the end, an
+        interrupted download leaves nothing behind.
+        """
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        fd, tmp = tempfile.mkstemp(dir=self.dir, suffix='.tmp')
+        complete = False
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for data in chunks:
+                    f.write(data)
+                    yield data
+            complete = True
+        finally:
+            if complete:
+                os.rename(tmp, entry.path)
+                self.evict(keep=entry.path)
+            else:
+                os.remove(tmp)
+
+    def evict(self, keep=None):
+        """Remove least recently used archives above `max_size`"""
+        files = []
+        for name in os.listdir(self.dir):
+            path = os.path.join(self.dir, name)
+            if not name.endswith('.zip') or path == keep:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for mtime, size, path in files)
+        if keep and os.path.exists(keep):
+            total += os.path.getsize(keep)
+        for mtime, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
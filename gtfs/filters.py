@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Spatial filters for the viewsets
+
+    /v1/stop/?bbox=100.50,13.70,100.60,13.80
+    /v1/stop/?near=13.75,100.53&radius=500
+    /v1/stop/?search=siam
+
+Both go through the spatial index of the geometry field (GiST on
+postgis, R*Tree on spatialite). `near` keeps the stops within `radius`
+metres, nearest first, with their `distance` annotated. `search` looks
+stops up in their `StopSearch` rows, see `gtfs.search`.
+"""
+from __future__ import unicode_literals
+import math
+
+from django.contrib.gis.db.models.functions import Distance
+from django.contrib.gis.geos import Point, Polygon
+from django.contrib.gis.measure import D
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend, SearchFilter
+
+from .search import search_stops
+
+# metres of a degree of latitude
+METERS_PER_DEGREE = 111320.0
+DEFAULT_RADIUS = 500
+MAX_RADIUS = 50000
+
+
+def parse_floats(value, count, name):
+    """`count` comma separated finite numbers of parameter `name`"""
+    try:
+        values = [float(i) for i in value.split(',')]
+    except ValueError:
+        values = []
+    if len(values) != count or \
+            any(math.isinf(i) or math.isnan(i) for i in values):
+        raise ValidationError(
+            {name: 'Expected %d comma separated numbers.' % count})
+    return values
+
+
+def bbox_polygon(value, name='bbox'):
+    """Polygon of `min_lon,min_lat,max_lon,max_lat`"""
+    min_lon, min_lat, max_lon, max_lat = parse_floats(value, 4, name)
+    if min_lon > max_lon or min_lat > max_lat:
+        raise ValidationError({name: 'Expected min_lon,min_lat,max_lon,'
+                                     'max_lat.'})
+    polygon = Polygon.from_bbox((min_lon, min_lat, max_lon, max_lat))
+    polygon.srid = 4326
+    return polygon
+
+
+def around(point, radius):
+    """Polygon around `point` covering at least `radius` metres"""
+    dlat = radius / METERS_PER_DEGREE
+    # a degree of longitude shrinks towards the poles
+    dlon = dlat / max(math.cos(math.radians(point.y)), 0.01)
+    polygon = Polygon.from_bbox((point.x - dlon, point.y - dlat,
+                                 point.x + dlon, point.y + dlat))
+    polygon.srid = 4326
+    return polygon
+
+
+class LocationFilter(BaseFilterBackend):
+    """`bbox=` and `near=lat,lon&radius=` on `location_field`"""
+    location_field = 'location'
+
+    def filter_queryset(self, request, queryset, view):
+        params = request.query_params
+        field = getattr(view, 'location_field', self.location_field)
+        if params.get('bbox'):
+            queryset = queryset.filter(**{
+                '%s__within' % field: bbox_polygon(params['bbox'])})
+        if params.get('near'):
+            lat, lon = parse_floats(params['near'], 2, 'near')
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                raise ValidationError({'near': 'Expected lat,lon.'})
+            try:
+                radius = float(params.get('radius', DEFAULT_RADIUS))
+            except ValueError:
+                raise ValidationError({'radius': 'Expected metres.'})
+            if not 0 < radius <= MAX_RADIUS:
+                raise ValidationError(
+                    {'radius': 'Expected 0 < radius <= %d.' % MAX_RADIUS})
+            point = Point(lon, lat, srid=4326)
+            # the box uses the index, the distance is exact
+            queryset = queryset.filter(**{
+                '%s__within' % field: around(point, radius),
+                '%s__distance_lte' % field: (point, D(m=radius)),
+            }).annotate(distance=Distance(field, point)) \
+                .order_by('distance')
+        return queryset
+
+
+class StopSearchFilter(SearchFilter):
+    """`search=` terms of stop names, codes and the routes serving them"""
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+        return search_stops(queryset, terms)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Frequency based trips written out as plain trips
+
+    starts = departures([(time(6), time(9), 600)])
+    trip_id = frequency_trip_id('T1', starts[0])        # T1-060000
+    for row in expand_stoptimes(template, starts):
+        ...
+
+A trip with `Frequency` rows is a template. Its stop times are offsets
+from its first departure, and every `start_time + x * headway_secs`
+before `end_time` of each of its frequencies becomes a trip of its own
+with the stop times shifted to start there. Times are written as GTFS
+does, past 24:00:00 for trips running after midnight.
+
+With numpy installed the times of all departures of a template are
+computed as one matrix, otherwise by a plain loop. Either way only one
+template is held in memory at a time.
+"""
+from __future__ import unicode_literals
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DAY = 24 * 3600
+# column of the times in StopTime.gtfs_columns
+ARRIVAL, DEPARTURE = 1, 2
+
+
+def seconds(value):
+    return value.hour * 3600 + value.minute * 60 + value.second
+
+
+_formatted = {}
+
+
+def format_time(value):
+    """HH:MM:SS of `value` seconds, hours may go past 24"""
+    text = _formatted.get(value)
+    if text is None:
+        text = _formatted[value] = '%02d:%02d:%02d' % (
+            value // 3600, value // 60 % 60, value % 60)
+    return text
+
+
+def frequency_trip_id(trip_id, start):
+    return '%s-%s' % (trip_id, format_time(start).replace(':', ''))
+
+
+def departures(frequencies):
+    """Sorted start times in seconds of (start_time, end_time,
+    headway_secs) `frequencies`"""
+    starts = set()
+    for start_time, end_time, headway in frequencies:
+        start, end = seconds(start_time), seconds(end_time)
+        if end <= start:
+            # runs past midnight
+            end += DAY
+        starts.update(range(start, end, max(headway, 1)))
+    return sorted(starts)
+
+
+def forward_offsets(times):
+    """Arrival and departure offsets in seconds from the first departure
+    of (arrival, departure) `times` in seconds, in sequence order"""
+    origin = times[0][0]
+    values = []
+    for pair in times:
+        for value in pair:
+            value = (value - origin) % DAY
+            # times only go forward, a time before the previous one is
+            # on the next day
+            while values and value < values[-1]:
+                value += DAY
+            values.append(value)
+    first = values[1]
+    return ([i - first for i in values[0::2]],
+            [i - first for i in values[1::2]])
+
+
+def offsets(template):
+    """`forward_offsets()` of StopTime rows sorted by sequence"""
+    return forward_offsets([(seconds(row[ARRIVAL]), seconds(row[DEPARTURE]))
+                            for row in template])
+
+
+def _times_numpy(starts, arrivals, departures):
+    starts = numpy.asarray(starts)[:, numpy.newaxis]
+    return ((starts + numpy.asarray(arrivals)).tolist(),
+            (starts + numpy.asarray(departures)).tolist())
+
+
+def _times_python(starts, arrivals, departures):
+    return ([[start + i for i in arrivals] for start in starts],
+            [[start + i for i in departures] for start in starts])
+
+
+def expand_stoptimes(template, starts):
+    """StopTime rows of every departure in `starts` of a `template` trip
+
+    `template` are the StopTime.gtfs_columns rows of the trip sorted by
+    sequence, with `time` values.
+    """
+    if not template or not starts:
+        return
+    arrivals, departures = offsets(template)
+    times = _times_numpy if numpy is not None else _times_python
+    for start, arrival_row, departure_row in zip(
+            starts, *times(starts, arrivals, departures)):
+        trip_id = frequency_trip_id(template[0][0], start)
+        for row, arrival, departure in zip(template, arrival_row,
+                                           departure_row):
+            yield (trip_id, format_time(arrival), format_time(departure)) \
+                + tuple(row[3:])
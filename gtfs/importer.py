@@ -0,0 +1,491 @@
+# -*- coding: utf-8 -*-
+"""Bulk GTFS feed importer
+
+Reads a GTFS zip table by table with the `csv` module and inserts every
+table in batches (`bulk_create`, or `COPY` on postgresql for tables without
+geometry). GTFS ids are resolved to primary keys through dictionaries built
+with one query per table, the whole feed is loaded in a single transaction.
+Text longer than its column stops the import with a `FeedError` naming
+the row, as does any value that can not be read.
+
+    importer = FeedImporter(company, 'feed.zip', log=print)
+    importer.run()
+"""
+from __future__ import unicode_literals
+import csv
+import io
+import time
+import zipfile
+from collections import defaultdict
+from datetime import date, time as daytime
+from decimal import Decimal
+
+from django.contrib.gis.db.models import GeometryField
+from django.contrib.gis.geos import Point, LineString
+from django.db import connection, transaction
+from django.db.models import CharField
+from django.utils import six
+
+from .models import (
+    Agency, Route, FareRule, Frequency, Calendar, CalendarDate,
+    StopTime, Stop, FareAttribute, Trip, TableVersion, TripSummary,
+    StopSearch
+)
+
+BATCH_SIZE = 5000
+
+
+class FeedError(Exception):
+    pass
+
+
+def _date(value):
+    return date(int(value[:4]), int(value[4:6]), int(value[6:8]))
+
+
+def _time(value):
+    """GTFS time, hours past midnight (e.g. 25:10:00) wrap around
+
+    TimeField can not hold a service day longer than 24 hours. A time
+    before the one of the previous stop is read as the next day, see
+    `gtfs.frequencies.forward_offsets`.
+    """
+    h, m, s = [int(i) for i in value.split(':')]
+    return daytime(h % 24, m, s)
+
+
+def _flag(value):
+    return value == '1'
+
+
+def _copy_value(value):
+    """Encode a value for `COPY ... FROM STDIN` text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return six.text_type(value).replace('\\', '\\\\') \
+        .replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class _CopyFile(object):
+    """Read-only file over an iterator of bytes for `cursor.copy_expert`"""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.buf = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            try:
+                self.buf += next(self.lines)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self.buf = self.buf, b''
+        else:
+            data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    readline = read
+
+
+class FeedImporter(object):
+    """Load a GTFS zip at `path` into `company`
+
+    batch_size  rows per `bulk_create`
+    use_copy    use postgresql `COPY` for tables without geometry,
+                defaults to whether the database is postgresql
+    log         called with a line of text after every table
+    """
+
+    def __init__(self, company, path, batch_size=BATCH_SIZE, use_copy=None,
+                 log=None):
+        self.company = company
+        self.path = path
+        self.batch_size = batch_size
+        if use_copy is None:
+            use_copy = connection.vendor == 'postgresql'
+        self.use_copy = use_copy
+        self.log = log
+        self.report = []
+        self._max_lengths = {}
+        # (filename, line) of the row being read
+        self.position = None
+
+    # reading
+
+    def rows(self, filename):
+        """Yield every row of `filename` as a dict of text"""
+        with self.zip.open(filename) as f:
+            if six.PY2:
+                reader = csv.reader(f, skipinitialspace=True)
+                decode = lambda row: [c.decode('utf-8') for c in row]
+            else:
+                reader = csv.reader(
+                    io.TextIOWrapper(f, encoding='utf-8', newline=''),
+                    skipinitialspace=True)
+                decode = lambda row: row
+            header = None
+            for row in reader:
+                if not row:
+                    continue
+                self.position = (filename, reader.line_num)
+                row = [c.strip() for c in decode(row)]
+                if header is None:
+                    header = [c.lstrip('\ufeff') for c in row]
+                    continue
+                yield dict(zip(header, row))
+
+    def has(self, filename):
+        return filename in self.names
+
+    def where(self):
+        return '%s line %d' % self.position if self.position else 'feed'
+
+    def time(self, value, column):
+        try:
+            return _time(value)
+        except ValueError:
+            raise FeedError('%s: %s "%s" is not a time HH:MM:SS' % (
+                self.where(), column, value))
+
+    # writing
+
+    def build(self, model, **values):
+        """Unsaved `model` of this company, FeedError on text longer than
+        its field"""
+        if model not in self._max_lengths:
+            self._max_lengths[model] = dict(
+                (f.attname, f.max_length)
+                for f in model._meta.concrete_fields
+                if isinstance(f, CharField) and f.max_length)
+        for attname, max_length in self._max_lengths[model].items():
+            value = values.get(attname)
+            if value and len(value) > max_length:
+                raise FeedError(
+                    '%s: %s "%s" is longer than %d characters' % (
+                        self.where(), attname, value, max_length))
+        return model(company_id=self.company.pk, **values)
+
+    def load(self, model, objs):
+        """Insert `objs`, returns the number of rows"""
+        geometry = any(isinstance(f, GeometryField)
+                       for f in model._meta.concrete_fields)
+        if self.use_copy and not geometry:
+            return self.copy(model, objs)
+        count, batch = 0, []
+        for obj in objs:
+            batch.append(obj)
+            if len(batch) >= self.batch_size:
+                model.objects.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            model.objects.bulk_create(batch)
+            count += len(batch)
+        return count
+
+    def copy(self, model, objs):
+        fields = [f for f in model._meta.concrete_fields if not f.primary_key]
+        qn = connection.ops.quote_name
+        sql = 'COPY %s (%s) FROM STDIN' % (
+            qn(model._meta.db_table), ', '.join(qn(f.column) for f in fields))
+        counter = [0]
+
+        def lines():
+            for obj in objs:
+                counter[0] += 1
+                values = [f.get_db_prep_save(f.pre_save(obj, True),
+                                             connection) for f in fields]
+                line = '\t'.join(_copy_value(v) for v in values) + '\n'
+                yield line.encode('utf-8')
+
+        with connection.cursor() as cursor:
+            cursor.copy_expert(sql, _CopyFile(lines()))
+        return counter[0]
+
+    def keys(self, model, field):
+        """{gtfs id: pk} of everything of this company in `model`"""
+        return dict(model.objects.filter(company=self.company)
+                    .values_list(field, 'pk'))
+
+    def resolve(self, keys, value, column):
+        try:
+            return keys[value]
+        except KeyError:
+            raise FeedError('%s: unknown %s "%s"' % (
+                self.where(), column, value))
+
+    # tables
+
+    def agencies(self):
+        for row in self.rows('agency.txt'):
+            yield self.build(
+                Agency,
+                agency_id=row.get('agency_id', ''),
+                name=row['agency_name'],
+                url=row.get('agency_url', ''),
+                timezone=row.get('agency_timezone', ''),
+                phone=row.get('agency_phone', ''),
+                lang=row.get('agency_lang', ''),
+                fare_url=row.get('agency_fare_url', ''),
+                email=row.get('agency_email', ''))
+
+    def stops(self, stations):
+        """Stations first, then everything else so parents can be resolved
+        """
+        parents = self.keys(Stop, 'stop_id') if not stations else {}
+        for row in self.rows('stops.txt'):
+            if (row.get('location_type') == '1') != stations:
+                continue
+            parent = row.get('parent_station')
+            yield self.build(
+                Stop,
+                stop_id=row['stop_id'],
+                name=row.get('stop_name', ''),
+                location=Point(float(row['stop_lon']),
+                               float(row['stop_lat']), srid=4326),
+                stop_code=row.get('stop_code', ''),
+                stop_desc=row.get('stop_desc', ''),
+                zone_id=row.get('zone_id', ''),
+                location_type=row.get('location_type') or '0',
+                parent_station_id=self.resolve(
+                    parents, parent, 'parent_station')
+                if parent else None,
+                stop_timezone=row.get('stop_timezone', ''),
+                wheelchair_boarding=row.get('wheelchair_boarding') or '0')
+
+    def route_shapes(self):
+        """{route_id: LineString} from the shape of the first trip of route
+        """
+        if not self.has('shapes.txt') or not self.has('trips.txt'):
+            return {}
+        shape_of_route = {}
+        for row in self.rows('trips.txt'):
+            if row.get('shape_id'):
+                shape_of_route.setdefault(row['route_id'], row['shape_id'])
+        wanted = set(shape_of_route.values())
+        points = defaultdict(list)
+        for row in self.rows('shapes.txt'):
+            if row['shape_id'] in wanted:
+                points[row['shape_id']].append((
+                    int(row['shape_pt_sequence']),
+                    float(row['shape_pt_lon']),
+                    float(row['shape_pt_lat'])))
+        shapes = {}
+        for route_id, shape_id in shape_of_route.items():
+            pts = sorted(points.get(shape_id, []))
+            if len(pts) > 1:
+                shapes[route_id] = LineString(
+                    [(x, y) for seq, x, y in pts], srid=4326)
+        return shapes
+
+    def routes(self):
+        agencies = self.keys(Agency, 'agency_id')
+        # agency_id is optional in routes.txt when there is only one
+        default = list(agencies.values())[0] if len(agencies) == 1 else None
+        shapes = self.route_shapes()
+        for row in self.rows('routes.txt'):
+            agency = row.get('agency_id')
+            yield self.build(
+                Route,
+                route_id=row['route_id'],
+                short_name=row.get('route_short_name', ''),
+                long_name=row.get('route_long_name', ''),
+                desc=row.get('route_desc', ''),
+                route_type=row.get('route_type') or '3',
+                route_url=row.get('route_url', ''),
+                route_color=row.get('route_color', ''),
+                route_text_color=row.get('route_text_color', ''),
+                route_sort_order=int(row.get('route_sort_order') or 0),
+                agency_id=self.resolve(agencies, agency, 'agency_id')
+                if agency else default,
+                shapes=shapes.get(row['route_id']))
+
+    def calendars(self):
+        days = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+                'saturday', 'sunday')
+        for row in self.rows('calendar.txt'):
+            values = dict((d, _flag(row.get(d))) for d in days)
+            yield self.build(
+                Calendar,
+                service_id=row['service_id'],
+                start_date=_date(row['start_date']),
+                end_date=_date(row['end_date']),
+                **values)
+
+    def calendar_dates(self):
+        rows = list(self.rows('calendar_dates.txt'))
+        services = self.keys(Calendar, 'service_id')
+        # services defined by exceptions only still need a Calendar
+        missing = defaultdict(list)
+        for row in rows:
+            if row['service_id'] not in services:
+                missing[row['service_id']].append(_date(row['date']))
+        if missing:
+            Calendar.objects.bulk_create([
+                self.build(Calendar, service_id=service_id,
+                           start_date=min(dates), end_date=max(dates))
+                for service_id, dates in missing.items()
+            ])
+            services = self.keys(Calendar, 'service_id')
+        for row in rows:
+            yield self.build(
+                CalendarDate,
+                service_id=services[row['service_id']],
+                date=_date(row['date']),
+                exception_type=row['exception_type'])
+
+    def trips(self):
+        routes = self.keys(Route, 'route_id')
+        services = self.keys(Calendar, 'service_id')
+        for row in self.rows('trips.txt'):
+            yield self.build(
+                Trip,
+                route_id=self.resolve(routes, row['route_id'], 'route_id'),
+                service_id=self.resolve(services, row['service_id'],
+                                        'service_id'),
+                trip_id=row['trip_id'],
+                trip_headsign=row.get('trip_headsign', ''),
+                short_name=row.get('trip_short_name', ''),
+                direction_id=row.get('direction_id', ''),
+                block_id=row.get('block_id', ''),
+                wheelchair_accessible=row.get('wheelchair_accessible', ''),
+                bike_allowed=row.get('bikes_allowed', ''))
+
+    def stoptimes(self):
+        trips = self.keys(Trip, 'trip_id')
+        stops = self.keys(Stop, 'stop_id')
+        trip, last = None, None
+        for row in self.rows('stop_times.txt'):
+            if row['trip_id'] != trip:
+                trip, last = row['trip_id'], None
+            # times are optional between timepoints, TimeField is not
+            arrival = row.get('arrival_time') or \
+                row.get('departure_time') or last
+            departure = row.get('departure_time') or arrival
+            if arrival is None:
+                raise FeedError('%s: trip "%s" has no time at its first '
+                                'stop' % (self.where(), trip))
+            last = departure
+            yield self.build(
+                StopTime,
+                trip_id=self.resolve(trips, trip, 'trip_id'),
+                stop_id=self.resolve(stops, row['stop_id'], 'stop_id'),
+                arrival=self.time(arrival, 'arrival_time'),
+                departure=self.time(departure, 'departure_time'),
+                sequence=int(row['stop_sequence']),
+                stop_headsign=row.get('stop_headsign', ''),
+                pickup_type=row.get('pickup_type') or '0',
+                drop_off_type=row.get('drop_off_type') or '0',
+                shape_dist_traveled=row.get('shape_dist_traveled', ''),
+                timepoint=row.get('timepoint', ''))
+
+    def frequencies(self):
+        trips = self.keys(Trip, 'trip_id')
+        for row in self.rows('frequencies.txt'):
+            yield self.build(
+                Frequency,
+                trip_id=self.resolve(trips, row['trip_id'], 'trip_id'),
+                start_time=self.time(row['start_time'], 'start_time'),
+                end_time=self.time(row['end_time'], 'end_time'),
+                headway_secs=int(row['headway_secs']),
+                exact_times=row.get('exact_times') or '0')
+
+    def fare_attributes(self):
+        agencies = self.keys(Agency, 'agency_id')
+        for row in self.rows('fare_attributes.txt'):
+            agency = row.get('agency_id')
+            yield self.build(
+                FareAttribute,
+                fare_id=row['fare_id'],
+                price=Decimal(row['price']),
+                currency_type=row['currency_type'],
+                payment_method=row.get('payment_method') or '0',
+                transfer=row.get('transfers', ''),
+                agency_id=agencies.get(agency) if agency else None,
+                transfer_duration=row.get('transfer_duration', ''))
+
+    def fare_rules(self):
+        fares = self.keys(FareAttribute, 'fare_id')
+        routes = self.keys(Route, 'route_id')
+        for row in self.rows('fare_rules.txt'):
+            # FareRule can only express route based fares
+            if not row.get('route_id'):
+                continue
+            yield self.build(
+                FareRule,
+                fare_id=self.resolve(fares, row['fare_id'], 'fare_id'),
+                route_id=self.resolve(routes, row['route_id'], 'route_id'))
+
+    def tables(self):
+        """(filename, model, rows) in dependency order"""
+        return [
+            ('agency.txt', Agency, self.agencies),
+            ('stops.txt', Stop, lambda: self.stops(stations=True)),
+            ('stops.txt', Stop, lambda: self.stops(stations=False)),
+            ('routes.txt', Route, self.routes),
+            ('calendar.txt', Calendar, self.calendars),
+            ('calendar_dates.txt', CalendarDate, self.calendar_dates),
+            ('trips.txt', Trip, self.trips),
+            ('stop_times.txt', StopTime, self.stoptimes),
+            ('frequencies.txt', Frequency, self.frequencies),
+            ('fare_attributes.txt', FareAttribute, self.fare_attributes),
+            ('fare_rules.txt', FareRule, self.fare_rules),
+        ]
+
+    def delete_existing(self):
+        """Remove the whole feed of this company, dependants first
+
+        One DELETE per table, without collecting the rows or sending
+        signals (which would refresh summaries and search rows one stop
+        time at a time). `run()` bumps the versions and rebuilds those.
+        """
+        company = self.company.pk
+        querysets = [
+            StopTime.objects.filter(company=company),
+            Frequency.objects.filter(company=company),
+            TripSummary.objects.filter(trip__company=company),
+            Trip.objects.filter(company=company),
+            CalendarDate.objects.filter(company=company),
+            FareRule.objects.filter(company=company),
+            FareAttribute.objects.filter(company=company),
+            Calendar.objects.filter(company=company),
+            Route.objects.filter(company=company),
+            StopSearch.objects.filter(company=company),
+            # stations last, stops refer to them
+            Stop.objects.filter(company=company,
+                                parent_station__isnull=False),
+            Stop.objects.filter(company=company),
+            Agency.objects.filter(company=company),
+        ]
+        for qs in querysets:
+            qs._raw_delete(qs.db)
+
+    def run(self, replace=False):
+        """Import the feed, returns [(filename, rows, seconds), ...]"""
+        self.report = []
+        with zipfile.ZipFile(self.path) as self.zip, transaction.atomic():
+            self.names = set(self.zip.namelist())
+            if replace:
+                self.delete_existing()
+            for filename, model, rows in self.tables():
+                if not self.has(filename):
+                    continue
+                start = time.time()
+                count = self.load(model, rows())
+                self.report.append((filename, count, time.time() - start))
+                if self.log:
+                    self.log(self.format_report(*self.report[-1]))
+            # bulk inserts skip signals
+            TableVersion.bump(self.company.pk, TableVersion.ALL)
+            TripSummary.rebuild(Trip.objects.filter(company=self.company))
+            StopSearch.rebuild(Stop.objects.filter(company=self.company))
+        return self.report
+
+    @staticmethod
+    def format_report(filename, count, seconds):
+        rate = count / seconds if seconds else 0
+        return '%-20s %10d rows %8.2fs %10.0f rows/s' % (
+            filename, count, seconds, rate)
@@ -0,0 +1,193 @@
+from __future__ import print_function
+from django.core.management.base import BaseCommand, CommandError
+from people.models import Company
+from gtfs.bench import SyntheticFeed, Benchmark, SIZES, compare
+import json
+import time
+
+help = '''
+Benchmark export, API and import on a synthetic feed
+
+./manage.py gtfs_bench <command> [options]
+
+Command:
+generate            (re)create the synthetic feed of --company
+run                 time export, /v1/ list endpoints, journey planner and
+                    import of --company
+compare <old> <new> diff two results files
+clean               delete the synthetic feed of --company
+
+Generate options:
+--size          small, medium or large (default: small)
+                small  10 routes x 20 trips x 20 stops
+                medium 50 routes x 100 trips x 40 stops
+                large  200 routes x 200 trips x 50 stops (2M stop_times)
+--agencies, --routes, --trips, --stops, --shape-points
+                override a single dimension of --size
+--seed          random seed (default: 0)
+
+Run options:
+--output        results file (default: bench-<time>.json)
+--repeat        keep the best of this many runs of every step (default: 1)
+--only          comma separated steps, e.g. export,import or
+                snapshot_build,plan_build,plan_query,api_plan
+--jobs          also time the export with this many processes
+
+Compare options:
+--threshold     relative change counted as a regression (default: 0.1)
+--fail          exit with an error when there is a regression
+
+--company       slug of the benchmark company (default: bench)
+'''
+
+
+class Command(BaseCommand):
+    help = help
+
+    def add_arguments(self, parser):
+        parser.add_argument('op', nargs='+', type=str)
+        parser.add_argument(
+            '--company',
+            action='store',
+            dest='company',
+            default='bench',
+            help='slug of the benchmark company')
+        parser.add_argument(
+            '--size',
+            action='store',
+            dest='size',
+            choices=sorted(SIZES),
+            default='small',
+            help='size of the synthetic feed')
+        for name in ('agencies', 'routes', 'trips', 'stops', 'shape-points'):
+            parser.add_argument(
+                '--%s' % name,
+                action='store',
+                dest=name.replace('-', '_'),
+                type=int,
+                default=None,
+                help='override the %s of --size' % name)
+        parser.add_argument(
+            '--seed',
+            action='store',
+            dest='seed',
+            type=int,
+            default=0,
+            help='random seed of the synthetic feed')
+        parser.add_argument(
+            '--output',
+            action='store',
+            dest='output',
+            default='',
+            help='results file')
+        parser.add_argument(
+            '--repeat',
+            action='store',
+            dest='repeat',
+            type=int,
+            default=1,
+            help='keep the best of this many runs')
+        parser.add_argument(
+            '--only',
+            action='store',
+            dest='only',
+            default='',
+            help='comma separated steps to run')
+        parser.add_argument(
+            '--jobs',
+            action='store',
+            dest='jobs',
+            type=int,
+            default=1,
+            help='also time the export with this many processes')
+        parser.add_argument(
+            '--threshold',
+            action='store',
+            dest='threshold',
+            type=float,
+            default=0.1,
+            help='relative change counted as a regression')
+        parser.add_argument(
+            '--fail',
+            action='store_true',
+            dest='fail',
+            default=False,
+            help='exit with an error when there is a regression')
+
+    def help_and_exit(self, message=''):
+        if message:
+            print(message)
+        print(help)
+        raise SystemExit(1)
+
+    def get_company(self, slug, create=False):
+        if create:
+            company, created = Company.objects.get_or_create(
+                slug=slug, defaults={'name': 'Benchmark %s' % slug,
+                                     'url': ''})
+            return company
+        try:
+            return Company.objects.get(slug=slug)
+        except Company.DoesNotExist:
+            raise CommandError('Company "%s" could not be found, '
+                               'generate it first' % slug)
+
+    def generate(self, options):
+        company = self.get_company(options['company'], create=True)
+        size = dict(SIZES[options['size']])
+        for name in size:
+            if options.get(name) is not None:
+                size[name] = options[name]
+        feed = SyntheticFeed(company, seed=options['seed'], log=print,
+                             **size)
+        feed.delete()
+        start = time.time()
+        counts = feed.generate()
+        print('%d rows in %.2fs' % (sum(counts.values()),
+                                    time.time() - start))
+
+    def run(self, options):
+        company = self.get_company(options['company'])
+        only = [i for i in options['only'].split(',') if i]
+        bench = Benchmark(company, repeat=options['repeat'], log=print)
+        results = bench.run(only=only, jobs=options['jobs'])
+        output = options['output'] or \
+            'bench-%s.json' % time.strftime('%Y%m%d-%H%M%S')
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(output)
+
+    def compare(self, old, new, options):
+        with open(old) as f:
+            old = json.load(f)
+        with open(new) as f:
+            new = json.load(f)
+        regressions = 0
+        for name, metric, a, b, change, regression in compare(
+                old, new, options['threshold']):
+            if metric is None:
+                print('%-24s %s' % (name, 'only in new' if a is None
+                                    else 'only in old'))
+                continue
+            regressions += regression
+            print('%-24s %-12s %12s %12s %+8.1f%%%s' % (
+                name, metric, a, b, change * 100,
+                '  REGRESSION' if regression else ''))
+        if regressions and options['fail']:
+            raise CommandError('%d regressions' % regressions)
+
+    def handle(self, *args, **options):
+        op = options['op']
+        if op[0] == 'generate':
+            return self.generate(options)
+        if op[0] == 'run':
+            return self.run(options)
+        if op[0] == 'compare':
+            if len(op) < 3:
+                self.help_and_exit('compare needs two results files')
+            return self.compare(op[1], op[2], options)
+        if op[0] == 'clean':
+            company = self.get_company(options['company'])
+            SyntheticFeed(company).delete()
+            return
+        self.help_and_exit()
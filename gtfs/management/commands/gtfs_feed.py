@@ -1,13 +1,16 @@
 from __future__ import print_function
 from django.core.management.base import BaseCommand, CommandError
-from gtfs.models import (
-    Agency, Route, FareRule, Frequency, Calendar, CalendarDate,
-    StopTime, Stop, FareAttribute, Trip
+from people.models import Company
+from gtfs.models import Agency, Route
+from gtfs.export import (
+    FeedExporter, IncrementalFeedExporter, select_routes, CHUNK_SIZE
 )
-from shutil import make_archive, rmtree
+from gtfs.importer import FeedImporter, FeedError, BATCH_SIZE
+from gtfs.feedcache import FeedCache
+from gtfs.shapes import default_tolerance
+from shutil import make_archive, rmtree, copyfile
 import tempfile
 import sys
-import csv
 import os
 
 help = '''
@@ -18,13 +21,38 @@ Export GTFS to the whole feed
 Command:
 list          list available agency/route for exporting
 export        output as gtfs zip
+import <zip>  load a gtfs zip into --company
 
-Options:
+Import options:
+--company     slug of the company to import into (export: to export from)
+--batch-size  rows per bulk insert (default: %(batch)s)
+--replace     delete the company's current feed first
+
+Export options:
 --output      zip name (default: output.zip)
 --agency      agency_id with comma (,) as separator
 --route       route_id with comma (,) as separator
               NOTE: route will override agency always
-'''
+--chunk-size  rows fetched from the database per round trip
+              (default: %(chunk)s)
+--stream      write the zip in one pass, without a temporary build directory
+--compress-level
+              zlib level 0-9 for --stream, 0 stores uncompressed (default: 6)
+--zip64       always write ZIP64 entries, needed for members over 4 GiB
+--jobs        export tables with this many processes (default: 1)
+--shards      key-range shards for stop_times/shapes with --jobs
+              (default: same as --jobs)
+--cache-dir   keep table fragments in this directory and only rebuild the
+              tables (or routes of stop_times/shapes) changed since the last
+              export, --jobs is ignored
+--cache       serve the zip from the feed archive cache when the data has
+              not changed since it was built, implies --stream
+--simplify    drop shape points within this many metres of the line
+              (default: GTFS_SHAPE_TOLERANCE setting, 0 keeps every point)
+--expand-frequencies
+              write every departure of a trip with frequencies as a trip
+              with its own stop_times, without frequencies.txt
+''' % {'batch': BATCH_SIZE, 'chunk': CHUNK_SIZE}
 
 class Command(BaseCommand):
     help = help
@@ -50,6 +78,91 @@ class Command(BaseCommand):
             dest='route_ids',
             default='',
             help='route_id with comma (,) as separator')
+        parser.add_argument(
+            '--chunk-size',
+            action='store',
+            dest='chunk_size',
+            type=int,
+            default=CHUNK_SIZE,
+            help='rows fetched from the database per round trip')
+        parser.add_argument(
+            '--stream',
+            action='store_true',
+            dest='stream',
+            default=False,
+            help='write the zip in one pass without a build directory')
+        parser.add_argument(
+            '--compress-level',
+            action='store',
+            dest='compress_level',
+            type=int,
+            choices=range(10),
+            default=6,
+            help='zlib compression level for --stream, 0 means stored')
+        parser.add_argument(
+            '--zip64',
+            action='store_true',
+            dest='zip64',
+            default=False,
+            help='always write ZIP64 entries')
+        parser.add_argument(
+            '--jobs',
+            action='store',
+            dest='jobs',
+            type=int,
+            default=1,
+            help='export tables with this many processes')
+        parser.add_argument(
+            '--shards',
+            action='store',
+            dest='shards',
+            type=int,
+            default=None,
+            help='key-range shards for stop_times and shapes with --jobs')
+        parser.add_argument(
+            '--cache-dir',
+            action='store',
+            dest='cache_dir',
+            default='',
+            help='rebuild only changed fragments kept in this directory')
+        parser.add_argument(
+            '--cache',
+            action='store_true',
+            dest='cache',
+            default=False,
+            help='reuse the cached archive of unchanged data')
+        parser.add_argument(
+            '--simplify',
+            action='store',
+            dest='simplify',
+            type=float,
+            default=None,
+            help='shape simplification tolerance in metres')
+        parser.add_argument(
+            '--expand-frequencies',
+            action='store_true',
+            dest='expand_frequencies',
+            default=False,
+            help='write frequency based trips out as plain trips')
+        parser.add_argument(
+            '--company',
+            action='store',
+            dest='company',
+            default='',
+            help='slug of the company to import into')
+        parser.add_argument(
+            '--batch-size',
+            action='store',
+            dest='batch_size',
+            type=int,
+            default=BATCH_SIZE,
+            help='rows per bulk insert')
+        parser.add_argument(
+            '--replace',
+            action='store_true',
+            dest='replace',
+            default=False,
+            help="delete the company's current feed before importing")
 
     def help_and_exit(self, message=''):
         if message:
@@ -89,92 +202,125 @@ class Command(BaseCommand):
                 print('%s. %s' % (order, a.agency_id))
                 order += 1
 
-    def shapes_file(self, dir, route_qs):
-        route_qs = route_qs.distinct()
-        if not route_qs:  # just skip if there is nothing at all
-            return
-        _header = route_qs[0].shapes_gtfs_header
-        with open(os.path.join(dir, 'shapes.txt'), 'a') as f:
-            cf = csv.DictWriter(f, fieldnames=_header)
-            cf.writeheader()
-            for route in route_qs:
-                for shape in route.export_to_shapes():
-                    cf.writerow(shape)
-
-    def gtfs_file(self, dir, queryset, filename, ):
-        queryset = queryset.distinct()
-        if not queryset:  # just skip if there is nothing at all
-            return
-        _header = queryset[0].gtfs_header
-        with open(os.path.join(dir, filename), 'a') as f:
-            cf = csv.DictWriter(f, fieldnames=_header)
-            cf.writeheader()
-            for row in queryset:
-                cf.writerow(row.gtfs_format())
-
-    def export_feed(self, routes, dir):
-        # agency
-        agencies = Agency.objects.filter(route__in=routes)
-        self.gtfs_file(dir, agencies, 'agency.txt')
-
-        # route
-        self.gtfs_file(dir, routes, 'routes.txt')
-        # shapes need special treatments
-        self.shapes_file(dir, routes)
-
-        # fare
-        fare_rules = FareRule.objects.filter(route__in=routes)
-        fare_attrs = FareAttribute.objects.filter(farerule__in=fare_rules)
-        self.gtfs_file(dir, fare_rules, 'fare_rules.txt')
-        self.gtfs_file(dir, fare_attrs, 'fare_attributes.txt')
-
-        # trip, shapes
-        trips = Trip.objects.filter(route__in=routes)
-        self.gtfs_file(dir, trips, 'trips.txt')
-
-        # frequency
-        freqs = Frequency.objects.filter(trip__in=trips)
-        self.gtfs_file(dir, freqs, 'frequencies.txt')
-
-        # stop_times, stop, transfer
-        stoptimes = StopTime.objects.filter(trip__in=trips)
-        stops = Stop.objects.filter(stoptime__in=stoptimes).distinct()
-        self.gtfs_file(dir, stoptimes, 'stop_times.txt')
-        self.gtfs_file(dir, stops, 'stops.txt')
-
-        # Calendar
-        srv_ids = [s['service'] for s in trips.values('service').distinct()]
-        calendars = Calendar.objects.filter(pk__in=srv_ids)
-        cal_exceptions = CalendarDate.objects.filter(service__in=calendars)
-        self.gtfs_file(dir, calendars, 'calendar.txt')
-        self.gtfs_file(dir, cal_exceptions, 'calendar_dates.txt')
+    def get_exporter(self, routes, options):
+        if options['cache_dir']:
+            return IncrementalFeedExporter(
+                routes, options['cache_dir'],
+                chunk_size=options['chunk_size'],
+                simplify=options['simplify'],
+                expand_frequencies=options['expand_frequencies'])
+        return FeedExporter(routes, chunk_size=options['chunk_size'],
+                            simplify=options['simplify'],
+                            expand_frequencies=options['expand_frequencies'])
+
+    def print_fragments(self, exporter):
+        if isinstance(exporter, IncrementalFeedExporter):
+            print('fragments: %s rebuilt, %s reused' % (
+                exporter.store.rebuilt, exporter.store.reused))
+
+    def export_feed(self, routes, dir, options):
+        exporter = self.get_exporter(routes, options)
+        exporter.write_dir(dir, jobs=options['jobs'],
+                           shards=options['shards'])
+        self.print_fragments(exporter)
+
+    def zip_options(self, options):
+        return {
+            'compresslevel': options['compress_level'],
+            'zip64': True if options['zip64'] else None,
+        }
 
+    def write_zip(self, routes, fileobj, options):
+        exporter = self.get_exporter(routes, options)
+        exporter.write_zip(fileobj, jobs=options['jobs'],
+                           shards=options['shards'],
+                           **self.zip_options(options))
+        self.print_fragments(exporter)
+
+    def cached_feed(self, routes, output, options):
+        cache = FeedCache()
+        simplify = options['simplify']
+        if simplify is None:
+            simplify = default_tolerance()
+        entry = cache.entry(
+            routes, simplify=simplify,
+            expand_frequencies=options['expand_frequencies'],
+            **self.zip_options(options))
+        path = cache.get(entry)
+        if path is None:
+            print('cache miss: %s' % entry.key)
+            path = cache.put(
+                entry, lambda f: self.write_zip(routes, f, options))
+        else:
+            print('cache hit: %s' % entry.key)
+        filename = '%s.zip' % output
+        copyfile(path, filename)
+        print(filename)
+
+    def stream_feed(self, routes, output, options):
+        filename = '%s.zip' % output
+        try:
+            with open(filename, 'wb') as f:
+                self.write_zip(routes, f, options)
+        except Exception:
+            if os.path.exists(filename):
+                os.remove(filename)
+            raise
+        print(filename)
+
+    def import_feed(self, path, options):
+        if not options['company']:
+            self.help_and_exit('Missing --company')
+        try:
+            company = Company.objects.get(slug=options['company'])
+        except Company.DoesNotExist:
+            self.help_and_exit('Company could not be found')
+        importer = FeedImporter(company, path,
+                                batch_size=options['batch_size'], log=print)
+        try:
+            report = importer.run(replace=options['replace'])
+        except FeedError as e:
+            raise CommandError(e)
+        rows = sum(r[1] for r in report)
+        seconds = sum(r[2] for r in report)
+        print(importer.format_report('total', rows, seconds))
 
     def handle(self, *args, **options):
         if 'list' in options['op']:
             return self.list_possible_agency_and_route()
 
+        if options['op'][0] == 'import':
+            if len(options['op']) < 2:
+                self.help_and_exit('Missing gtfs zip')
+            return self.import_feed(options['op'][1], options)
+
         if 'export' in options['op']:
             agency_ids = options['agency_ids']
             route_ids = options['route_ids']
-            if route_ids:
-                rts = Route.objects.filter(route_id__in=route_ids.split(','))
-            elif agency_ids:
-                q = { 'agency__agency_id__in': agency_ids.split(',') }
-                rts = Route.objects.filter(**q)
-            else:
+            rts = select_routes(route_ids.split(',') if route_ids else None,
+                                agency_ids.split(',') if agency_ids else None,
+                                options['company'])
+            if rts is None:
                 self.help_and_exit('Missing parameters')
 
-            if not rts:
+            if not rts.exists():
                 self.help_and_exit('Route could not be found')
 
+            if options['cache']:
+                self.cached_feed(rts, options['output'], options)
+                return
+
+            if options['stream']:
+                self.stream_feed(rts, options['output'], options)
+                return
+
             tmpdir = tempfile.mkdtemp()
             try:
                 _build = os.path.join(tmpdir, '_build')
                 print(_build)
                 if not os.path.isdir(_build):
                     os.mkdir(_build)
-                self.export_feed(rts, _build)
+                self.export_feed(rts, _build, options)
                 print(options['output'])
                 # data = open(make_archive(tmparchive, 'zip', root_dir), 'rb').read()
                 make_archive(options['output'], 'zip', _build)
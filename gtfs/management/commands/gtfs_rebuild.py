@@ -0,0 +1,81 @@
+from __future__ import print_function
+from django.core.management.base import BaseCommand, CommandError
+from people.models import Company
+from gtfs.models import Trip, TripSummary, Stop, StopSearch
+import time
+
+help = '''
+Recompute the tables derived from the feed
+
+./manage.py gtfs_rebuild [table ...] [options]
+
+Table:
+trip-summary  stop count and time span of every trip (TripSummary)
+stop-search   text stops are searched by (StopSearch)
+
+All of them when none is given.
+
+Options:
+--company     slug of the only company to rebuild
+--chunk-size  rows recomputed per transaction (default: 1000)
+'''
+
+
+class Command(BaseCommand):
+    help = help
+
+    def add_arguments(self, parser):
+        parser.add_argument('tables', nargs='*', type=str)
+        parser.add_argument(
+            '--company',
+            action='store',
+            dest='company',
+            default='',
+            help='slug of the only company to rebuild')
+        parser.add_argument(
+            '--chunk-size',
+            action='store',
+            dest='chunk_size',
+            type=int,
+            default=1000,
+            help='rows recomputed per transaction')
+
+    def trip_summary(self, company, options):
+        trips = Trip.objects.all()
+        if company:
+            trips = trips.filter(company=company)
+        return TripSummary.rebuild(trips, chunk_size=options['chunk_size'])
+
+    def stop_search(self, company, options):
+        stops = Stop.objects.all()
+        if company:
+            stops = stops.filter(company=company)
+        return StopSearch.rebuild(stops, chunk_size=options['chunk_size'])
+
+    def rebuilders(self):
+        return [
+            ('trip-summary', self.trip_summary),
+            ('stop-search', self.stop_search),
+        ]
+
+    def handle(self, *args, **options):
+        company = None
+        if options['company']:
+            try:
+                company = Company.objects.get(slug=options['company'])
+            except Company.DoesNotExist:
+                raise CommandError(
+                    'Company "%s" could not be found' % options['company'])
+        rebuilders = self.rebuilders()
+        names = [name for name, rebuild in rebuilders]
+        for table in options['tables']:
+            if table not in names:
+                raise CommandError('unknown table "%s", one of: %s' % (
+                    table, ', '.join(names)))
+        for name, rebuild in rebuilders:
+            if options['tables'] and name not in options['tables']:
+                continue
+            start = time.time()
+            count = rebuild(company, options)
+            print('%-14s %10d rows %8.2fs' % (name, count,
+                                              time.time() - start))
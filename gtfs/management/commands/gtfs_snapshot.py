@@ -0,0 +1,45 @@
+from __future__ import print_function
+from django.core.management.base import BaseCommand, CommandError
+from people.models import Company
+from gtfs.snapshot import timetable_snapshot
+
+help = '''
+Build the in-memory timetable snapshot and report its size
+
+./manage.py gtfs_snapshot [options]
+
+Every company is reported when none is given. The snapshot is what the
+/v1/ stop, trip and stop time lists are served from with
+GTFS_TIMETABLE_SNAPSHOT on, see gtfs.snapshot.
+
+Options:
+--company     slug of the only company to report
+'''
+
+
+class Command(BaseCommand):
+    help = help
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--company',
+            action='store',
+            dest='company',
+            default='',
+            help='slug of the only company to report')
+
+    def handle(self, *args, **options):
+        companies = Company.objects.order_by('slug')
+        if options['company']:
+            companies = companies.filter(slug=options['company'])
+            if not companies:
+                raise CommandError(
+                    'Company "%s" could not be found' % options['company'])
+        for company in companies:
+            snapshot = timetable_snapshot(company.pk)
+            memory = snapshot.memory()
+            print('%s: %d stops, %d trips, %d stop times in %.2fs' % (
+                company.slug, len(snapshot.stop_pk), len(snapshot.trip_pk),
+                len(snapshot.st_pk), snapshot.build_seconds))
+            for table, size in memory.items():
+                print('  %-12s %10.1f KiB' % (table, size / 1024.0))
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.13 on 2018-06-12 10:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('people', '0002_auto_20180525_2236'),
+        ('gtfs', '0010_auto_20180605_2207'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TableVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table', models.CharField(max_length=30, verbose_name='Table')),
+                ('route', models.IntegerField(default=0, verbose_name='Route')),
+                ('version', models.IntegerField(default=0, verbose_name='Version')),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Updated at')),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='people.Company')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='tableversion',
+            unique_together=set([('company', 'table', 'route')]),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.13 on 2018-06-14 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gtfs', '0011_tableversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TripSummary',
+            fields=[
+                ('trip', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='gtfs.Trip')),
+                ('stop_count', models.IntegerField(default=0, verbose_name='Stop count')),
+                ('first_arrival', models.TimeField(blank=True, null=True, verbose_name='First arrival')),
+                ('first_departure', models.TimeField(blank=True, null=True, verbose_name='First departure')),
+                ('last_arrival', models.TimeField(blank=True, null=True, verbose_name='Last arrival')),
+                ('duration', models.IntegerField(blank=True, null=True, verbose_name='Duration')),
+                ('first_stop', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='gtfs.Stop')),
+                ('last_stop', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='gtfs.Stop')),
+            ],
+        ),
+    ]
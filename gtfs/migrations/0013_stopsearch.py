@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.13 on 2018-06-18 10:41
+from __future__ import unicode_literals
+from collections import defaultdict
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from gtfs.models import search_text
+
+TRIGRAM_INDEX = 'gtfs_stopsearch_text_trgm'
+
+
+def fill_stop_search(apps, schema_editor):
+    Stop = apps.get_model('gtfs', 'Stop')
+    StopTime = apps.get_model('gtfs', 'StopTime')
+    Route = apps.get_model('gtfs', 'Route')
+    StopSearch = apps.get_model('gtfs', 'StopSearch')
+    routes = defaultdict(set)
+    served = StopTime.objects.order_by() \
+        .values_list('stop', 'trip__route').distinct()
+    for stop, route in served.iterator():
+        routes[stop].add(route)
+    labels = dict(
+        (row[0], row[1:]) for row in Route.objects
+        .values_list('pk', 'agency__name', 'short_name', 'route_id'))
+    searches = []
+    stops = Stop.objects.values_list('pk', 'company', 'stop_id', 'name',
+                                     'stop_code')
+    for pk, company, stop_id, name, stop_code in stops.iterator():
+        values = [stop_id, name, stop_code]
+        for route in sorted(routes[pk]):
+            values.extend(labels.get(route, ()))
+        searches.append(StopSearch(stop_id=pk, company_id=company,
+                                   text=search_text(values)))
+    StopSearch.objects.bulk_create(searches, batch_size=500)
+
+
+def create_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX %s ON gtfs_stopsearch USING gin (text gin_trgm_ops)'
+        % TRIGRAM_INDEX)
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS %s' % TRIGRAM_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('people', '0002_auto_20180525_2236'),
+        ('gtfs', '0012_tripsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StopSearch',
+            fields=[
+                ('stop', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search', serialize=False, to='gtfs.Stop')),
+                ('text', models.TextField(blank=True, verbose_name='Text')),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='people.Company')),
+            ],
+        ),
+        migrations.RunPython(fill_stop_search, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
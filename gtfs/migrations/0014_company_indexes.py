@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.13 on 2018-06-19 16:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gtfs', '0013_stopsearch'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stoptime',
+            index=models.Index(fields=['trip', 'sequence'], name='gtfs_stoptime_trip_seq_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='calendardate',
+            index=models.Index(fields=['service', 'date'], name='gtfs_caldate_service_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['company', 'trip_id'], name='gtfs_trip_company_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='frequency',
+            index=models.Index(fields=['trip', 'start_time'], name='gtfs_frequency_trip_idx'),
+        ),
+    ]
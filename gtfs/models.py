@@ -4,20 +4,80 @@ from django.utils.encoding import python_2_unicode_compatible
 from django.contrib.gis.db.models import (
     Model, CharField, IntegerField, DateField, BooleanField, ForeignKey,
     LineStringField, EmailField, PointField, DecimalField, TimeField,
+    DateTimeField, F, Case, When, Value, OneToOneField, SET_NULL, TextField,
+    Index,
 )
+from django.db import IntegrityError, transaction
 from django.utils import timezone
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from itertools import groupby
+from operator import itemgetter
+
+from .shapes import shape_points
+
+
+def _flag(value):
+    return '1' if value else '0'
+
+
+def _date(value):
+    return value.strftime('%Y%m%d')
+
+
+def _resolve(obj, lookup):
+    """Follow a values_list() lookup like `trip__trip_id` on an instance"""
+    for attr in lookup.split('__'):
+        if obj is None:
+            return None
+        obj = getattr(obj, attr)
+    return obj
 
 
 class CompanyBoundModel(Model):
+    """Model of a company's feed
+
+    A row of `gtfs_table` is described once per class: `gtfs_columns` is
+    the csv header, `gtfs_lookups` are the values_list() lookups (with
+    `gtfs_annotations` for anything that is not a plain field) and
+    `gtfs_tuple()` turns those values into the row, in header order. The
+    exporter runs that on plain tuples straight from the database,
+    `gtfs_row()` on an instance.
+    """
     company = ForeignKey('people.Company')
+    # feed table whose TableVersion is bumped on every write
+    gtfs_table = None
+    gtfs_columns = ()
+    gtfs_lookups = ()
+    gtfs_annotations = {}
 
     class Meta:
         abstract = True
 
     @property
     def gtfs_header(self):
-        raise NotImplementedError("Please Implement this property")
+        if not self.gtfs_columns:
+            raise NotImplementedError("Please Implement this property")
+        return list(self.gtfs_columns)
+
+    @staticmethod
+    def gtfs_tuple(values):
+        return tuple(values)
+
+    @classmethod
+    def gtfs_values(cls, queryset, *extra):
+        """`queryset` as the tuples `gtfs_tuple()` expects, after the
+        `extra` lookups if any"""
+        if cls.gtfs_annotations:
+            queryset = queryset.annotate(**cls.gtfs_annotations)
+        return queryset.values_list(*(extra + tuple(cls.gtfs_lookups)))
+
+    def gtfs_row(self):
+        return self.gtfs_tuple(
+            [_resolve(self, lookup) for lookup in self.gtfs_lookups])
+
+    def gtfs_format(self):
+        """The row as an OrderedDict, kept for compatibility"""
+        return OrderedDict(zip(self.gtfs_columns, self.gtfs_row()))
 
 
 @python_2_unicode_compatible
@@ -34,6 +94,8 @@ class Agency(CompanyBoundModel):
     fare_url = CharField('Agency URL', max_length=240, blank=True)
     email = EmailField('Email', blank=True)
 
+    gtfs_table = 'agency.txt'
+
     class Meta:
         unique_together = ('company', 'agency_id')
         verbose_name_plural = "agencies"
@@ -41,25 +103,14 @@ class Agency(CompanyBoundModel):
     def __str__(self):
         return self.agency_id
 
-    @property
-    def gtfs_header(self):
-        return [
-            'agency_id', 'agency_name', 'agency_url', 'agency_timezone',
-            'agency_phone', 'agency_lang', 'agency_fare_url', 'agency_email'
-        ]
-
-    def gtfs_format(self):
-        data = [
-            ('agency_id', self.agency_id),
-            ('agency_name', self.name.encode('utf-8')),
-            ('agency_url', self.url),
-            ('agency_timezone', self.timezone),
-            ('agency_phone', self.phone),
-            ('agency_lang', self.lang),
-            ('agency_fare_url', self.fare_url),
-            ('agency_email', self.email),
-        ]
-        return OrderedDict(data)
+    gtfs_columns = (
+        'agency_id', 'agency_name', 'agency_url', 'agency_timezone',
+        'agency_phone', 'agency_lang', 'agency_fare_url', 'agency_email'
+    )
+    gtfs_lookups = (
+        'agency_id', 'name', 'url', 'timezone', 'phone', 'lang', 'fare_url',
+        'email'
+    )
 
 
 @python_2_unicode_compatible
@@ -98,37 +149,43 @@ class Stop(CompanyBoundModel):
     wheelchair_boarding = CharField('Wheelchair boarding', max_length=1,
                                     default='0', choices=WHEELCHAIR_CHOICES)
 
+    gtfs_table = 'stops.txt'
+
     class Meta:
         unique_together = ('company', 'stop_id')
 
     def __str__(self):
         return self.stop_id
 
-    @property
-    def gtfs_header(self):
-        return [
-            'stop_id', 'stop_name', 'stop_desc', 'stop_lat', 'stop_lon',
-            'zone_id', 'stop_url', 'location_type', 'parent_station',
-        ]
+    gtfs_columns = (
+        'stop_id', 'stop_name', 'stop_desc', 'stop_lat', 'stop_lon',
+        'zone_id', 'stop_url', 'location_type', 'parent_station',
+    )
+    gtfs_lookups = (
+        'stop_id', 'name', 'stop_desc', 'location', 'zone_id',
+        'location_type', 'parent_station__stop_id',
+    )
 
-    def gtfs_format(self):
-        _parent = self.parent_station.stop_id if self.parent_station else ''
-        data = [
-            ('stop_id', self.stop_id),
-            ('stop_name', self.name.encode('utf-8')),
-            ('stop_desc', self.stop_desc),
-            ('stop_lat', self.location.coords[1]),
-            ('stop_lon', self.location.coords[0]),
-            ('zone_id', self.zone_id),
-            ('stop_url', ''),
-            ('location_type', self.location_type),
-            ('parent_station', _parent),
-        ]
-        return OrderedDict(data)
+    @staticmethod
+    def gtfs_tuple(values):
+        (stop_id, name, desc, location, zone_id, location_type,
+         parent) = values
+        lon, lat = location.coords
+        return (stop_id, name, desc, lat, lon, zone_id, '', location_type,
+                parent or '')
 
     def merge_with(self, another_stop):
+        # update() skips signals, mark the affected routes as changed
+        routes = another_stop.stoptime_set \
+            .values_list('trip__route', flat=True).order_by().distinct()
+        for route in routes:
+            TableVersion.bump(self.company_id, StopTime.gtfs_table, route)
+        trips = list(another_stop.stoptime_set
+                     .values_list('trip', flat=True).order_by().distinct())
         # change stop_times to this stop
         another_stop.stoptime_set.all().update(stop=self)
+        TripSummary.refresh(trips)
+        StopSearch.refresh([self.pk])
         # NOTE: if Transfer introduces, then should add something here too
         another_stop.delete()
 
@@ -190,6 +247,8 @@ class Route(CompanyBoundModel):
     route_text_color = CharField('Route text color', max_length=6, blank=True)
     route_sort_order = IntegerField('Route sort order', default=0, blank=True)
 
+    gtfs_table = 'routes.txt'
+
     class Meta:
         unique_together = ('company', 'route_id')
         ordering = ('agency', 'route_id')
@@ -197,13 +256,16 @@ class Route(CompanyBoundModel):
     def __str__(self):
         return self.route_id
 
-    @property
-    def gtfs_header(self):
-        return [
-            'route_type', 'route_id', 'route_short_name', 'route_long_name',
-            'agency_id', 'route_url', 'route_color', 'route_text_color',
-            'route_sort_order'
-        ]
+    gtfs_columns = (
+        'route_type', 'route_id', 'route_short_name', 'route_long_name',
+        'agency_id', 'route_url', 'route_color', 'route_text_color',
+        'route_sort_order'
+    )
+    gtfs_lookups = (
+        'route_type', 'route_id', 'short_name', 'long_name',
+        'agency__agency_id', 'route_url', 'route_color', 'route_text_color',
+        'route_sort_order'
+    )
 
     @property
     def routes_gtfs_header(self):
@@ -212,43 +274,28 @@ class Route(CompanyBoundModel):
     @property
     def shapes_gtfs_header(self):
         return [
-            'shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'
+            'shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence',
+            'shape_dist_traveled'
         ]
 
-    def gtfs_format(self):
-        data = [
-            ('route_type', self.route_type),
-            ('route_id', self.route_id),
-            ('route_short_name', self.short_name.encode('utf-8')),
-            ('route_long_name', self.long_name.encode('utf-8')),
-            ('agency_id', self.agency.agency_id),
-            ('route_url', self.route_url),
-            ('route_color', self.route_color.upper()),
-            ('route_text_color', self.route_text_color.upper()),
-            ('route_sort_order', str(self.route_sort_order)),
-        ]
-        return OrderedDict(data)
+    @staticmethod
+    def gtfs_tuple(values):
+        (route_type, route_id, short_name, long_name, agency_id, url, color,
+         text_color, sort_order) = values
+        return (route_type, route_id, short_name, long_name, agency_id or '',
+                url, color.upper(), text_color.upper(), str(sort_order))
 
-    def export_to_shapes(self):
+    def export_to_shapes(self, tolerance=None):
         """Export to shapes
 
+        tolerance    simplify within this many metres, see gtfs.shapes
+
         Output:
         list of dict for shapes.txt
         """
-        if not self.shapes:
-            return []
-        results = []
-        seq = 1
-        for o in self.shapes.coords:
-            _ = [
-                ('shape_id', self.route_id),
-                ('shape_pt_lat', o[1]),
-                ('shape_pt_lon', o[0]),
-                ('shape_pt_sequence', seq),
-            ]
-            seq += 1
-            results.append(OrderedDict(_))
-        return results
+        header = self.shapes_gtfs_header
+        return [OrderedDict(zip(header, (self.route_id, ) + point))
+                for point in shape_points(self.shapes, tolerance)]
 
 
 @python_2_unicode_compatible
@@ -292,36 +339,30 @@ class StopTime(CompanyBoundModel):
     timepoint = CharField('Timepoint', max_length=1, default='',
                           choices=TIMEPOINT_CHOICES)
 
+    gtfs_table = 'stop_times.txt'
+
     class Meta:
         verbose_name_plural = "Stop times"
         ordering = ['sequence', ]
+        indexes = [
+            Index(fields=['trip', 'sequence'],
+                  name='gtfs_stoptime_trip_seq_idx'),
+        ]
 
     def __str__(self):
         return 'trip #%s seq#%s-%s' % (
             self.trip.id, self.sequence, self.arrival)
 
-    @property
-    def gtfs_header(self):
-        return [
-            'trip_id', 'arrival_time', 'departure_time', 'stop_id',
-            'stop_sequence', 'stop_headsign', 'pickup_type', 'drop_off_type',
-            'shape_dist_traveled', 'timepoint'
-        ]
-
-    def gtfs_format(self):
-        data = [
-            ('trip_id', self.trip.trip_id),
-            ('arrival_time', self.arrival),
-            ('departure_time', self.departure),
-            ('stop_id', self.stop.stop_id),
-            ('stop_sequence', self.sequence),
-            ('stop_headsign', self.stop_headsign),
-            ('pickup_type', self.pickup_type),
-            ('drop_off_type', self.drop_off_type),
-            ('shape_dist_traveled', self.shape_dist_traveled),
-            ('timepoint', self.timepoint),
-        ]
-        return OrderedDict(data)
+    gtfs_columns = (
+        'trip_id', 'arrival_time', 'departure_time', 'stop_id',
+        'stop_sequence', 'stop_headsign', 'pickup_type', 'drop_off_type',
+        'shape_dist_traveled', 'timepoint'
+    )
+    gtfs_lookups = (
+        'trip__trip_id', 'arrival', 'departure', 'stop__stop_id', 'sequence',
+        'stop_headsign', 'pickup_type', 'drop_off_type',
+        'shape_dist_traveled', 'timepoint'
+    )
 
 
 @python_2_unicode_compatible
@@ -339,33 +380,24 @@ class Calendar(CompanyBoundModel):
     saturday = BooleanField('Saturday', default=False)
     sunday = BooleanField('Sunday', default=False)
 
+    gtfs_table = 'calendar.txt'
+
     class Meta:
         unique_together = ('company', 'service_id')
 
     def __str__(self):
         return self.service_id
 
-    @property
-    def gtfs_header(self):
-        return [
-            'service_id', 'monday', 'tuesday', 'wednesday', 'thursday',
-            'friday', 'saturday', 'sunday', 'start_date', 'end_date'
-        ]
+    gtfs_columns = (
+        'service_id', 'monday', 'tuesday', 'wednesday', 'thursday',
+        'friday', 'saturday', 'sunday', 'start_date', 'end_date'
+    )
+    gtfs_lookups = gtfs_columns
 
-    def gtfs_format(self):
-        data = [
-            ('service_id', self.service_id),
-            ('monday', '1' if self.monday else '0'),
-            ('tuesday', '1' if self.tuesday else '0'),
-            ('wednesday', '1' if self.wednesday else '0'),
-            ('thursday', '1' if self.thursday else '0'),
-            ('friday', '1' if self.friday else '0'),
-            ('saturday', '1' if self.saturday else '0'),
-            ('sunday', '1' if self.sunday else '0'),
-            ('start_date', self.start_date.strftime('%Y%m%d')),
-            ('end_date', self.end_date.strftime('%Y%m%d')),
-        ]
-        return OrderedDict(data)
+    @staticmethod
+    def gtfs_tuple(values):
+        return (values[0], ) + tuple(_flag(i) for i in values[1:8]) + \
+            (_date(values[8]), _date(values[9]))
 
 
 @python_2_unicode_compatible
@@ -382,23 +414,24 @@ class CalendarDate(CompanyBoundModel):
                                default='2',
                                choices=EXCEPTION_TYPES)
 
+    gtfs_table = 'calendar_dates.txt'
+
     class Meta:
         verbose_name_plural = "Calendar Dates"
+        indexes = [
+            Index(fields=['service', 'date'], name='gtfs_caldate_service_idx'),
+        ]
 
     def __str__(self):
         return '%s-%s' % (self.pk, self.date)
 
-    @property
-    def gtfs_header(self):
-        return 'service_id,date,exception_type'
+    gtfs_columns = ('service_id', 'date', 'exception_type')
+    gtfs_lookups = ('service__service_id', 'date', 'exception_type')
 
-    def gtfs_format(self):
-        data = [
-            ('service_id', self.service.service_id),
-            ('date', self.date.strftime('%Y-%m-%d')),
-            ('exception_type', self.exception_type),
-        ]
-        return OrderedDict(data)
+    @staticmethod
+    def gtfs_tuple(values):
+        service_id, date, exception_type = values
+        return (service_id, _date(date), exception_type)
 
 
 @python_2_unicode_compatible
@@ -447,35 +480,68 @@ class Trip(CompanyBoundModel):
         default='',
         choices=BIKE_CHOICES)
 
+    gtfs_table = 'trips.txt'
+
     class Meta:
         ordering = ('trip_id', )
+        indexes = [
+            Index(fields=['company', 'trip_id'], name='gtfs_trip_company_idx'),
+        ]
 
     def __str__(self):
         return self.trip_id
 
+    gtfs_columns = (
+        'route_id', 'service_id', 'trip_id', 'trip_headsign',
+        'trip_short_name', 'direction_id', 'block_id', 'shape_id',
+        'wheelchair_accessible', 'bikes_allowed'
+    )
+    gtfs_lookups = (
+        'route__route_id', 'service__service_id', 'trip_id', 'trip_headsign',
+        'short_name', 'direction_id', 'block_id', 'route_has_shapes',
+        'wheelchair_accessible', 'bike_allowed'
+    )
+    # shape_id is route_id, but only when the route has shapes
+    gtfs_annotations = {
+        'route_has_shapes': Case(
+            When(route__shapes__isnull=True, then=Value(False)),
+            default=Value(True), output_field=BooleanField()),
+    }
+
     @property
-    def gtfs_header(self):
-        return [
-            'route_id', 'service_id', 'trip_id', 'trip_headsign',
-            'trip_short_name', 'direction_id', 'block_id', 'shape_id',
-            'wheelchair_accessible', 'bikes_allowed'
-        ]
+    def route_has_shapes(self):
+        return bool(self.route.shapes)
 
-    def gtfs_format(self):
-        has_shape = self.route.shapes
-        data = [
-            ('route_id', self.route.route_id),
-            ('service_id', self.service.service_id),
-            ('trip_id', self.trip_id),
-            ('trip_headsign', self.trip_headsign),
-            ('trip_short_name', self.short_name),
-            ('direction_id', self.direction_id),
-            ('block_id', self.block_id),
-            ('shape_id', self.route.route_id if has_shape else ''),
-            ('wheelchair_accessible', self.wheelchair_accessible),
-            ('bikes_allowed', self.bike_allowed),
-        ]
-        return OrderedDict(data)
+    @staticmethod
+    def gtfs_tuple(values):
+        (route_id, service_id, trip_id, headsign, short_name, direction_id,
+         block_id, has_shapes, wheelchair, bike) = values
+        return (route_id, service_id, trip_id, headsign, short_name,
+                direction_id, block_id, route_id if has_shapes else '',
+                wheelchair, bike)
+
+    def replace_stoptimes(self, rows):
+        """Replace every stop time of this trip by `rows` at once
+
+        rows    dicts of StopTime fields with `stop_id` as a Stop pk
+
+        One delete and one insert in a single transaction, signals are
+        skipped so versions and the summary are updated here.
+        """
+        stoptimes = [StopTime(company_id=self.company_id, trip=self, **row)
+                     for row in rows]
+        with transaction.atomic():
+            # nothing references stop times, no need to collect them
+            qs = StopTime.objects.filter(trip=self)
+            stops = set(qs.values_list('stop', flat=True))
+            qs._raw_delete(qs.db)
+            StopTime.objects.bulk_create(stoptimes)
+            TableVersion.bump(self.company_id, StopTime.gtfs_table)
+            TableVersion.bump(self.company_id, StopTime.gtfs_table,
+                              self.route_id)
+            TripSummary.refresh([self.pk])
+            StopSearch.refresh(stops | set(i.stop_id for i in stoptimes))
+        return self.stoptime_set.select_related('stop')
 
 
 @python_2_unicode_compatible
@@ -513,30 +579,22 @@ class FareAttribute(CompanyBoundModel):
                         related_name='fare_agency')
     transfer_duration = CharField('Transfer duration', max_length=2)
 
+    gtfs_table = 'fare_attributes.txt'
+
     class Meta:
         unique_together = ('company', 'fare_id')
 
     def __str__(self):
         return self.pk
 
-    @property
-    def gtfs_header(self):
-        return [
-            'fare_id', 'price', 'currency_type', 'payment_method', 'transfers',
-            'transfer_duration'
-        ]
-
-    def gtfs_format(self):
-        data = [
-            ('fare_id', self.fare.fare_id),
-            ('price', self.route.route_id),
-            ('currency_type', self.currency_type),
-            ('payment_method', self.payment_method),
-            ('transfers', self.transfer),
-            ('agency_id', self.agency.agency_id),
-            ('transfer_duration', self.transfer_duration),
-        ]
-        return OrderedDict(data)
+    gtfs_columns = (
+        'fare_id', 'price', 'currency_type', 'payment_method', 'transfers',
+        'transfer_duration'
+    )
+    gtfs_lookups = (
+        'fare_id', 'price', 'currency_type', 'payment_method', 'transfer',
+        'transfer_duration'
+    )
 
 
 @python_2_unicode_compatible
@@ -563,24 +621,19 @@ class FareRule(CompanyBoundModel):
     # destination_id = CharField('Destination ID', max_length=100)
     # contains_id = CharField('Contains ID', max_length=100)
 
+    gtfs_table = 'fare_rules.txt'
+
     def __str__(self):
         return self.pk
 
-    @property
-    def gtfs_header(self):
-        return [
-            'fare_id', 'route_id', 'origin_id', 'destination_id', 'contains_id'
-        ]
+    gtfs_columns = (
+        'fare_id', 'route_id', 'origin_id', 'destination_id', 'contains_id'
+    )
+    gtfs_lookups = ('fare__fare_id', 'route__route_id')
 
-    def gtfs_format(self):
-        data = [
-            ('fare_id', self.fare.fare_id),
-            ('route_id', self.route.route_id),
-            ('origin_id', ''),
-            ('destination_id', ''),
-            ('contains_id', ''),
-        ]
-        return OrderedDict(data)
+    @staticmethod
+    def gtfs_tuple(values):
+        return tuple(values) + ('', '', '')
 
 
 @python_2_unicode_compatible
@@ -611,8 +664,14 @@ class Frequency(CompanyBoundModel):
     exact_times = CharField(
         'Exact times', max_length=1, default='0', choices=EXACT_TIME_CHOICES)
 
+    gtfs_table = 'frequencies.txt'
+
     class Meta:
         verbose_name_plural = "Frequencies"
+        indexes = [
+            Index(fields=['trip', 'start_time'],
+                  name='gtfs_frequency_trip_idx'),
+        ]
 
 
     def __str__(self):
@@ -620,18 +679,213 @@ class Frequency(CompanyBoundModel):
             self.trip.trip_id, self.start_time, self.end_time,
             self.headway_secs)
 
-    @property
-    def gtfs_header(self):
-        return [
-            'trip_id', 'start_time', 'end_time', 'headway_secs', 'exact_times'
-        ]
+    gtfs_columns = (
+        'trip_id', 'start_time', 'end_time', 'headway_secs', 'exact_times'
+    )
+    gtfs_lookups = (
+        'trip__trip_id', 'start_time', 'end_time', 'headway_secs',
+        'exact_times'
+    )
 
-    def gtfs_format(self):
-        data = [
-            ('trip_id', self.trip.trip_id),
-            ('start_time', self.start_time),
-            ('end_time', self.end_time),
-            ('headway_secs', self.headway_secs),
-            ('exact_times', self.exact_times),
-        ]
-        return OrderedDict(data)
+
+@python_2_unicode_compatible
+class TableVersion(Model):
+    """Change counter of a feed table of a company
+
+    Every write through the ORM bumps the counter of the table it touches
+    (see `gtfs.signals`), anything bypassing signals like `update()` or
+    `bulk_create()` has to call `bump()` itself.
+
+    stop_times.txt and shapes.txt are exported per route, so they are
+    counted per `route` as well. It is a plain Route pk rather than a
+    ForeignKey to keep the counter of a deleted route. Other tables use
+    route 0, and table `*` stands for everything of the company.
+    """
+    ALL = '*'
+
+    company = ForeignKey('people.Company')
+    table = CharField('Table', max_length=30)
+    route = IntegerField('Route', default=0)
+    version = IntegerField('Version', default=0)
+    updated_at = DateTimeField('Updated at', default=timezone.now)
+
+    class Meta:
+        unique_together = ('company', 'table', 'route')
+
+    def __str__(self):
+        return '%s %s#%s v%s' % (
+            self.company_id, self.table, self.route, self.version)
+
+    @classmethod
+    def bump(cls, company_id, table, route=0):
+        q = {'company_id': company_id, 'table': table, 'route': route or 0}
+        changes = {'version': F('version') + 1, 'updated_at': timezone.now()}
+        if cls.objects.filter(**q).update(**changes):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(version=1, **q)
+        except IntegrityError:
+            # created by someone else in the meantime
+            cls.objects.filter(**q).update(**changes)
+
+    @classmethod
+    def versions(cls, companies):
+        """{(table, route): version} summed over `companies` (pks)"""
+        result = {}
+        qs = cls.objects.filter(company__in=companies) \
+            .values_list('table', 'route', 'version')
+        for table, route, version in qs:
+            result[(table, route)] = result.get((table, route), 0) + version
+        return result
+
+
+def _seconds(value):
+    return value.hour * 3600 + value.minute * 60 + value.second
+
+
+@python_2_unicode_compatible
+class TripSummary(Model):
+    """Stop times of a trip summed up, so lists of trips don't scan them
+
+    Kept in step by `gtfs.signals` on every StopTime write, anything
+    bypassing signals like `update()` or `bulk_create()` has to call
+    `refresh()` itself. `./manage.py gtfs_rebuild` recomputes all of them.
+
+    period        first_arrival to last_arrival in the API
+    duration      seconds from the first departure to the last arrival
+    """
+    trip = OneToOneField(Trip, primary_key=True, related_name='summary')
+    stop_count = IntegerField('Stop count', default=0)
+    first_arrival = TimeField('First arrival', null=True, blank=True)
+    first_departure = TimeField('First departure', null=True, blank=True)
+    last_arrival = TimeField('Last arrival', null=True, blank=True)
+    duration = IntegerField('Duration', null=True, blank=True)
+    first_stop = ForeignKey(Stop, null=True, blank=True, related_name='+',
+                            on_delete=SET_NULL)
+    last_stop = ForeignKey(Stop, null=True, blank=True, related_name='+',
+                           on_delete=SET_NULL)
+
+    def __str__(self):
+        return '%s: %s stops' % (self.trip_id, self.stop_count)
+
+    @classmethod
+    def summarize(cls, trip_id, rows):
+        """Unsaved summary of (sequence, arrival, departure, stop) `rows`
+        sorted by sequence"""
+        if not rows:
+            return cls(trip_id=trip_id)
+        first, last = rows[0], rows[-1]
+        duration = _seconds(last[1]) - _seconds(first[2])
+        if duration < 0:
+            # times past midnight wrap around
+            duration += 24 * 3600
+        return cls(trip_id=trip_id, stop_count=len(rows),
+                   first_arrival=first[1], first_departure=first[2],
+                   last_arrival=last[1],
+                   duration=duration, first_stop_id=first[3],
+                   last_stop_id=last[3])
+
+    @classmethod
+    def refresh(cls, trips):
+        """Recompute the summaries of `trips`, pks or a Trip queryset"""
+        trips = list(Trip.objects.filter(pk__in=trips)
+                     .values_list('pk', flat=True))
+        if not trips:
+            return 0
+        rows = StopTime.objects.filter(trip__in=trips) \
+            .order_by('trip', 'sequence') \
+            .values_list('trip', 'sequence', 'arrival', 'departure', 'stop')
+        summaries = dict(
+            (trip, cls.summarize(trip, [row[1:] for row in group]))
+            for trip, group in groupby(rows.iterator(), key=itemgetter(0)))
+        with transaction.atomic():
+            cls.objects.filter(trip__in=trips).delete()
+            cls.objects.bulk_create([
+                summaries.get(trip) or cls.summarize(trip, [])
+                for trip in trips])
+        return len(trips)
+
+    @classmethod
+    def rebuild(cls, trips=None, chunk_size=1000):
+        """`refresh()` every trip (or `trips`) `chunk_size` at a time"""
+        if trips is None:
+            trips = Trip.objects.all()
+        pks = list(trips.order_by('pk').values_list('pk', flat=True))
+        for i in range(0, len(pks), chunk_size):
+            cls.refresh(pks[i:i + chunk_size])
+        return len(pks)
+
+
+def search_text(values):
+    """`values` in lower case, one per line, without blanks or repeats"""
+    lines = []
+    for value in values:
+        value = ' '.join((value or '').lower().split())
+        if value and value not in lines:
+            lines.append(value)
+    return '\n'.join(lines)
+
+
+@python_2_unicode_compatible
+class StopSearch(Model):
+    """What a stop is searched by, so searches don't join the stop times
+
+    `text` holds the stop_id, name and stop_code of the stop and the
+    agency name, short_name and route_id of every route serving it (see
+    `search_text()`). It has a trigram index on postgresql, see
+    `gtfs.search` for the other databases.
+
+    Kept in step by `gtfs.signals` like `TripSummary`, the table version
+    `stop-search` is bumped on every change.
+    """
+    version_table = 'stop-search'
+
+    stop = OneToOneField(Stop, primary_key=True, related_name='search')
+    company = ForeignKey('people.Company')
+    text = TextField('Text', blank=True)
+
+    def __str__(self):
+        return '%s: %s' % (self.stop_id, self.text.replace('\n', ', '))
+
+    @classmethod
+    def refresh(cls, stops):
+        """Recompute the rows of `stops`, pks or a Stop queryset"""
+        rows = list(Stop.objects.filter(pk__in=stops).order_by('pk')
+                    .values_list('pk', 'company', 'stop_id', 'name',
+                                 'stop_code'))
+        if not rows:
+            return 0
+        pks = [row[0] for row in rows]
+        routes = defaultdict(set)
+        served = StopTime.objects.filter(stop__in=pks).order_by() \
+            .values_list('stop', 'trip__route').distinct()
+        for stop, route in served:
+            routes[stop].add(route)
+        labels = dict(
+            (row[0], row[1:]) for row in Route.objects.filter(
+                pk__in=set().union(*routes.values()))
+            .values_list('pk', 'agency__name', 'short_name', 'route_id'))
+        searches = []
+        for pk, company, stop_id, name, stop_code in rows:
+            values = [stop_id, name, stop_code]
+            for route in sorted(routes[pk]):
+                values.extend(labels.get(route, ()))
+            searches.append(cls(stop_id=pk, company_id=company,
+                                text=search_text(values)))
+        with transaction.atomic():
+            cls.objects.filter(stop__in=pks).delete()
+            cls.objects.bulk_create(searches)
+            for company in set(row[1] for row in rows):
+                TableVersion.bump(company, cls.version_table)
+        return len(pks)
+
+    @classmethod
+    def rebuild(cls, stops=None, chunk_size=1000):
+        """`refresh()` every stop (or `stops`) `chunk_size` at a time"""
+        if stops is None:
+            stops = Stop.objects.all()
+        pks = list(stops.order_by('pk').values_list('pk', flat=True))
+        for i in range(0, len(pks), chunk_size):
+            cls.refresh(pks[i:i + chunk_size])
+        return len(pks)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Pagination of every /v1/ list
+
+    /v1/stoptime/?limit=100&offset=400
+    /v1/stoptime/?limit=100&offset=400&count=false
+    /v1/stoptime/?cursor=&limit=1000
+
+Limit/offset stays the default. `count=false` leaves out the COUNT(*)
+of the whole list (`count` is null, `next` is set when there is more).
+`cursor` switches to keyset pagination on the `cursor_ordering` of the
+view (`pk` unless set): start with an empty cursor and follow `next`,
+every page is then an indexed range scan however deep it is, so
+reading a whole table costs linear time instead of quadratic. The
+cursor is a value of the first field of the ordering only, plus an
+offset among the rows sharing it, so that field should be unique or
+nearly so.
+
+`limit` is capped at `GTFS_MAX_PAGE_SIZE` in both styles.
+"""
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.utils import six
+from rest_framework import pagination
+from rest_framework.utils.urls import replace_query_param
+
+MAX_PAGE_SIZE = getattr(settings, 'GTFS_MAX_PAGE_SIZE', 1000)
+FALSE_VALUES = ('0', 'false', 'no', 'off')
+
+
+class CursorPagination(pagination.CursorPagination):
+    """Keyset pagination on `view.cursor_ordering`"""
+    ordering = 'pk'
+    page_size_query_param = 'limit'
+    max_page_size = MAX_PAGE_SIZE
+
+    def get_ordering(self, request, queryset, view):
+        ordering = getattr(view, 'cursor_ordering', self.ordering)
+        if isinstance(ordering, six.string_types):
+            return (ordering, )
+        return tuple(ordering)
+
+
+class HybridPagination(pagination.LimitOffsetPagination):
+    """Limit/offset, or `CursorPagination` when `cursor` is given"""
+    max_limit = MAX_PAGE_SIZE
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor = None
+        if self.cursor_query_param in request.query_params:
+            self.cursor = CursorPagination()
+            return self.cursor.paginate_queryset(queryset, request, view)
+        count = request.query_params.get(self.count_query_param, '')
+        if count.lower() not in FALSE_VALUES:
+            return super(HybridPagination, self).paginate_queryset(
+                queryset, request, view)
+
+        self.count = None
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        self.offset = self.get_offset(request)
+        self.request = request
+        # one more row tells whether there is a next page
+        rows = list(queryset[self.offset:self.offset + self.limit + 1])
+        self.has_next = len(rows) > self.limit
+        return rows[:self.limit]
+
+    def get_paginated_response(self, data):
+        if self.cursor is not None:
+            return self.cursor.get_paginated_response(data)
+        return super(HybridPagination, self).get_paginated_response(data)
+
+    def get_next_link(self):
+        if self.count is not None:
+            return super(HybridPagination, self).get_next_link()
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.offset_query_param,
+                                   self.offset + self.limit)
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+"""Journey planner over the timetable of a company
+
+    planner = day_planner(company_id, date(2018, 12, 25))
+    journeys = planner.plan(planner.network.around_stop(origin),
+                            {destination: 0}, 8 * 3600)
+
+RAPTOR (Delling, Pajor and Werneck, 2012). The trips running on the day
+are grouped into routes, trips visiting the same stops in the same order
+that never overtake each other, so the times of a route are a table with
+one sorted column per stop. Round `k` rides one more trip from every
+stop improved in round `k - 1`, then walks to the stops nearby, so after
+`k` rounds the earliest arrival with `k - 1` transfers is known at every
+stop. Every round that gets to the destination earlier than the rounds
+before is one journey, from the fastest to the one with fewest
+transfers.
+
+Everything is built from the `TimetableSnapshot`. A `Network` holds what
+does not depend on the date: trips grouped by the stops they visit,
+their times as offsets from the first departure and the walking
+transfers between stops within MAX_WALK metres, found with a `StopGrid`.
+A `Planner` holds the routes of one service date, frequency based trips
+expanded and trips of the day before still running after midnight
+included. Both are kept per process, the planners of the last
+CACHE_SIZE dates asked for.
+"""
+from __future__ import unicode_literals
+import math
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import timedelta
+from time import time as now
+
+from .frequencies import forward_offsets, frequency_trip_id, format_time
+from .services import ServiceDays
+from .snapshot import DAY, building, timetable_snapshot
+
+# metres of a walking transfer
+MAX_WALK = 500
+# metres per second
+WALK_SPEED = 1.2
+MAX_ROUNDS = 5
+CACHE_SIZE = 8
+EARTH_RADIUS = 6371000.0
+INFINITY = float('inf')
+
+
+class StopGrid(object):
+    """Points bucketed in square cells of `size` metres
+
+    Distances are on a plane around the mean latitude, which is close
+    enough over a city.
+    """
+
+    def __init__(self, lons, lats, size=MAX_WALK):
+        self.lons, self.lats, self.size = lons, lats, size
+        mean = sum(lats) / len(lats) if len(lats) else 0.0
+        # metres per degree
+        self.ky = math.pi * EARTH_RADIUS / 180
+        self.kx = self.ky * math.cos(math.radians(mean))
+        self.cells = {}
+        for i, (lon, lat) in enumerate(zip(lons, lats)):
+            self.cells.setdefault(self.cell(lon, lat), []).append(i)
+
+    def cell(self, lon, lat):
+        return (int(math.floor(lon * self.kx / self.size)),
+                int(math.floor(lat * self.ky / self.size)))
+
+    def near(self, lon, lat):
+        """[(point, metres)] of the points within `size` metres"""
+        cx, cy = self.cell(lon, lat)
+        result = []
+        for x in (cx - 1, cx, cx + 1):
+            for y in (cy - 1, cy, cy + 1):
+                for i in self.cells.get((x, y), ()):
+                    dx = (self.lons[i] - lon) * self.kx
+                    dy = (self.lats[i] - lat) * self.ky
+                    metres = math.sqrt(dx * dx + dy * dy)
+                    if metres <= self.size:
+                        result.append((i, metres))
+        return result
+
+
+def walking_seconds(metres):
+    return int(round(metres / WALK_SPEED))
+
+
+class Network(object):
+    """The trips and walking transfers of a snapshot, for every date"""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.grid = StopGrid(snapshot.stop_lon, snapshot.stop_lat)
+        self.transfers = [
+            [(j, walking_seconds(metres))
+             for j, metres in self.grid.near(lon, lat) if j != i]
+            for i, (lon, lat) in enumerate(zip(snapshot.stop_lon,
+                                               snapshot.stop_lat))]
+        # {stops: [trip]}, (arrival, departure) offsets of every trip and
+        # the times it starts at
+        self.patterns = OrderedDict()
+        self.offsets = {}
+        self.starts = {}
+        shared = {}
+        for trip in range(len(snapshot.trip_pk)):
+            start, end = snapshot.trip_start[trip], snapshot.trip_end[trip]
+            if end - start < 2:
+                continue
+            stops = tuple(snapshot.st_stop[start:end])
+            self.patterns.setdefault(stops, []).append(trip)
+            offsets = tuple(tuple(i) for i in forward_offsets(list(zip(
+                snapshot.st_arrival[start:end],
+                snapshot.st_departure[start:end]))))
+            self.offsets[trip] = shared.setdefault(offsets, offsets)
+            self.starts[trip] = snapshot.trip_starts.get(trip) or \
+                [snapshot.st_departure[start]]
+
+    def around(self, lon, lat):
+        """{stop: walking seconds} of the stops near a point"""
+        return dict((i, walking_seconds(metres))
+                    for i, metres in self.grid.near(lon, lat))
+
+    def around_stop(self, stop):
+        """{stop: walking seconds} of a stop and the stops near it"""
+        result = dict(self.transfers[stop])
+        result[stop] = 0
+        return result
+
+
+def overtakes(run, previous, offsets):
+    """Whether trip `run` gets anywhere before `previous`, both
+    (start, trip, first) and `run` starting last"""
+    if offsets[run[1]] == offsets[previous[1]]:
+        return False
+    for times, other in zip(offsets[run[1]], offsets[previous[1]]):
+        for a, b in zip(times, other):
+            if run[0] + a < previous[0] + b:
+                return True
+    return False
+
+
+def fifo_routes(runs, offsets):
+    """Split `runs` sorted by start into lists of trips that never
+    overtake the trip before them"""
+    routes = []
+    for run in runs:
+        for route in routes:
+            if not overtakes(run, route[-1], offsets):
+                route.append(run)
+                break
+        else:
+            routes.append([run])
+    return routes
+
+
+class Planner(object):
+    """RAPTOR routes of one service date"""
+
+    def __init__(self, network, day):
+        self.network = network
+        self.snapshot = network.snapshot
+        self.day = day
+        # per route, the stops, the arrival and departure columns and
+        # the (trip, frequency start) of every row
+        self.route_stops = []
+        self.route_arrivals = []
+        self.route_departures = []
+        self.route_trips = []
+        # per stop, (route, position) of the routes serving it
+        self.stop_routes = [[] for i in self.snapshot.stops()]
+        self.build_seconds = None
+
+    @classmethod
+    def build(cls, network, days, day):
+        """Planner of `day`, `days` are the ServiceDays of the company"""
+        began = now()
+        planner = cls(network, day)
+        snapshot = network.snapshot
+        yesterday = day - timedelta(days=1)
+        for stops, trips in network.patterns.items():
+            runs = []
+            for trip in trips:
+                service = snapshot.trip_service[trip]
+                last = network.offsets[trip][0][-1]
+                for running, shift in ((day, 0), (yesterday, -DAY)):
+                    if not days.runs(service, running):
+                        continue
+                    for first in network.starts[trip]:
+                        if first + shift + last >= 0:
+                            runs.append((first + shift, trip, first))
+            runs.sort()
+            for route in fifo_routes(runs, network.offsets):
+                planner.add_route(stops, route)
+        planner.build_seconds = now() - began
+        return planner
+
+    def add_route(self, stops, runs):
+        route = len(self.route_stops)
+        offsets = self.network.offsets
+        self.route_stops.append(stops)
+        self.route_trips.append([(trip, first) for start, trip, first
+                                 in runs])
+        for index, columns in ((0, self.route_arrivals),
+                               (1, self.route_departures)):
+            rows = [[start + i for i in offsets[trip][index]]
+                    for start, trip, first in runs]
+            columns.append([array(str('l'), column)
+                            for column in zip(*rows)])
+        for position, stop in enumerate(stops):
+            self.stop_routes[stop].append((route, position))
+
+    def plan(self, origins, targets, departure, rounds=MAX_ROUNDS):
+        """Journeys from `origins` to `targets`, both {stop: walking
+        seconds}, leaving at `departure` seconds from midnight
+
+        The fastest journey first, then every journey with fewer
+        transfers that arrives later, as `journey_data`.
+        """
+        best = [INFINITY] * len(self.stop_routes)
+        labels = list(best)
+        # walks start from rides, transfers within MAX_WALK are not
+        # transitive and a stop reached earlier on foot may still be the
+        # way on
+        best_ride = list(best)
+        # per round, {stop: how it was reached}
+        legs = {}
+        for stop, seconds in origins.items():
+            labels[stop] = best[stop] = departure + seconds
+            legs[stop] = ('access', seconds)
+        rounds_legs = [legs]
+        marked = set(origins)
+        journeys = []
+        arrival, target = self.arrival(labels, targets)
+        if target is not None:
+            journeys.append(self.journey_data(rounds_legs, 0, target,
+                                              arrival, targets[target]))
+
+        for k in range(1, rounds + 1):
+            queue = {}
+            for stop in marked:
+                for route, position in self.stop_routes[stop]:
+                    if position < queue.get(route, position + 1):
+                        queue[route] = position
+            current = list(labels)
+            legs = {}
+            marked = set()
+            rides = {}
+            for route, position in queue.items():
+                stops = self.route_stops[route]
+                arrivals = self.route_arrivals[route]
+                departures = self.route_departures[route]
+                trip = board = None
+                for i in range(position, len(stops)):
+                    stop = stops[i]
+                    if trip is not None:
+                        time = arrivals[i][trip]
+                        if time < best_ride[stop] and time < arrival:
+                            best_ride[stop] = time
+                            rides[stop] = ('ride', route, trip, board, i)
+                            if time < best[stop]:
+                                current[stop] = best[stop] = time
+                                legs[stop] = rides[stop]
+                                marked.add(stop)
+                    if labels[stop] == INFINITY or (
+                            trip is not None and
+                            labels[stop] > departures[i][trip]):
+                        continue
+                    j = bisect_left(departures[i], labels[stop])
+                    if j < len(departures[i]) and (trip is None or j < trip):
+                        trip, board = j, i
+
+            # one walk after a ride
+            for stop, ride in rides.items():
+                for other, seconds in self.network.transfers[stop]:
+                    time = best_ride[stop] + seconds
+                    if time < best[other] and time < arrival:
+                        current[other] = best[other] = time
+                        legs[other] = ('walk', stop, seconds, ride)
+                        marked.add(other)
+
+            rounds_legs.append(legs)
+            labels = current
+            time, target = self.arrival(labels, targets)
+            if target is not None and time < arrival:
+                arrival = time
+                journeys.append(self.journey_data(
+                    rounds_legs, k, target, arrival, targets[target]))
+            if not marked:
+                break
+        journeys.reverse()
+        return journeys
+
+    @staticmethod
+    def arrival(labels, targets):
+        """(time, stop) of the earliest arrival at `targets`"""
+        result = (INFINITY, None)
+        for stop, seconds in targets.items():
+            if labels[stop] + seconds < result[0]:
+                result = (labels[stop] + seconds, stop)
+        return result
+
+    def journey_data(self, rounds_legs, k, stop, arrival, egress):
+        snapshot = self.snapshot
+        legs = []
+        # the first ride leaves at `departure`, after `walked` seconds
+        departure, walked = None, egress
+        if egress:
+            legs.append(walk_data(snapshot.stop_pk[stop], None, egress))
+        while True:
+            while stop not in rounds_legs[k]:
+                k -= 1
+            leg = rounds_legs[k][stop]
+            if leg[0] == 'walk':
+                legs.append(walk_data(snapshot.stop_pk[leg[1]],
+                                      snapshot.stop_pk[stop], leg[2]))
+                walked += leg[2]
+                stop, leg = leg[1], leg[3]
+            if leg[0] == 'access':
+                if leg[1]:
+                    legs.append(walk_data(None, snapshot.stop_pk[stop],
+                                          leg[1]))
+                walked += leg[1]
+                break
+            route, row, board, alight = leg[1:]
+            legs.append(self.ride_data(route, row, board, alight))
+            departure, walked = self.route_departures[route][board][row], 0
+            stop = self.route_stops[route][board]
+            k -= 1
+        legs.reverse()
+        if departure is None:
+            departure = arrival
+        rides = sum(1 for leg in legs if leg['mode'] == 'transit')
+        return {
+            'departure': format_time(departure - walked),
+            'arrival': format_time(arrival),
+            'transfers': max(rides - 1, 0),
+            'legs': legs,
+        }
+
+    def ride_data(self, route, row, board, alight):
+        snapshot = self.snapshot
+        trip, first = self.route_trips[route][row]
+        trip_id = snapshot.trip_text['trip_id'][trip]
+        if trip in snapshot.trip_starts:
+            trip_id = frequency_trip_id(trip_id, first)
+        stops = self.route_stops[route]
+        departure = self.route_departures[route][board][row]
+        arrival = self.route_arrivals[route][alight][row]
+        return {
+            'mode': 'transit',
+            'trip': snapshot.trip_pk[trip],
+            'trip_id': trip_id,
+            'route': snapshot.trip_route[trip],
+            'route_id': snapshot.route_ids.get(snapshot.trip_route[trip]),
+            'from': snapshot.stop_pk[stops[board]],
+            'to': snapshot.stop_pk[stops[alight]],
+            'departure': format_time(departure),
+            'arrival': format_time(arrival),
+            'duration': arrival - departure,
+            'stops': alight - board,
+        }
+
+    def stats(self):
+        return {
+            'routes': len(self.route_stops),
+            'trips': sum(len(trips) for trips in self.route_trips),
+            'transfers': sum(len(i) for i in self.network.transfers),
+            'build_seconds': self.build_seconds,
+        }
+
+
+def walk_data(origin, destination, seconds):
+    """Walk between two stop pks, None for the point asked for"""
+    return {'mode': 'walk', 'from': origin, 'to': destination,
+            'duration': seconds}
+
+
+_networks = {}
+_planners = OrderedDict()
+# held for lookups only, builds hold a lock of their own, see building()
+_lock = threading.Lock()
+
+
+def _cached(key):
+    """Planner of `key`, now the most recently used"""
+    with _lock:
+        planner = _planners.pop(key, None)
+        if planner is not None:
+            _planners[key] = planner
+    return planner
+
+
+def company_network(snapshot):
+    """Network of a snapshot, built when missing or outdated"""
+    company_id = snapshot.company_id
+    current = _networks.get(company_id)
+    if current is None or current.snapshot is not snapshot:
+        with building(('network', company_id)):
+            current = _networks.get(company_id)
+            if current is None or current.snapshot is not snapshot:
+                current = _networks[company_id] = Network(snapshot)
+    return current
+
+
+def day_planner(company_id, day):
+    """Planner of a company for a service date, built when missing or
+    outdated"""
+    snapshot = timetable_snapshot(company_id)
+    key = (company_id, snapshot.version, day)
+    planner = _cached(key)
+    if planner is not None:
+        return planner
+    with building(('planner', company_id, day)):
+        # built by another request in the meantime
+        planner = _cached(key)
+        if planner is None:
+            planner = Planner.build(
+                company_network(snapshot), ServiceDays.of_company(company_id),
+                day)
+            with _lock:
+                _planners[key] = planner
+                while len(_planners) > CACHE_SIZE:
+                    _planners.popitem(last=False)
+    return planner
+
+
+def clear():
+    """Drop every network and planner of this process"""
+    with _lock:
+        _networks.clear()
+        _planners.clear()
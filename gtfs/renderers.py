@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from rest_framework.negotiation import BaseContentNegotiation
+from rest_framework.renderers import JSONRenderer
+
+
+class GeoJSONRenderer(JSONRenderer):
+    """JSON with the GeoJSON media type, picked by `?format=geojson` or
+    `Accept: application/geo+json`
+
+    The view decides what to render, see StopViewSet.list.
+    """
+    media_type = 'application/geo+json'
+    format = 'geojson'
+
+
+class IgnoreClientContentNegotiation(BaseContentNegotiation):
+    """Always the first renderer, for views that answer with their own
+    HttpResponse whatever the client accepts (e.g. binary tiles)"""
+
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return (renderers[0], renderers[0].media_type)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Text search of stops by their names, codes and the routes serving them
+
+    stops = search_stops(Stop.objects.all(), ['siam', '73'])
+
+Every term has to be part of the `StopSearch.text` of a stop. On
+postgresql that is a LIKE on the trigram index of migration 0013. Other
+databases (sqlite in development) have no such index, the stops are
+looked up in an in-process trigram index instead, rebuilt whenever the
+`stop-search` table version moves.
+"""
+from __future__ import unicode_literals
+import threading
+from collections import defaultdict
+
+from django.db import connections
+from django.db.models import Max, Sum
+
+from .models import StopSearch, TableVersion
+
+# more matches than this are filtered in the database instead, sqlite
+# has a limit on the number of query parameters
+MAX_MATCHES = 500
+
+
+def normalize(term):
+    return ' '.join(term.lower().split())
+
+
+def trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class StopIndex(object):
+    """Trigrams of the `StopSearch` rows, of every company"""
+    _current = None
+    _lock = threading.Lock()
+
+    def __init__(self, rows, version=None):
+        self.version = version
+        self.texts = {}
+        self.grams = defaultdict(set)
+        for pk, text in rows:
+            self.texts[pk] = text
+            for gram in trigrams(text):
+                self.grams[gram].add(pk)
+
+    @staticmethod
+    def current_version():
+        versions = TableVersion.objects \
+            .filter(table=StopSearch.version_table) \
+            .aggregate(sum=Sum('version'), updated_at=Max('updated_at'))
+        return (versions['sum'], versions['updated_at'])
+
+    @classmethod
+    def current(cls):
+        """The index of the current `StopSearch` rows, shared by threads"""
+        version = cls.current_version()
+        with cls._lock:
+            index = cls._current
+            if index is None or index.version != version:
+                rows = StopSearch.objects.values_list('stop', 'text')
+                index = cls._current = cls(rows.iterator(), version)
+        return index
+
+    def match(self, term):
+        """pks of the stops whose text contains `term`"""
+        grams = sorted((self.grams.get(gram, ()) for gram in trigrams(term)),
+                       key=len)
+        if grams:
+            candidates = set(grams[0]).intersection(*grams[1:])
+        else:
+            # shorter than a trigram
+            candidates = self.texts
+        return set(pk for pk in candidates if term in self.texts[pk])
+
+
+def search_stops(queryset, terms):
+    """Stops of `queryset` matching every one of `terms`"""
+    terms = [term for term in (normalize(term) for term in terms) if term]
+    if connections[queryset.db].vendor == 'postgresql':
+        index = None
+    else:
+        index = StopIndex.current()
+    for term in terms:
+        matches = index.match(term) if index is not None else None
+        if matches is not None and len(matches) <= MAX_MATCHES:
+            queryset = queryset.filter(pk__in=matches)
+        else:
+            # `contains` rather than `icontains`, whose UPPER() the
+            # trigram index can't serve
+            queryset = queryset.filter(search__text__contains=term)
+    return queryset
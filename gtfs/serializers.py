@@ -1,12 +1,63 @@
+from django.db.models import Q
+from django.utils import six
 from rest_framework.serializers import (
-    ModelSerializer, SerializerMethodField, CurrentUserDefault, ValidationError
+    ModelSerializer, SerializerMethodField, CurrentUserDefault,
+    ValidationError, Field, ListSerializer, IntegerField, TimeField
 )
 from drf_extra_fields.geo_fields import PointField
 
 from .models import Agency, Stop, Route, Trip, Calendar, CalendarDate, \
-    FareAttribute, FareRule, StopTime, Frequency
-import json
+    FareAttribute, FareRule, StopTime, Frequency, TripSummary
+from .shapes import simplified_coords
 
+GEOMETRY_MODES = ('none', 'simplified', 'full')
+
+
+def geometry_mode(request):
+    """`?geometry=none|simplified|full` of `request`, full by default"""
+    if request is None:
+        return 'full'
+    mode = request.query_params.get('geometry') or 'full'
+    if mode not in GEOMETRY_MODES:
+        raise ValidationError({'geometry': 'Expected one of %s.' % (
+            ', '.join(GEOMETRY_MODES))})
+    return mode
+
+
+class GeoJSONField(Field):
+    """Read only GeoJSON geometry, built from the coordinates directly
+
+    Follows `?geometry=`: nothing for none, shapes simplified to
+    gtfs.shapes.SIMPLIFIED_TOLERANCE for simplified.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super(GeoJSONField, self).__init__(**kwargs)
+
+    def get_attribute(self, instance):
+        mode = geometry_mode(self.context.get('request'))
+        if mode == 'none':
+            return None
+        geom = super(GeoJSONField, self).get_attribute(instance)
+        if not geom:
+            return None
+        if mode == 'simplified' and geom.geom_type == 'LineString':
+            return (geom.geom_type, simplified_coords(geom))
+        return (geom.geom_type, geom.coords)
+
+    def to_representation(self, value):
+        geom_type, coords = value
+        return {'type': geom_type, 'coordinates': coords}
+
+
+class LocationField(PointField):
+    """PointField left out for `?geometry=none`, like GeoJSONField"""
+
+    def get_attribute(self, instance):
+        if geometry_mode(self.context.get('request')) == 'none':
+            return None
+        return super(LocationField, self).get_attribute(instance)
 
 
 class CompanyModelSerializer(ModelSerializer):
@@ -17,7 +68,7 @@ class CompanyModelSerializer(ModelSerializer):
 
     def create(self, validated_data):
         user = self.context['request'].user
-        validated_data['company'] = user.company
+        validated_data['company_id'] = user.company_pk
         return super(CompanyModelSerializer, self).create(validated_data)
 
 
@@ -30,18 +81,13 @@ class AgencySerializer(CompanyModelSerializer):
 
 
 class StopSerializer(CompanyModelSerializer):
-    geojson = SerializerMethodField()
-    location = PointField()
+    geojson = GeoJSONField(source='location')
+    location = LocationField()
 
     class Meta:
         model = Stop
         exclude = ['company', ]
 
-    def get_geojson(self, obj):
-        if not obj.location:
-            return None
-        return json.loads(obj.location.geojson)
-
 
 class StopTimeSerializer(CompanyModelSerializer):
     stop = StopSerializer()
@@ -78,6 +124,79 @@ class StopTimeSerializer(CompanyModelSerializer):
         return saved_obj
 
 
+class StopReferenceField(Field):
+    """A stop as its pk, its stop_id or an object with either of them
+
+    Validates to ('pk', value) or ('stop_id', value), the stops are looked
+    up by the list serializer all at once.
+    """
+    default_error_messages = {
+        'invalid': 'Expected a stop pk, a stop_id or an object with one.',
+    }
+
+    def to_internal_value(self, data):
+        if isinstance(data, dict):
+            if 'id' in data:
+                data = data['id']
+            elif 'stop_id' in data:
+                data = six.text_type(data['stop_id'])
+        if isinstance(data, bool):
+            self.fail('invalid')
+        if isinstance(data, six.integer_types):
+            return ('pk', data)
+        if isinstance(data, six.string_types) and data:
+            return ('stop_id', data)
+        self.fail('invalid')
+
+    def to_representation(self, value):
+        return value.pk
+
+
+class BulkStopTimeListSerializer(ListSerializer):
+    """Ordered stop times of `context['trip']`
+
+    sequence defaults to the position in the list, departure to arrival
+    and every stop is resolved in a single query.
+    """
+
+    def validate(self, attrs):
+        trip = self.context['trip']
+        refs = [row['stop'] for row in attrs]
+        pks = [value for kind, value in refs if kind == 'pk']
+        stop_ids = [value for kind, value in refs if kind == 'stop_id']
+        found = {}
+        for pk, stop_id in Stop.objects.filter(company=trip.company_id) \
+                .filter(Q(pk__in=pks) | Q(stop_id__in=stop_ids)) \
+                .values_list('pk', 'stop_id'):
+            found[('pk', pk)] = pk
+            found[('stop_id', stop_id)] = pk
+        errors = {}
+        for i, row in enumerate(attrs):
+            ref = row.pop('stop')
+            if ref not in found:
+                errors[i] = {'stop': 'Stop %s could not be found' % ref[1]}
+                continue
+            row['stop_id'] = found[ref]
+            row.setdefault('sequence', i + 1)
+            row.setdefault('departure', row['arrival'])
+        if errors:
+            raise ValidationError(errors)
+        return attrs
+
+
+class BulkStopTimeSerializer(ModelSerializer):
+    stop = StopReferenceField()
+    departure = TimeField(required=False)
+    sequence = IntegerField(required=False)
+
+    class Meta:
+        model = StopTime
+        fields = ('stop', 'arrival', 'departure', 'sequence',
+                  'stop_headsign', 'pickup_type', 'drop_off_type',
+                  'shape_dist_traveled', 'timepoint')
+        list_serializer_class = BulkStopTimeListSerializer
+
+
 class CalendarDateSerializer(CompanyModelSerializer):
 
     class Meta:
@@ -93,7 +212,8 @@ class CalendarSerializer(CompanyModelSerializer):
         exclude = ['company', ]
 
     def get_exceptions(self, obj):
-        exceptions = CalendarDate.objects.filter(service=obj)
+        # all() to use what the viewsets prefetched
+        exceptions = obj.calendardate_set.all()
         return CalendarDateSerializer(exceptions, many=True).data
 
 
@@ -114,15 +234,24 @@ class TripSerializer(CompanyModelSerializer):
         exclude = ['company', ]
 
     def get_stoptime(self, obj):
-        st = obj.stoptime_set.all()
-        if not st:
+        try:
+            summary = obj.summary
+        except TripSummary.DoesNotExist:
+            # not built yet, see ./manage.py gtfs_rebuild
+            st = obj.stoptime_set.all()
+            summary = TripSummary.summarize(obj.pk, [
+                (s.sequence, s.arrival, s.departure, s.stop_id) for s in st])
+        if not summary.stop_count:
             return {
                 'count': 0,
                 'period': [],
             }
         return {
-            'count': st.count(),
-            'period': [st[0].arrival, st[len(st)-1].arrival],
+            'count': summary.stop_count,
+            'period': [summary.first_arrival, summary.last_arrival],
+            'duration': summary.duration,
+            'first_stop': summary.first_stop_id,
+            'last_stop': summary.last_stop_id,
         }
 
     def to_internal_value(self, data):
@@ -180,7 +309,7 @@ class FareAttributeSerializer(CompanyModelSerializer):
 
 
 class RouteSerializer(CompanyModelSerializer):
-    geojson = SerializerMethodField()
+    geojson = GeoJSONField(source='shapes')
     trip_set = TripSerializer(many=True, required=False)
     farerule_set = FareAttributeSerializer(many=True, required=False)
 
@@ -188,11 +317,6 @@ class RouteSerializer(CompanyModelSerializer):
         model = Route
         exclude = ['company', 'shapes', ]
 
-    def get_geojson(self, obj):
-        if not obj.shapes:
-            return None
-        return json.loads(obj.shapes.geojson)
-
     def validate(self, data):
         if 'agency_id' not in data or \
                 not ('agency' in data and 'id' in data['agency']):
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Days every service runs on
+
+    days = ServiceDays.of_company(company_id)
+    days.runs(service_pk, date(2018, 12, 25))
+    days.active(date(2018, 12, 25))     # pks of the services running
+    days.dates(service_pk)              # every date, in order
+
+Each `Calendar` is compiled into a bitset, a python int whose bit `i`
+says the service runs on `start + i` days, with its `CalendarDate`
+exceptions applied (added days may lie outside start_date..end_date,
+the range is widened for them). Telling whether a service runs on a day
+is then a shift and a mask.
+
+The bitsets of a company are compiled at once and kept in the django
+cache under the `TableVersion` counters of calendar.txt and
+calendar_dates.txt, any write of those moves the company to a new key.
+"""
+from __future__ import unicode_literals
+from datetime import date
+
+from django.core.cache import cache
+
+from .models import Calendar, CalendarDate, TableVersion
+
+CACHE_TIMEOUT = 24 * 3600
+WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+            'saturday', 'sunday')
+TABLES = (TableVersion.ALL, Calendar.gtfs_table, CalendarDate.gtfs_table)
+
+
+def compile_service(start_date, end_date, weekdays, exceptions):
+    """(first day ordinal, bits) of a service
+
+    weekdays      7 booleans, monday first
+    exceptions    (date, exception_type) pairs
+    """
+    added = [day for day, kind in exceptions if kind == '1']
+    start = min([start_date] + added).toordinal()
+    first, last = start_date.toordinal(), end_date.toordinal()
+    bits = 0
+    if first <= last and any(weekdays):
+        # one week of the pattern, repeated over the calendar range
+        week = 0
+        for i in range(7):
+            if weekdays[(start_date.weekday() + i) % 7]:
+                week |= 1 << i
+        days = last - first + 1
+        pattern = 0
+        for i in range(0, days, 7):
+            pattern |= week << i
+        bits = (pattern & ((1 << days) - 1)) << (first - start)
+    for day, kind in exceptions:
+        offset = day.toordinal() - start
+        if kind == '1':
+            bits |= 1 << offset
+        elif offset >= 0:
+            bits &= ~(1 << offset)
+    return start, bits
+
+
+class ServiceDays(object):
+    """Bitsets of services, {service pk: (first day ordinal, bits)}"""
+
+    def __init__(self, services):
+        self.services = services
+
+    @classmethod
+    def compile(cls, calendars):
+        """Bitsets of `calendars`, a Calendar queryset"""
+        exceptions = {}
+        rows = CalendarDate.objects.filter(service__in=calendars) \
+            .values_list('service', 'date', 'exception_type')
+        for service, day, kind in rows:
+            exceptions.setdefault(service, []).append((day, kind))
+        services = {}
+        for row in calendars.values_list('pk', 'start_date', 'end_date',
+                                         *WEEKDAYS):
+            services[row[0]] = compile_service(
+                row[1], row[2], row[3:], exceptions.get(row[0], ()))
+        return cls(services)
+
+    @classmethod
+    def of_company(cls, company_id):
+        """Cached bitsets of every service of a company"""
+        versions = TableVersion.versions([company_id])
+        key = 'gtfs:services:%s:%s' % (company_id, '-'.join(
+            str(versions.get((table, 0), 0)) for table in TABLES))
+        services = cache.get(key)
+        if services is None:
+            services = cls.compile(
+                Calendar.objects.filter(company=company_id)).services
+            cache.set(key, services, CACHE_TIMEOUT)
+        return cls(services)
+
+    def runs(self, service, day):
+        start, bits = self.services.get(service, (0, 0))
+        offset = day.toordinal() - start
+        return offset >= 0 and bool(bits >> offset & 1)
+
+    def active(self, day):
+        """pks of the services running on `day`"""
+        ordinal = day.toordinal()
+        return [service for service, (start, bits) in self.services.items()
+                if ordinal >= start and bits >> (ordinal - start) & 1]
+
+    def dates(self, service):
+        start, bits = self.services.get(service, (0, 0))
+        result, offset = [], 0
+        while bits:
+            if bits & 1:
+                result.append(date.fromordinal(start + offset))
+            bits >>= 1
+            offset += 1
+        return result
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""shapes.txt points of a route geometry
+
+    for lat, lon, seq, dist in shape_points(route.shapes, tolerance=5):
+        ...
+
+The line is simplified by GEOS first when a `tolerance` (in metres) is
+given, then `shape_dist_traveled` is accumulated over the remaining
+vertices. Distances are in km, the unit of StopTime.shape_dist_traveled.
+With numpy installed the whole coordinate array is handled at once,
+otherwise by a plain loop.
+
+Points are kept in the django cache under a hash of the geometry and the
+tolerance for CACHE_TIMEOUT, so an unchanged route is not computed again.
+Lines of more than MAX_CACHED_POINTS vertices are not cached, they would
+not fit in a memcached item.
+"""
+from __future__ import unicode_literals
+import hashlib
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# mean earth radius in km
+EARTH_RADIUS = 6371.0088
+# length of a degree of latitude, a tolerance in metres is turned into
+# degrees with it since the geometries are in EPSG:4326
+METERS_PER_DEGREE = 111320.0
+# decimals of shape_dist_traveled, that is metres
+DISTANCE_DECIMALS = 3
+# metres, for geometry drawn on a map rather than exported
+SIMPLIFIED_TOLERANCE = 10
+# keys are hashes of the geometry, nothing else reclaims those of shapes
+# that changed
+CACHE_TIMEOUT = 7 * 24 * 3600
+MAX_CACHED_POINTS = 10000
+
+
+def default_tolerance():
+    return getattr(settings, 'GTFS_SHAPE_TOLERANCE', 0) or 0
+
+
+def simplify(geom, tolerance):
+    """`geom` without the vertices within `tolerance` metres of the line"""
+    if not tolerance:
+        return geom
+    return geom.simplify(tolerance / METERS_PER_DEGREE,
+                         preserve_topology=True)
+
+
+def _cache(key, points):
+    if len(points) <= MAX_CACHED_POINTS:
+        cache.set(key, points, CACHE_TIMEOUT)
+
+
+def _coords_array(geom):
+    """(lon, lat) vertices as an array read straight from the WKB"""
+    if geom.hasz:
+        return numpy.asarray(geom.coords, dtype=float)[:, :2]
+    wkb = bytes(geom.wkb)
+    # byte order (1), geometry type (4) and number of points (4) first
+    dtype = '<f8' if wkb[:1] == b'\x01' else '>f8'
+    return numpy.frombuffer(wkb, dtype=dtype, offset=9).reshape(-1, 2)
+
+
+def _distances(lon, lat):
+    lon, lat = numpy.radians(lon), numpy.radians(lat)
+    h = numpy.sin(numpy.diff(lat) / 2) ** 2 + \
+        numpy.cos(lat[:-1]) * numpy.cos(lat[1:]) * \
+        numpy.sin(numpy.diff(lon) / 2) ** 2
+    steps = 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(h))
+    total = numpy.concatenate(([0.0], numpy.cumsum(steps)))
+    return numpy.round(total, DISTANCE_DECIMALS)
+
+
+def _points_numpy(coords):
+    lon, lat = coords[:, 0], coords[:, 1]
+    return list(zip(lat.tolist(), lon.tolist(),
+                    range(1, len(coords) + 1),
+                    _distances(lon, lat).tolist()))
+
+
+def _points_python(coords):
+    radians, sin, cos = math.radians, math.sin, math.cos
+    points, total, last = [], 0.0, None
+    for seq, (lon, lat) in enumerate(coords, 1):
+        x, y = radians(lon), radians(lat)
+        if last is not None:
+            h = sin((y - last[1]) / 2) ** 2 + \
+                cos(last[1]) * cos(y) * sin((x - last[0]) / 2) ** 2
+            total += 2 * EARTH_RADIUS * math.asin(math.sqrt(h))
+        points.append((lat, lon, seq, round(total, DISTANCE_DECIMALS)))
+        last = (x, y)
+    return points
+
+
+def compute_shape_points(geom, tolerance=0):
+    """(lat, lon, sequence, shape_dist_traveled) of every vertex"""
+    geom = simplify(geom, tolerance)
+    if not geom.num_points:
+        return []
+    if numpy is not None:
+        return _points_numpy(_coords_array(geom))
+    return _points_python(geom.coords)
+
+
+def shape_points(geom, tolerance=None):
+    """Cached `compute_shape_points`, `tolerance` defaults to the setting
+    GTFS_SHAPE_TOLERANCE"""
+    if geom is None:
+        return []
+    if tolerance is None:
+        tolerance = default_tolerance()
+    key = 'gtfs:shape:%s:%s' % (
+        hashlib.sha1(bytes(geom.wkb)).hexdigest(), tolerance)
+    points = cache.get(key)
+    if points is None:
+        points = compute_shape_points(geom, tolerance)
+        _cache(key, points)
+    return points
+
+
+def simplified_coords(geom, tolerance=None):
+    """Coordinates of `geom` simplified within `tolerance` metres, cached
+    like `shape_points`. SIMPLIFIED_TOLERANCE by default."""
+    if tolerance is None:
+        tolerance = SIMPLIFIED_TOLERANCE
+    key = 'gtfs:simplified:%s:%s' % (
+        hashlib.sha1(bytes(geom.wkb)).hexdigest(), tolerance)
+    coords = cache.get(key)
+    if coords is None:
+        coords = simplify(geom, tolerance).coords
+        _cache(key, coords)
+    return coords
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""Keep `TableVersion` counters, `TripSummary` and `StopSearch` rows in
+step with every write of the feed
+
+Receivers only note what a write touched, the versions to bump and the
+trips and stops to refresh, in a `Pending` of the current thread. It is
+applied once when the transaction commits, right away outside of one.
+Rows deleted in the meantime are skipped by the refreshes.
+
+Connected in `GtfsConfig.ready()`.
+"""
+from __future__ import unicode_literals
+import threading
+
+from django.db import connection, transaction
+from django.core.signals import request_started
+from django.db.models.signals import (
+    pre_save, post_save, pre_delete, post_delete
+)
+
+from .models import (
+    Agency, Route, FareRule, Frequency, Calendar, CalendarDate,
+    StopTime, Stop, FareAttribute, Trip, TableVersion, TripSummary,
+    StopSearch
+)
+
+TRACKED_MODELS = (
+    Agency, Route, FareRule, Frequency, Calendar, CalendarDate,
+    StopTime, Stop, FareAttribute, Trip,
+)
+
+
+class Pending(object):
+    """What the writes of a transaction changed"""
+
+    def __init__(self, savepoints=None):
+        # applied on commit rather than at the end of the write, until the
+        # callback has run
+        self.registered = savepoints is not None
+        # savepoints open when the callback was registered, rolling back
+        # any of them drops it
+        self.savepoints = savepoints
+        # (company, table, route)
+        self.versions = set()
+        # trips of changed stop times, by company
+        self.stoptime_trips = {}
+        self.trips = set()
+        self.stops = set()
+
+    def apply(self):
+        self.registered = False
+        if getattr(_local, 'pending', None) is self:
+            _local.pending = None
+        for company_id, trips in self.stoptime_trips.items():
+            routes = Trip.objects.filter(pk__in=trips) \
+                .values_list('route_id', flat=True).distinct()
+            for route in routes:
+                self.versions.add((company_id, StopTime.gtfs_table, route))
+        for company_id, table, route in sorted(self.versions):
+            TableVersion.bump(company_id, table, route)
+        if self.trips:
+            TripSummary.refresh(self.trips)
+        self.stops.discard(None)
+        if self.stops:
+            StopSearch.refresh(self.stops)
+
+
+_local = threading.local()
+
+
+def pending():
+    """`Pending` of the transaction of this thread"""
+    current = getattr(_local, 'pending', None)
+    if connection.in_atomic_block:
+        savepoints = tuple(connection.savepoint_ids)
+        # start over once the savepoint the callback was registered in is
+        # left, or the transaction is bound to roll back
+        if current is None or not current.registered or \
+                transaction.get_rollback() or \
+                savepoints[:len(current.savepoints)] != current.savepoints:
+            current = _local.pending = Pending(savepoints)
+            transaction.on_commit(current.apply)
+    elif current is None or current.registered:
+        current = _local.pending = Pending()
+    return current
+
+
+def apply_now(sender, **kwargs):
+    """Apply what a write outside of a transaction changed"""
+    current = getattr(_local, 'pending', None)
+    if current is not None and not current.registered and \
+            not connection.in_atomic_block:
+        current.apply()
+
+
+def forget(sender, **kwargs):
+    """Drop what a transaction rolled back by the previous request noted"""
+    _local.pending = None
+
+
+def _trips_of(stoptime):
+    """The trip of `stoptime`, and the one it was moved away from"""
+    trips = set([stoptime.trip_id])
+    previous = getattr(stoptime, '_previous', None)
+    if previous is not None:
+        trips.add(previous)
+    return trips
+
+
+def remember_previous(sender, instance, **kwargs):
+    """Keep the values a write may move a row out of its partition with"""
+    if not instance.pk:
+        return
+    if sender is Trip:
+        instance._previous = Trip.objects.filter(pk=instance.pk) \
+            .values_list('route_id', flat=True).first()
+    elif sender is Stop:
+        instance._previous = Stop.objects.filter(pk=instance.pk) \
+            .values_list('stop_id', flat=True).first()
+    elif sender is StopTime:
+        instance._previous, instance._previous_stop = \
+            StopTime.objects.filter(pk=instance.pk) \
+            .values_list('trip_id', 'stop_id').first() or (None, None)
+    elif sender is Route:
+        instance._previous = Route.objects.filter(pk=instance.pk) \
+            .values_list('route_id', 'short_name', 'agency_id').first()
+    elif sender is Agency:
+        instance._previous = Agency.objects.filter(pk=instance.pk) \
+            .values_list('name', flat=True).first()
+
+
+def bump_versions(sender, instance, **kwargs):
+    company_id = instance.company_id
+    versions = pending().versions
+    versions.add((company_id, sender.gtfs_table, 0))
+
+    if sender is Route:
+        versions.add((company_id, 'shapes.txt', instance.pk))
+    elif sender is StopTime:
+        pending().stoptime_trips.setdefault(company_id, set()).update(
+            _trips_of(instance))
+    elif sender is Trip:
+        # trip_id is written into every stop_times.txt row of the trip
+        routes = set([instance.route_id])
+        previous = getattr(instance, '_previous', None)
+        if previous is not None:
+            routes.add(previous)
+        for route in routes:
+            versions.add((company_id, StopTime.gtfs_table, route))
+    elif sender is Stop:
+        # so is stop_id, but a renamed stop is the only case that matters
+        previous = getattr(instance, '_previous', None)
+        if previous is not None and previous != instance.stop_id:
+            routes = StopTime.objects.filter(stop=instance) \
+                .values_list('trip__route', flat=True).order_by().distinct()
+            for route in routes:
+                versions.add((company_id, StopTime.gtfs_table, route))
+
+
+def remember_stops(sender, instance, **kwargs):
+    """The stops of a trip being deleted are searched by its route until
+    it is gone"""
+    refresh_stops(StopTime.objects.filter(trip=instance)
+                  .values_list('stop', flat=True))
+
+
+def refresh_summary(sender, instance, **kwargs):
+    pending().trips.update(_trips_of(instance))
+
+
+def refresh_stops(stops):
+    pending().stops.update(stops)
+
+
+def _stops_of(routes):
+    return StopTime.objects.filter(trip__route__in=routes) \
+        .values_list('stop', flat=True).order_by().distinct()
+
+
+def refresh_search(sender, instance, **kwargs):
+    """Refresh the `StopSearch` rows a write may have changed"""
+    previous = getattr(instance, '_previous', None)
+    if sender is Stop:
+        refresh_stops([instance.pk])
+    elif sender is StopTime:
+        refresh_stops([instance.stop_id,
+                       getattr(instance, '_previous_stop', None)])
+    elif sender is Trip:
+        if previous is not None and previous != instance.route_id:
+            refresh_stops(StopTime.objects.filter(trip=instance)
+                          .values_list('stop', flat=True))
+    elif sender is Route:
+        current = (instance.route_id, instance.short_name,
+                   instance.agency_id)
+        if previous is not None and previous != current:
+            refresh_stops(_stops_of([instance.pk]))
+    elif sender is Agency:
+        if previous is not None and previous != instance.name:
+            refresh_stops(_stops_of(instance.route_set.all()))
+
+
+def connect():
+    for model in (Trip, Stop, StopTime, Route, Agency):
+        pre_save.connect(remember_previous, sender=model)
+    for model in TRACKED_MODELS:
+        post_save.connect(bump_versions, sender=model)
+        post_delete.connect(bump_versions, sender=model)
+    pre_delete.connect(remember_stops, sender=Trip)
+    post_save.connect(refresh_summary, sender=StopTime)
+    post_delete.connect(refresh_summary, sender=StopTime)
+    for model in (Stop, StopTime, Trip, Route, Agency):
+        post_save.connect(refresh_search, sender=model)
+    post_delete.connect(refresh_search, sender=StopTime)
+    request_started.connect(forget)
+    # last, after every receiver above had its say
+    for model in TRACKED_MODELS:
+        post_save.connect(apply_now, sender=model)
+        post_delete.connect(apply_now, sender=model)
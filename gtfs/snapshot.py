@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+"""Read only, in-memory timetable of a company
+
+    snapshot = timetable_snapshot(company_id)
+    for row in snapshot.stoptimes([snapshot.trip_index[trip_pk]]):
+        data = snapshot.stoptime_data(row)
+
+Stops, trips and stop times are held as columns (`array` of ints and
+floats, lists of shared strings), a stop time is a row number into
+them. Stop times are sorted by trip and sequence, `trip_start` and
+`trip_end` give the rows of every trip. Stops and trips are referred to
+by their index in the snapshot rather than by pk.
+
+A snapshot is built on first use and kept per process until one of the
+`TableVersion` counters it was built from moves, so every request only
+asks the database for those. The list endpoints of stops, trips and
+stop times are served from it when GTFS_TIMETABLE_SNAPSHOT is on, see
+`gtfs.views.SnapshotMixin`. `./manage.py gtfs_snapshot` reports its
+size.
+
+`departures()` answers the departure board of a stop from an index of
+every departure at every stop sorted by time, frequency based trips
+expanded, built the first time it is asked for:
+
+    snapshot.departures(stop, ServiceDays.of_company(company_id),
+                        date(2018, 12, 25), after=8 * 3600, limit=10)
+"""
+from __future__ import unicode_literals
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from heapq import merge
+from itertools import islice
+from collections import OrderedDict
+from datetime import time, timedelta
+from time import time as now
+
+from django.conf import settings
+
+from .frequencies import departures, forward_offsets
+from .models import (
+    Stop, Route, Trip, StopTime, Calendar, CalendarDate, Frequency,
+    TableVersion
+)
+
+DAY = 24 * 3600
+# tables the snapshot is built from
+TABLES = (TableVersion.ALL, Stop.gtfs_table, Route.gtfs_table,
+          Trip.gtfs_table, StopTime.gtfs_table, Calendar.gtfs_table,
+          CalendarDate.gtfs_table, Frequency.gtfs_table)
+
+
+def enabled():
+    return getattr(settings, 'GTFS_TIMETABLE_SNAPSHOT', False)
+
+
+def _seconds(value):
+    return value.hour * 3600 + value.minute * 60 + value.second
+
+
+def _as_time(value):
+    return time(value // 3600 % 24, value // 60 % 60, value % 60)
+
+
+def _isoformat(value):
+    return '%02d:%02d:%02d' % (value // 3600, value // 60 % 60, value % 60)
+
+
+def snapshot_version(company_id):
+    versions = TableVersion.versions([company_id])
+    return tuple(sum(v for (t, r), v in versions.items() if t == table)
+                 for table in TABLES)
+
+
+class TimetableSnapshot(object):
+    """Columns of the stops, trips and stop times of a company"""
+
+    STOP_COLUMNS = ('stop_id', 'name', 'stop_code', 'stop_desc', 'zone_id',
+                    'location_type', 'stop_timezone', 'wheelchair_boarding')
+    TRIP_COLUMNS = ('trip_id', 'trip_headsign', 'short_name', 'direction_id',
+                    'block_id', 'wheelchair_accessible', 'bike_allowed')
+    STOPTIME_COLUMNS = ('stop_headsign', 'pickup_type', 'drop_off_type',
+                        'shape_dist_traveled', 'timepoint')
+
+    def __init__(self, company_id, version=None):
+        self.company_id = company_id
+        self.version = version
+        self.built_at = None
+        self.build_seconds = None
+        self._strings = {}
+        self._by_sequence = None
+        self._departures = None
+
+    def _text(self, value):
+        """One shared object per distinct string"""
+        return self._strings.setdefault(value, value)
+
+    @classmethod
+    def build(cls, company_id, version=None):
+        start = now()
+        snapshot = cls(company_id, version)
+        snapshot.load_stops()
+        snapshot.load_trips()
+        snapshot.load_stoptimes()
+        snapshot._strings = None
+        snapshot.built_at = now()
+        snapshot.build_seconds = snapshot.built_at - start
+        return snapshot
+
+    def load_stops(self):
+        self.stop_pk = array(str('l'))
+        self.stop_lon = array(str('d'))
+        self.stop_lat = array(str('d'))
+        self.stop_parent = array(str('l'))
+        self.stop_text = dict((name, []) for name in self.STOP_COLUMNS)
+        qs = Stop.objects.filter(company=self.company_id).order_by('pk') \
+            .values_list('pk', 'location', 'parent_station',
+                         *self.STOP_COLUMNS)
+        for row in qs.iterator():
+            self.stop_pk.append(row[0])
+            self.stop_lon.append(row[1].x)
+            self.stop_lat.append(row[1].y)
+            self.stop_parent.append(row[2] or 0)
+            for name, value in zip(self.STOP_COLUMNS, row[3:]):
+                self.stop_text[name].append(self._text(value))
+        self.stop_index = dict((pk, i) for i, pk in enumerate(self.stop_pk))
+
+    def load_trips(self):
+        self.trip_pk = array(str('l'))
+        self.trip_route = array(str('l'))
+        self.trip_service = array(str('l'))
+        self.trip_text = dict((name, []) for name in self.TRIP_COLUMNS)
+        qs = Trip.objects.filter(company=self.company_id) \
+            .values_list('pk', 'route', 'service', *self.TRIP_COLUMNS)
+        for row in qs.iterator():
+            self.trip_pk.append(row[0])
+            self.trip_route.append(row[1])
+            self.trip_service.append(row[2])
+            for name, value in zip(self.TRIP_COLUMNS, row[3:]):
+                self.trip_text[name].append(self._text(value))
+        self.trip_index = dict((pk, i) for i, pk in enumerate(self.trip_pk))
+        self.trips_by_id = {}
+        for i, trip_id in enumerate(self.trip_text['trip_id']):
+            self.trips_by_id.setdefault(trip_id, []).append(i)
+        self.route_ids = dict(
+            Route.objects.filter(company=self.company_id)
+            .values_list('pk', 'route_id'))
+
+        # nested in every trip, small enough to keep serialized
+        from .serializers import CalendarSerializer, FrequencySerializer
+        calendars = Calendar.objects.filter(company=self.company_id) \
+            .prefetch_related('calendardate_set')
+        self.services = dict((calendar.pk, CalendarSerializer(calendar).data)
+                             for calendar in calendars)
+        self.frequencies = {}
+        periods = {}
+        frequencies = Frequency.objects.filter(company=self.company_id) \
+            .order_by('trip', 'start_time')
+        for frequency in frequencies:
+            self.frequencies.setdefault(frequency.trip_id, []).append(
+                FrequencySerializer(frequency).data)
+            periods.setdefault(frequency.trip_id, []).append(
+                (frequency.start_time, frequency.end_time,
+                 frequency.headway_secs))
+        # start times in seconds of the trips run by frequencies
+        self.trip_starts = dict(
+            (self.trip_index[pk], departures(values))
+            for pk, values in periods.items() if pk in self.trip_index)
+
+    def load_stoptimes(self):
+        self.st_pk = array(str('l'))
+        self.st_trip = array(str('l'))
+        self.st_stop = array(str('l'))
+        self.st_sequence = array(str('l'))
+        self.st_arrival = array(str('l'))
+        self.st_departure = array(str('l'))
+        self.st_text = dict((name, []) for name in self.STOPTIME_COLUMNS)
+        self.trip_start = array(str('l'), [0] * len(self.trip_pk))
+        self.trip_end = array(str('l'), [0] * len(self.trip_pk))
+        qs = StopTime.objects.filter(company=self.company_id) \
+            .order_by('trip', 'sequence', 'pk') \
+            .values_list('pk', 'trip', 'stop', 'sequence', 'arrival',
+                         'departure', *self.STOPTIME_COLUMNS)
+        previous = None
+        for row in qs.iterator():
+            trip = self.trip_index.get(row[1])
+            stop = self.stop_index.get(row[2])
+            if trip is None or stop is None:
+                # of another company
+                continue
+            if trip != previous:
+                self.trip_start[trip] = len(self.st_pk)
+                previous = trip
+            self.st_pk.append(row[0])
+            self.st_trip.append(trip)
+            self.st_stop.append(stop)
+            self.st_sequence.append(row[3])
+            self.st_arrival.append(_seconds(row[4]))
+            self.st_departure.append(_seconds(row[5]))
+            for name, value in zip(self.STOPTIME_COLUMNS, row[6:]):
+                self.st_text[name].append(self._text(value))
+            self.trip_end[trip] = len(self.st_pk)
+
+    def memory(self):
+        """Approximate bytes held, per table"""
+        def size(columns):
+            total, seen = 0, set()
+            for column in columns:
+                if isinstance(column, array):
+                    total += column.buffer_info()[1] * column.itemsize
+                    continue
+                total += sys.getsizeof(column)
+                for value in column:
+                    if id(value) not in seen:
+                        seen.add(id(value))
+                        total += sys.getsizeof(value)
+            return total
+
+        result = OrderedDict([
+            ('stops', size([self.stop_pk, self.stop_lon, self.stop_lat,
+                            self.stop_parent] +
+                           list(self.stop_text.values()))),
+            ('trips', size([self.trip_pk, self.trip_route,
+                            self.trip_service] +
+                           list(self.trip_text.values()))),
+            ('stop_times', size([self.st_pk, self.st_trip, self.st_stop,
+                                 self.st_sequence, self.st_arrival,
+                                 self.st_departure, self.trip_start,
+                                 self.trip_end] +
+                                list(self.st_text.values()))),
+        ])
+        if self._departures is not None:
+            result['departures'] = size(self._departures)
+        result['total'] = sum(result.values())
+        return result
+
+    def departure_index(self):
+        """Departures at every stop, sorted by time
+
+        (dep_first, dep_time, dep_row, dep_start) columns, the
+        departures of stop `i` are `dep_first[i]:dep_first[i + 1]`.
+        `dep_row` is the stop time, `dep_start` the start time of the
+        trip run by frequencies or -1, `dep_time` is in seconds from the
+        start of the service day and may go past 24:00:00.
+        """
+        if self._departures is not None:
+            return self._departures
+        at_stop = [[] for i in range(len(self.stop_pk))]
+        for trip in range(len(self.trip_pk)):
+            start, end = self.trip_start[trip], self.trip_end[trip]
+            # nobody boards at the last stop
+            rows = range(start, end - 1)
+            if not rows:
+                continue
+            # times are stored within a day, a trip running past
+            # midnight goes on from its first departure
+            offsets = forward_offsets(
+                [(self.st_arrival[row], self.st_departure[row])
+                 for row in range(start, end)])[1]
+            starts = self.trip_starts.get(trip)
+            if starts is None:
+                first = self.st_departure[start]
+                for row, offset in zip(rows, offsets):
+                    at_stop[self.st_stop[row]].append(
+                        (first + offset, row, -1))
+                continue
+            for row, offset in zip(rows, offsets):
+                at_stop[self.st_stop[row]].extend(
+                    (first + offset, row, first) for first in starts)
+        dep_first = array(str('l'), [0])
+        dep_time, dep_row = array(str('l')), array(str('l'))
+        dep_start = array(str('l'))
+        for entries in at_stop:
+            entries.sort()
+            for value, row, first in entries:
+                dep_time.append(value)
+                dep_row.append(row)
+                dep_start.append(first)
+            dep_first.append(len(dep_time))
+        self._departures = dep_first, dep_time, dep_row, dep_start
+        return self._departures
+
+    def departures(self, stop, days, day, after=0, limit=10):
+        """Next `limit` departures at `stop` (index) on `day` from `after`
+        seconds, `days` are the ServiceDays of the company
+
+        A list of (stop time row, departure in seconds from midnight of
+        `day`, frequency start time or -1) in time order. Trips of the
+        day before still running after midnight are in.
+        """
+        dep_first, dep_time, dep_row, dep_start = self.departure_index()
+        lo, hi = dep_first[stop], dep_first[stop + 1]
+        runs = {}
+
+        def running(trip, day):
+            service = self.trip_service[trip]
+            key = (service, day)
+            if key not in runs:
+                runs[key] = days.runs(service, day)
+            return runs[key]
+
+        def scan(day, shift):
+            """Departures of the services of `day`, `shift` seconds from
+            the midnight asked for"""
+            i = bisect_left(dep_time, after - shift, lo, hi)
+            for i in range(i, hi):
+                row = dep_row[i]
+                if self.st_text['pickup_type'][row] == '1':
+                    continue
+                if running(self.st_trip[row], day):
+                    yield dep_time[i] + shift, row, dep_start[i]
+
+        # the previous service day goes on past its 24:00:00
+        return list(islice(merge(scan(day - timedelta(days=1), -DAY),
+                                 scan(day, 0)), limit))
+
+    # selections, lists of row numbers in the order of the database
+
+    def stops(self):
+        return range(len(self.stop_pk))
+
+    def trips(self, routes=None, services=None):
+        """Trips ordered by trip_id, of `routes` and `services` (pks)"""
+        rows = range(len(self.trip_pk))
+        if routes is not None:
+            routes = set(routes)
+            rows = [i for i in rows if self.trip_route[i] in routes]
+        if services is not None:
+            services = set(services)
+            rows = [i for i in rows if self.trip_service[i] in services]
+        return rows
+
+    def stoptimes(self, trips=None):
+        """Stop times of `trips` (rows) ordered by sequence, or of every
+        trip"""
+        if trips is None:
+            if self._by_sequence is None:
+                self._by_sequence = array(str('l'), sorted(
+                    range(len(self.st_pk)),
+                    key=lambda i: (self.st_sequence[i], self.st_pk[i])))
+            return self._by_sequence
+        rows = []
+        for trip in trips:
+            rows.extend(range(self.trip_start[trip], self.trip_end[trip]))
+        if len(trips) > 1:
+            rows.sort(key=lambda i: (self.st_sequence[i], self.st_pk[i]))
+        return rows
+
+    # rows as their serializer gives them
+
+    def stop_data(self, i, geometry='full'):
+        lon, lat = self.stop_lon[i], self.stop_lat[i]
+        data = OrderedDict([
+            ('id', self.stop_pk[i]),
+            ('geojson', None if geometry == 'none' else
+             {'type': 'Point', 'coordinates': (lon, lat)}),
+            ('location', {'latitude': lat, 'longitude': lon}),
+        ])
+        for name in self.STOP_COLUMNS:
+            data[name] = self.stop_text[name][i]
+        data['parent_station'] = self.stop_parent[i] or None
+        return data
+
+    def stoptime_data(self, row, geometry='full'):
+        data = OrderedDict([
+            ('id', self.st_pk[row]),
+            ('stop', self.stop_data(self.st_stop[row], geometry)),
+            ('arrival', _isoformat(self.st_arrival[row])),
+            ('departure', _isoformat(self.st_departure[row])),
+            ('sequence', self.st_sequence[row]),
+        ])
+        for name in self.STOPTIME_COLUMNS:
+            data[name] = self.st_text[name][row]
+        data['trip'] = self.trip_pk[self.st_trip[row]]
+        return data
+
+    def trip_summary(self, i):
+        """Like TripSerializer.get_stoptime"""
+        start, end = self.trip_start[i], self.trip_end[i]
+        if start == end:
+            return {'count': 0, 'period': []}
+        first_departure = self.st_departure[start]
+        last_arrival = self.st_arrival[end - 1]
+        duration = last_arrival - first_departure
+        if duration < 0:
+            duration += DAY
+        return {
+            'count': end - start,
+            'period': [_as_time(self.st_arrival[start]),
+                       _as_time(last_arrival)],
+            'duration': duration,
+            'first_stop': self.stop_pk[self.st_stop[start]],
+            'last_stop': self.stop_pk[self.st_stop[end - 1]],
+        }
+
+    def trip_data(self, i):
+        pk = self.trip_pk[i]
+        data = OrderedDict([
+            ('id', pk),
+            ('service', self.services.get(self.trip_service[i])),
+            ('frequency_set', self.frequencies.get(pk, [])),
+            ('stoptime', self.trip_summary(i)),
+        ])
+        for name in self.TRIP_COLUMNS:
+            data[name] = self.trip_text[name][i]
+        data['route'] = self.trip_route[i]
+        return data
+
+
+_snapshots = {}
+# held for lookups only, never while building
+_lock = threading.Lock()
+_building = {}
+
+
+@contextmanager
+def building(key):
+    """Lock of whatever `key` names while it is built, so a build holds
+    up the requests waiting for the same thing and nothing else"""
+    with _lock:
+        lock = _building.setdefault(key, threading.Lock())
+    try:
+        with lock:
+            yield
+    finally:
+        with _lock:
+            if _building.get(key) is lock:
+                del _building[key]
+
+
+def timetable_snapshot(company_id):
+    """Current snapshot of a company, built when missing or outdated"""
+    version = snapshot_version(company_id)
+    snapshot = _snapshots.get(company_id)
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+    with building(('snapshot', company_id)):
+        # built by another request in the meantime
+        snapshot = _snapshots.get(company_id)
+        if snapshot is None or snapshot.version != version:
+            snapshot = _snapshots[company_id] = TimetableSnapshot.build(
+                company_id, version)
+    return snapshot
+
+
+def clear():
+    """Drop every snapshot of this process"""
+    with _lock:
+        _snapshots.clear()
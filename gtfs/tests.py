@@ -1,6 +1,938 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import io
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from unittest import skipIf
+from datetime import date, time
 
-from django.test import TestCase
+from django.contrib.gis.geos import Point
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.exceptions import ValidationError
 
-# Create your tests here.
+from people.authentication import (
+    JSONWebTokenAuthentication, jwt_payload_handler
+)
+from people.models import Company, User
+from . import planner, snapshot
+from .admin import pk_nakhon_agency_action
+from .filters import parse_floats
+from .frequencies import (
+    departures, forward_offsets, format_time, frequency_trip_id
+)
+from .importer import FeedImporter, FeedError
+from .pagination import HybridPagination, CursorPagination
+from .models import (
+    Agency, Stop, Route, Trip, Calendar, CalendarDate, StopTime, Frequency,
+    TripSummary, StopSearch, TableVersion
+)
+from .search import StopIndex, search_stops
+from .serializers import TripSerializer
+from .services import ServiceDays, compile_service
+from .tiles import Tiles, tile_bounds, valid_tile, ORIGIN_SHIFT
+
+
+def commit():
+    """Run the on_commit callbacks TestCase holds back, that is what
+    gtfs.signals left for the end of the transaction"""
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for sids, func in callbacks:
+        func()
+
+
+class FeedTestCase(TestCase):
+    """A company `test` with an agency and three stops, `add_routes()`
+    adds the rest"""
+
+    def setUp(self):
+        self.company = Company.objects.create(name='Test', slug='test',
+                                              url='')
+        self.agency = Agency.objects.create(
+            company=self.company, agency_id='A', name='Agency')
+        self.stops = [
+            Stop.objects.create(company=self.company, stop_id='S%d' % i,
+                                name='Stop %d' % i,
+                                location=Point(100.5, 13.7 + i * 0.01))
+            for i in range(3)]
+        commit()
+        cache.clear()
+        # pks come back after a rollback, so do versions
+        snapshot.clear()
+        planner.clear()
+        StopIndex._current = None
+
+    def add_routes(self, routes, trips):
+        for r in range(routes):
+            route = Route.objects.create(
+                company=self.company, agency=self.agency,
+                route_id='R%d-%d' % (routes, r), short_name='%d' % r,
+                long_name='Route %d' % r, route_type='3')
+            service = Calendar.objects.create(
+                company=self.company, service_id='S%d-%d' % (routes, r),
+                start_date=date(2018, 1, 1), end_date=date(2018, 12, 31))
+            CalendarDate.objects.create(
+                company=self.company, service=service,
+                date=date(2018, 1, 1), exception_type='2')
+            for t in range(trips):
+                trip = Trip.objects.create(
+                    company=self.company, route=route, service=service,
+                    trip_id='%s-T%d' % (route.route_id, t))
+                Frequency.objects.create(
+                    company=self.company, trip=trip, start_time=time(6),
+                    end_time=time(9), headway_secs=600)
+                for seq, stop in enumerate(self.stops, 1):
+                    StopTime.objects.create(
+                        company=self.company, trip=trip, stop=stop,
+                        arrival=time(6, seq), departure=time(6, seq),
+                        sequence=seq)
+        commit()
+
+    def add_night_trip(self):
+        """Trip X every half hour from 23:30 to 00:30, 20 minutes long"""
+        self.add_routes(1, 1)
+        trip = Trip.objects.create(
+            company=self.company, route=Route.objects.get(),
+            service=Calendar.objects.get(), trip_id='X')
+        Frequency.objects.create(
+            company=self.company, trip=trip, start_time=time(23, 30),
+            end_time=time(0, 30), headway_secs=1800)
+        for seq, (arrival, departure) in enumerate([
+                (time(23, 50), time(23, 50)), (time(0, 5), time(0, 5)),
+                (time(0, 10), time(0, 12))]):
+            StopTime.objects.create(
+                company=self.company, trip=trip, stop=self.stops[seq],
+                arrival=arrival, departure=departure, sequence=seq + 1)
+        CalendarDate.objects.create(
+            company=self.company, service=Calendar.objects.get(),
+            date=date(2018, 3, 1), exception_type='1')
+        commit()
+        return trip
+
+    def login(self, company=None):
+        """Log in a new user of `company` (self.company)"""
+        company = company or self.company
+        user = User.objects.create_user('%s-user' % company.slug)
+        company.users.add(user)
+        self.client.force_login(user)
+        return user
+
+
+class ListQueryCountTest(FeedTestCase):
+    """A page of routes or trips takes the same number of queries whatever
+    there is on it"""
+
+    def count_queries(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.data
+
+    def test_route_list(self):
+        self.add_routes(1, 1)
+        few, data = self.count_queries('/v1/route/')
+        self.add_routes(5, 4)
+        many, data = self.count_queries('/v1/route/')
+        self.assertEqual(data['count'], 6)
+        self.assertEqual(few, many)
+
+    def test_trip_list(self):
+        self.add_routes(1, 1)
+        few, data = self.count_queries('/v1/trip/')
+        self.add_routes(3, 5)
+        many, data = self.count_queries('/v1/trip/')
+        self.assertEqual(data['count'], 16)
+        self.assertEqual(few, many)
+
+    def test_trip_stoptime_summary(self):
+        self.add_routes(1, 1)
+        few, data = self.count_queries('/v1/trip/')
+        trip = data['results'][0]
+        self.assertEqual(trip['stoptime']['count'], 3)
+        self.assertEqual(trip['stoptime']['period'], [time(6, 1), time(6, 3)])
+        self.assertEqual(len(trip['service']['exceptions']), 1)
+        self.assertEqual(len(trip['frequency_set']), 1)
+
+    def test_snapshot_lists(self):
+        self.add_routes(2, 2)
+        trip = Trip.objects.order_by('pk').first()
+        for url in ('/v1/stop/?company=test', '/v1/trip/?company=test',
+                    '/v1/stoptime/?company=test&trip=%d' % trip.pk):
+            expected = self.client.get(url).json()
+            with override_settings(GTFS_TIMETABLE_SNAPSHOT=True):
+                self.assertEqual(self.client.get(url).json(), expected)
+
+    def test_snapshot_build(self):
+        self.add_routes(1, 1)
+        # another company being built holds up nothing else
+        with snapshot.building(('snapshot', 0)):
+            built = snapshot.timetable_snapshot(self.company.pk)
+        self.assertIs(snapshot.timetable_snapshot(self.company.pk), built)
+        self.assertEqual(snapshot._building, {})
+        Stop.objects.create(company=self.company, stop_id='S3', name='New',
+                            location=Point(100.5, 13.8))
+        commit()
+        self.assertIsNot(snapshot.timetable_snapshot(self.company.pk), built)
+
+    def test_stop_departures(self):
+        self.add_routes(2, 1)
+        for service in Calendar.objects.all():
+            CalendarDate.objects.create(
+                company=self.company, service=service,
+                date=date(2018, 3, 1), exception_type='1')
+        commit()
+        self.check_departures()
+        with override_settings(GTFS_TIMETABLE_SNAPSHOT=True):
+            self.check_departures()
+
+    def check_departures(self):
+        url = '/v1/stop/%d/departures?date=2018-03-%02d&after=07:30&limit=5'
+        response = self.client.get(url % (self.stops[0].pk, 1))
+        self.assertEqual(
+            [row['departure'] for row in response.data['departures']],
+            ['07:30:00', '07:30:00', '07:40:00', '07:40:00', '07:50:00'])
+        self.assertEqual(
+            response.data['departures'][0]['trip_id'][-7:], '-073000')
+        response = self.client.get(url % (self.stops[0].pk, 2))
+        self.assertEqual(response.data['departures'], [])
+        # nobody boards at the last stop
+        response = self.client.get(url % (self.stops[2].pk, 1))
+        self.assertEqual(response.data['departures'], [])
+
+    def test_plan(self):
+        self.add_routes(1, 1)
+        CalendarDate.objects.create(
+            company=self.company, service=Calendar.objects.get(),
+            date=date(2018, 3, 1), exception_type='1')
+        commit()
+        response = self.client.get(
+            '/v1/plan?from=%d&to=%d&date=2018-03-01&time=07:55' % (
+                self.stops[0].pk, self.stops[2].pk))
+        self.assertEqual(response.status_code, 200)
+        journey = response.data['journeys'][0]
+        self.assertEqual((journey['departure'], journey['arrival']),
+                         ('08:00:00', '08:02:00'))
+        self.assertEqual([leg['mode'] for leg in journey['legs']],
+                         ['transit'])
+
+    def test_planner_build(self):
+        self.add_routes(1, 1)
+        company = self.company.pk
+        # another day being built holds up nothing else
+        with snapshot.building(('planner', company, date(2018, 3, 2))):
+            built = planner.day_planner(company, date(2018, 3, 1))
+        self.assertIs(planner.day_planner(company, date(2018, 3, 1)), built)
+        other = planner.day_planner(company, date(2018, 3, 2))
+        self.assertIsNot(other, built)
+        self.assertIs(other.network, built.network)
+        self.assertEqual(snapshot._building, {})
+
+
+FEED = {
+    'agency.txt': 'agency_id,agency_name,agency_url,agency_timezone\n'
+                  'A,Agency,http://example.com,Asia/Bangkok\n',
+    'stops.txt': 'stop_id,stop_name,stop_lat,stop_lon\n'
+                 'S1,One,13.7,100.5\nS2,Two,13.71,100.5\n',
+    'routes.txt': 'route_id,route_short_name,route_long_name,route_type\n'
+                  'R1,1,One,3\n',
+    'calendar.txt': 'service_id,monday,tuesday,wednesday,thursday,friday,'
+                    'saturday,sunday,start_date,end_date\n'
+                    'WD,1,1,1,1,1,0,0,20180101,20181231\n',
+    'trips.txt': 'route_id,service_id,trip_id\nR1,WD,T1\n',
+    'stop_times.txt': 'trip_id,arrival_time,departure_time,stop_id,'
+                      'stop_sequence\n'
+                      'T1,23:50:00,23:50:00,S1,1\n'
+                      'T1,23:58:00,23:58:00,S2,2\n',
+}
+
+
+def feed_zip(**tables):
+    """GTFS zip of FEED with `tables` replaced, as a file"""
+    f = io.BytesIO()
+    with zipfile.ZipFile(f, 'w') as z:
+        for name, text in dict(FEED, **tables).items():
+            z.writestr(name, text.encode('utf-8'))
+    f.seek(0)
+    return f
+
+
+class FeedImporterTest(TestCase):
+
+    def setUp(self):
+        self.company = Company.objects.create(name='Test', slug='test',
+                                              url='')
+
+    def test_import(self):
+        FeedImporter(self.company, feed_zip(), use_copy=False).run()
+        self.assertEqual(
+            list(StopTime.objects.order_by('sequence')
+                 .values_list('arrival', flat=True)),
+            [time(23, 50), time(23, 58)])
+
+    def test_time_past_midnight(self):
+        feed = feed_zip(**{'stop_times.txt': FEED['stop_times.txt'].replace(
+            '23:58:00,23:58:00', '25:10:00,25:10:00')})
+        FeedImporter(self.company, feed, use_copy=False).run()
+        # the next day, after the time of the stop before
+        self.assertEqual(
+            list(StopTime.objects.order_by('sequence')
+                 .values_list('arrival', flat=True)),
+            [time(23, 50), time(1, 10)])
+
+    def test_bad_rows(self):
+        for table, find, replace, error in (
+                ('stop_times.txt', '23:58:00,23:58:00', '23:5x:00,',
+                 'stop_times.txt line 3: arrival_time "23:5x:00"'),
+                ('stop_times.txt', ',S2,', ',S3,',
+                 'stop_times.txt line 3: unknown stop_id "S3"'),
+                ('trips.txt', 'R1,WD', 'R1,WE',
+                 'trips.txt line 2: unknown service_id "WE"')):
+            feed = feed_zip(**{table: FEED[table].replace(find, replace)})
+            with self.assertRaisesRegexp(FeedError, error):
+                FeedImporter(self.company, feed, use_copy=False).run()
+            self.assertFalse(StopTime.objects.exists())
+
+    def test_value_too_long(self):
+        feed = feed_zip(**{
+            'fare_attributes.txt': 'fare_id,price,currency_type,'
+                                   'payment_method,transfers,'
+                                   'transfer_duration\n'
+                                   'F1,15.00,THB,0,,7200\n'})
+        with self.assertRaisesRegexp(
+                FeedError, 'fare_attributes.txt line 2: transfer_duration'):
+            FeedImporter(self.company, feed, use_copy=False).run()
+
+    def test_replace(self):
+        FeedImporter(self.company, feed_zip(), use_copy=False).run()
+        with CaptureQueriesContext(connection) as queries:
+            FeedImporter(self.company, feed_zip(), use_copy=False) \
+                .delete_existing()
+        # one DELETE per table whatever the number of rows
+        self.assertEqual(len(queries), 13)
+        FeedImporter(self.company, feed_zip(), use_copy=False).run(
+            replace=True)
+        self.assertEqual(StopTime.objects.count(), 2)
+        self.assertEqual(Trip.objects.get().summary.stop_count, 2)
+
+
+class SignalsTest(FeedTestCase):
+
+    def add_trip(self):
+        self.add_routes(1, 0)
+        return Trip.objects.create(
+            company=self.company, route=Route.objects.get(),
+            service=Calendar.objects.get(), trip_id='T')
+
+    def test_refresh_on_commit(self):
+        trip = self.add_trip()
+        commit()
+        for seq, stop in enumerate(self.stops, 1):
+            StopTime.objects.create(
+                company=self.company, trip=trip, stop=stop, sequence=seq,
+                arrival=time(7, seq), departure=time(7, seq, 30))
+        # left for the end of the transaction
+        self.assertEqual(TripSummary.objects.get(trip=trip).stop_count, 0)
+        with CaptureQueriesContext(connection) as queries:
+            commit()
+        self.assertEqual(TripSummary.objects.get(trip=trip).stop_count, 3)
+        self.assertLess(len(queries), 20)
+        summary = TripSerializer(Trip.objects.get(pk=trip.pk)).data
+        self.assertEqual(summary['stoptime']['period'],
+                         [time(7, 1), time(7, 3)])
+        self.assertIn('r1-0', StopSearch.objects.get(stop=self.stops[0]).text)
+
+    def test_rolled_back(self):
+        trip = self.add_trip()
+        commit()
+        try:
+            with transaction.atomic():
+                StopTime.objects.create(
+                    company=self.company, trip=trip, stop=self.stops[0],
+                    sequence=1, arrival=time(7), departure=time(7))
+                raise ValueError
+        except ValueError:
+            pass
+        # the work of the rolled back savepoint is gone, not the next
+        StopTime.objects.create(
+            company=self.company, trip=trip, stop=self.stops[1],
+            sequence=2, arrival=time(8), departure=time(8))
+        commit()
+        self.assertEqual(TripSummary.objects.get(trip=trip).stop_count, 1)
+
+    def test_savepoints(self):
+        trip = self.add_trip()
+        commit()
+        for i in range(2):
+            with transaction.atomic():
+                StopTime.objects.create(
+                    company=self.company, trip=trip, stop=self.stops[i],
+                    sequence=i, arrival=time(7 + i), departure=time(7 + i))
+        commit()
+        self.assertEqual(TripSummary.objects.get(trip=trip).stop_count, 2)
+
+    def test_delete_trip(self):
+        self.add_routes(1, 1)
+        trip = Trip.objects.get()
+        trip.delete()
+        commit()
+        self.assertFalse(TripSummary.objects.exists())
+        # no longer served by the route
+        self.assertNotIn('r1-0',
+                         StopSearch.objects.get(stop=self.stops[0]).text)
+        # a later write of a stop still refreshes it
+        self.stops[0].name = 'Renamed'
+        self.stops[0].save()
+        commit()
+        self.assertIn('renamed',
+                      StopSearch.objects.get(stop=self.stops[0]).text)
+
+
+class BulkStopTimesTest(FeedTestCase):
+
+    def setUp(self):
+        super(BulkStopTimesTest, self).setUp()
+        self.add_routes(1, 1)
+        self.trip = Trip.objects.get()
+        self.url = '/v1/trip/%d/stoptimes/bulk/' % self.trip.pk
+        self.login()
+
+    def post(self, data):
+        response = self.client.post(self.url, json.dumps(data),
+                                    content_type='application/json')
+        commit()
+        return response
+
+    def version(self, route=0):
+        return TableVersion.objects.get(
+            company=self.company, table=StopTime.gtfs_table,
+            route=route).version
+
+    def test_replace(self):
+        versions = self.version(), self.version(self.trip.route_id)
+        response = self.post([
+            {'stop': self.stops[2].pk, 'arrival': '08:00:00'},
+            {'stop': 'S0', 'arrival': '08:10:00', 'departure': '08:11:00'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        stoptimes = list(self.trip.stoptime_set.order_by('sequence')
+                         .values_list('sequence', 'stop', 'arrival',
+                                      'departure'))
+        self.assertEqual(stoptimes, [
+            (1, self.stops[2].pk, time(8), time(8)),
+            (2, self.stops[0].pk, time(8, 10), time(8, 11)),
+        ])
+        self.assertEqual(
+            (self.version(), self.version(self.trip.route_id)),
+            (versions[0] + 1, versions[1] + 1))
+        summary = TripSummary.objects.get(trip=self.trip)
+        self.assertEqual(
+            (summary.stop_count, summary.first_arrival, summary.last_arrival),
+            (2, time(8), time(8, 10)))
+        # S1 is no longer served by the route
+        self.assertNotIn('r1-0',
+                         StopSearch.objects.get(stop=self.stops[1]).text)
+        self.assertIn('r1-0', StopSearch.objects.get(stop=self.stops[2]).text)
+
+    def test_stops_of_company(self):
+        other = Company.objects.create(name='Other', slug='other', url='')
+        stop = Stop.objects.create(company=other, stop_id='X',
+                                   name='Other', location=Point(100, 13))
+        response = self.post([
+            {'stop': 'S0', 'arrival': '08:00:00'},
+            {'stop': stop.pk, 'arrival': '08:10:00'},
+            {'stop': 'X', 'arrival': '08:20:00'},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(sorted(response.json()), ['1', '2'])
+        # left as it was
+        self.assertEqual(self.trip.stoptime_set.count(), 3)
+
+
+class LocationFilterTest(FeedTestCase):
+    """The stops are about 1113 m apart, S0 southmost"""
+
+    def features(self, query, status=200):
+        response = self.client.get('/v1/stop/?format=geojson&' + query)
+        self.assertEqual(response.status_code, status)
+        if status != 200:
+            return response.json()
+        return [(feature['properties']['stop_id'],
+                 feature['properties'].get('distance'))
+                for feature in response.json()['features']]
+
+    def test_bbox(self):
+        found = self.features('bbox=100.4,13.705,100.6,13.73')
+        self.assertEqual(sorted(stop for stop, _ in found), ['S1', 'S2'])
+        self.assertEqual(self.features('bbox=100.6,13.6,100.7,13.8'), [])
+        self.assertIn('bbox', self.features('bbox=100.6,13.6,100.5,13.8',
+                                            status=400))
+
+    def test_near(self):
+        found = self.features('near=13.712,100.5&radius=1000')
+        # nearest first, S0 is 1336 m away
+        self.assertEqual([stop for stop, _ in found], ['S1', 'S2'])
+        self.assertAlmostEqual(found[0][1], 221, delta=10)
+        self.assertAlmostEqual(found[1][1], 885, delta=10)
+        self.assertEqual(self.features('near=13.712,100.5&radius=500'),
+                         [('S1', found[0][1])])
+        # the default radius is 500 m as well
+        self.assertEqual(self.features('near=13.712,100.5'),
+                         [('S1', found[0][1])])
+
+    def test_near_invalid(self):
+        self.assertIn('radius', self.features(
+            'near=13.712,100.5&radius=60000', status=400))
+        self.assertIn('radius', self.features(
+            'near=13.712,100.5&radius=0', status=400))
+        self.assertIn('radius', self.features(
+            'near=13.712,100.5&radius=far', status=400))
+        # lon,lat the wrong way round
+        self.assertIn('near', self.features('near=100.5,13.712',
+                                            status=400))
+
+    def test_parse_floats(self):
+        self.assertEqual(parse_floats('1.5,-2', 2, 'near'), [1.5, -2])
+        for value in ('1', '1,2,3', '1,a', '', '1,,2', 'nan,1', '1,inf'):
+            with self.assertRaises(ValidationError) as error:
+                parse_floats(value, 2, 'near')
+            self.assertIn('near', error.exception.detail)
+
+
+class TileTest(FeedTestCase):
+
+    def test_bounds(self):
+        shift = ORIGIN_SHIFT
+        self.assertEqual(tile_bounds(0, 0, 0), (-shift, -shift, shift, shift))
+        # y counts down from the top
+        self.assertEqual(tile_bounds(1, 1, 0), (0, 0, shift, shift))
+        self.assertEqual(tile_bounds(1, 0, 1), (-shift, -shift, 0, 0))
+        left, right = tile_bounds(5, 3, 7), tile_bounds(5, 4, 7)
+        self.assertEqual(left[2], right[0])
+        self.assertAlmostEqual(left[2] - left[0], 2 * shift / 32)
+
+    def test_valid_tile(self):
+        self.assertTrue(valid_tile(0, 0, 0))
+        self.assertTrue(valid_tile(22, (1 << 22) - 1, 0))
+        self.assertFalse(valid_tile(23, 0, 0))
+        self.assertFalse(valid_tile(1, 2, 0))
+        self.assertFalse(valid_tile(1, 0, 2))
+        self.assertFalse(valid_tile(-1, 0, 0))
+
+    def status(self, url):
+        return self.client.get(url).status_code
+
+    def test_not_found(self):
+        self.assertEqual(self.status('/v1/tiles/1/2/0.mvt'), 404)
+        self.assertEqual(self.status('/v1/tiles/23/0/0.mvt'), 404)
+        self.assertEqual(self.status('/v1/tiles/0/0/0.mvt?company=none'),
+                         404)
+
+    @skipIf(connection.vendor == 'postgresql', 'tiles are rendered')
+    def test_not_supported(self):
+        self.assertEqual(self.status('/v1/tiles/0/0/0.mvt'), 501)
+
+    def test_etag(self):
+        url = '/v1/tiles/14/12912/7581.mvt?company=test'
+        tiles = Tiles(self.company)
+        # rendered already, so this works on any database
+        cache.set(tiles.key(14, 12912, 7581), b'tile')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'tile')
+        etag = response['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # a moved stop is a new version of every tile of the company
+        self.stops[0].location = Point(100.6, 13.7)
+        self.stops[0].save()
+        commit()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertNotEqual(response.status_code, 304)
+
+
+class StopSearchTest(FeedTestCase):
+
+    def setUp(self):
+        super(StopSearchTest, self).setUp()
+        self.add_routes(1, 1)
+        self.stops[1].stop_code = '73'
+        self.stops[1].save()
+        commit()
+
+    def search(self, terms):
+        response = self.client.get('/v1/stop/', {'search': terms})
+        self.assertEqual(response.status_code, 200)
+        return sorted(stop['stop_id'] for stop in response.json()['results'])
+
+    def test_search(self):
+        # by the route serving them
+        self.assertEqual(self.search('r1-0'), ['S0', 'S1', 'S2'])
+        self.assertEqual(self.search('AGENCY'), ['S0', 'S1', 'S2'])
+        # by stop code and name
+        self.assertEqual(self.search('73'), ['S1'])
+        self.assertEqual(self.search('stop'), ['S0', 'S1', 'S2'])
+        # every term has to match
+        self.assertEqual(self.search('stop 2'), ['S2'])
+        self.assertEqual(self.search('agency 73'), ['S1'])
+        self.assertEqual(self.search('agency 74'), [])
+
+    def test_index(self):
+        terms = ['r1-0', 'stop 1']
+        stops = Stop.objects.all()
+        expected = set(stops.filter(search__text__contains='stop 1'))
+        self.assertEqual(set(search_stops(stops, terms)), expected)
+        self.assertEqual(len(StopIndex.current().match('r1-0')), 3)
+        self.assertEqual(StopIndex.current().match('nowhere'), set())
+
+    def test_renamed(self):
+        route = Route.objects.get()
+        route.route_id = 'Express'
+        route.save()
+        commit()
+        self.assertEqual(self.search('express'), ['S0', 'S1', 'S2'])
+        self.assertEqual(self.search('r1-0'), [])
+        self.agency.name = 'Bus Company'
+        self.agency.save()
+        commit()
+        self.assertEqual(self.search('bus company'), ['S0', 'S1', 'S2'])
+        self.assertEqual(self.search('agency'), [])
+
+    def test_agency_action(self):
+        Agency.objects.create(company=self.company,
+                              agency_id='phuket-nakhon', name='Nakhon')
+        commit()
+        pk_nakhon_agency_action(None, None, Route.objects.all())
+        self.assertEqual(self.search('nakhon'), ['S0', 'S1', 'S2'])
+        self.assertEqual(self.search('agency'), [])
+
+
+class GeometryTest(FeedTestCase):
+
+    def stop(self, query):
+        response = self.client.get('/v1/stop/', query)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results'][0]
+
+    def test_stop(self):
+        stop = self.stop({})
+        self.assertEqual(stop['geojson']['type'], 'Point')
+        self.assertIsNotNone(stop['location'])
+        stop = self.stop({'geometry': 'none'})
+        self.assertIsNone(stop['geojson'])
+        self.assertIsNone(stop['location'])
+        response = self.client.get('/v1/stop/', {'geometry': 'all'})
+        self.assertEqual(response.status_code, 400)
+
+
+class PaginationTest(FeedTestCase):
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_without_count(self):
+        self.add_routes(3, 0)
+        data = self.get('/v1/route/?count=false&limit=2')
+        self.assertIsNone(data['count'])
+        self.assertEqual([route['route_id'] for route in data['results']],
+                         ['R3-0', 'R3-1'])
+        self.assertIn('offset=2', data['next'])
+        data = self.get(data['next'])
+        self.assertEqual([route['route_id'] for route in data['results']],
+                         ['R3-2'])
+        self.assertIsNone(data['next'])
+        self.assertEqual(
+            self.get('/v1/route/?count=no&offset=3')['results'], [])
+        self.assertEqual(self.get('/v1/route/?count=true')['count'], 3)
+
+    def test_cursor(self):
+        self.add_routes(1, 3)
+        expected = list(StopTime.objects.order_by('trip_id', 'sequence')
+                        .values_list('trip', 'sequence'))
+        self.assertEqual(len(expected), 9)
+        # pages start within and at the end of a trip
+        for limit in (2, 3):
+            url, rows = '/v1/stoptime/?cursor=&limit=%d' % limit, []
+            while url:
+                data = self.get(url)
+                self.assertNotIn('count', data)
+                self.assertLessEqual(len(data['results']), limit)
+                rows.extend((row['trip'], row['sequence'])
+                            for row in data['results'])
+                url = data['next']
+            self.assertEqual(rows, expected)
+
+    def test_max_page_size(self):
+        self.add_routes(3, 0)
+        self.assertEqual(HybridPagination.max_limit,
+                         settings.GTFS_MAX_PAGE_SIZE)
+        self.assertEqual(CursorPagination.max_page_size,
+                         settings.GTFS_MAX_PAGE_SIZE)
+        limits = HybridPagination.max_limit, CursorPagination.max_page_size
+        HybridPagination.max_limit = CursorPagination.max_page_size = 2
+        try:
+            for url in ('/v1/route/?limit=1000', '/v1/route/?count=0&limit=9',
+                        '/v1/route/?cursor=&limit=1000'):
+                self.assertEqual(len(self.get(url)['results']), 2)
+        finally:
+            HybridPagination.max_limit, CursorPagination.max_page_size = \
+                limits
+
+
+class CompanyScopeTest(FeedTestCase):
+
+    def setUp(self):
+        super(CompanyScopeTest, self).setUp()
+        self.other = Company.objects.create(name='Other', slug='other',
+                                            url='')
+        self.stop = Stop.objects.create(company=self.other, stop_id='X',
+                                        name='Other', location=Point(100, 13))
+        self.url = '/v1/stop/%d/' % self.stop.pk
+        self.login()
+
+    def test_writes_of_own_company(self):
+        data = json.dumps({'name': 'Mine'})
+        for url in (self.url, self.url + '?company=other'):
+            response = self.client.patch(url, data,
+                                         content_type='application/json')
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(self.client.delete(url).status_code, 404)
+        self.assertEqual(Stop.objects.get(pk=self.stop.pk).name, 'Other')
+
+    def test_reads_of_any_company(self):
+        # ?company= is for reads only
+        response = self.client.get(self.url + '?company=other')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        response = self.client.get('/v1/stop/?company=other')
+        self.assertEqual([stop['stop_id'] for stop in
+                          response.json()['results']], ['X'])
+
+    def test_jwt_company(self):
+        user = User.objects.create_user('jwt-user')
+        self.company.users.add(user)
+        payload = jwt_payload_handler(User.objects.get(pk=user.pk))
+        self.assertEqual(payload['company_id'], self.company.pk)
+        user = JSONWebTokenAuthentication().authenticate_credentials(payload)
+        with self.assertNumQueries(0):
+            self.assertEqual(user.company_pk, self.company.pk)
+        # a claim of a company the user is not in
+        payload['company_id'] = self.other.pk
+        user = JSONWebTokenAuthentication().authenticate_credentials(payload)
+        self.assertEqual(user.company, self.company)
+        self.assertEqual(user.company_pk, self.company.pk)
+
+
+class ServiceDaysTest(FeedTestCase):
+    """2018-01-01 is a monday"""
+    EVERY_DAY = (True, ) * 7
+
+    def dates(self, start, end, weekdays=EVERY_DAY, exceptions=()):
+        days = ServiceDays({1: compile_service(start, end, weekdays,
+                                               exceptions)})
+        return days.dates(1)
+
+    def test_weekdays(self):
+        mondays = (True, ) + (False, ) * 6
+        self.assertEqual(
+            self.dates(date(2018, 1, 1), date(2018, 1, 31), mondays),
+            [date(2018, 1, day) for day in (1, 8, 15, 22, 29)])
+        # the week starts on start_date, not on a monday
+        self.assertEqual(
+            self.dates(date(2018, 1, 3), date(2018, 1, 16), mondays),
+            [date(2018, 1, 8), date(2018, 1, 15)])
+        self.assertEqual(self.dates(date(2018, 1, 1), date(2018, 1, 31),
+                                    (False, ) * 7), [])
+        # end before start
+        self.assertEqual(self.dates(date(2018, 1, 2), date(2018, 1, 1)), [])
+
+    def test_exceptions(self):
+        start, end = date(2018, 1, 10), date(2018, 1, 12)
+        # added before start_date widens the range
+        self.assertEqual(
+            self.dates(start, end, exceptions=[(date(2018, 1, 5), '1')]),
+            [date(2018, 1, 5), start, date(2018, 1, 11), end])
+        self.assertEqual(
+            self.dates(start, end, exceptions=[(date(2018, 1, 11), '2'),
+                                               (date(2018, 1, 2), '2'),
+                                               (date(2018, 2, 2), '2')]),
+            [start, end])
+        # a service of exceptions only
+        self.assertEqual(
+            self.dates(start, end, (False, ) * 7,
+                       [(date(2018, 3, 1), '1'), (date(2018, 1, 1), '1')]),
+            [date(2018, 1, 1), date(2018, 3, 1)])
+
+    def test_runs(self):
+        days = ServiceDays({1: compile_service(
+            date(2018, 1, 1), date(2018, 1, 7), self.EVERY_DAY,
+            [(date(2018, 1, 3), '2')])})
+        self.assertTrue(days.runs(1, date(2018, 1, 2)))
+        self.assertFalse(days.runs(1, date(2018, 1, 3)))
+        self.assertFalse(days.runs(1, date(2017, 12, 31)))
+        self.assertFalse(days.runs(1, date(2018, 1, 8)))
+        self.assertFalse(days.runs(2, date(2018, 1, 2)))
+        self.assertEqual(days.active(date(2018, 1, 2)), [1])
+
+    def add_services(self):
+        self.add_routes(2, 1)
+        mondays, extra = Calendar.objects.order_by('service_id')
+        mondays.monday = True
+        mondays.save()
+        CalendarDate.objects.create(
+            company=self.company, service=extra, date=date(2018, 1, 6),
+            exception_type='1')
+        commit()
+        return mondays, extra
+
+    def test_active_on(self):
+        mondays, extra = self.add_services()
+
+        def trips(day, query='&company=test'):
+            response = self.client.get('/v1/trip/?active_on=%s%s' % (
+                day, query))
+            self.assertEqual(response.status_code, 200)
+            return [trip['trip_id'] for trip in response.json()['results']]
+
+        self.assertEqual(trips('2018-01-08'), ['R2-0-T0'])
+        # removed by the exception of add_routes()
+        self.assertEqual(trips('2018-01-01'), [])
+        self.assertEqual(trips('2018-01-06'), ['R2-1-T0'])
+        self.assertEqual(trips('2019-01-07'), [])
+        self.assertEqual(trips('2018-01-08', '&company=none'), [])
+        # anonymous requests are of every company, one at a time
+        response = self.client.get('/v1/trip/?active_on=2018-01-08')
+        self.assertEqual(response.status_code, 400)
+        self.login()
+        self.assertEqual(trips('2018-01-08', ''), ['R2-0-T0'])
+        response = self.client.get('/v1/trip/?active_on=2018-13-01')
+        self.assertEqual(response.status_code, 400)
+
+    def test_dates(self):
+        mondays, extra = self.add_services()
+        url = '/v1/calendar/%d/dates/' % mondays.pk
+        dates = self.client.get(url).json()['dates']
+        self.assertEqual(len(dates), 52)
+        self.assertEqual(dates[0], '2018-01-08')
+        dates = self.client.get(url + '?from=2018-02-01&to=2018-02-28') \
+            .json()['dates']
+        self.assertEqual(dates, ['2018-02-05', '2018-02-12', '2018-02-19',
+                                 '2018-02-26'])
+        url = '/v1/calendar/%d/dates/' % extra.pk
+        self.assertEqual(self.client.get(url).json()['dates'],
+                         ['2018-01-06'])
+
+
+class FrequencyTest(FeedTestCase):
+
+    def test_forward_offsets(self):
+        # 23:50, 00:05, 00:10-00:12
+        self.assertEqual(
+            forward_offsets([(85800, 85800), (300, 300), (600, 720)]),
+            ([0, 900, 1200], [0, 900, 1320]))
+        # from the first departure, not the first arrival
+        self.assertEqual(forward_offsets([(100, 160), (400, 400)]),
+                         ([-60, 240], [0, 240]))
+        # a whole day is not a time going backwards
+        self.assertEqual(forward_offsets([(0, 0), (0, 0)]),
+                         ([0, 0], [0, 0]))
+
+    def test_departures(self):
+        self.assertEqual(departures([(time(23, 30), time(0, 30), 1800)]),
+                         [84600, 86400])
+        # overlaps are a single departure
+        self.assertEqual(departures([(time(6), time(7), 1800),
+                                     (time(6, 30), time(7, 30), 1800)]),
+                         [21600, 23400, 25200])
+        self.assertEqual(format_time(90000), '25:00:00')
+        self.assertEqual(frequency_trip_id('X', 86400), 'X-240000')
+
+    def test_export(self):
+        self.add_night_trip()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            output = os.path.join(tmpdir, 'feed')
+            call_command('gtfs_feed', 'export', agency_ids='A',
+                         company='test', output=output, stream=True,
+                         expand_frequencies=True)
+            with zipfile.ZipFile(output + '.zip') as feed:
+                tables = dict(
+                    (name, [line.split(',') for line in
+                            feed.read(name).decode('utf-8').splitlines()])
+                    for name in feed.namelist())
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertNotIn('frequencies.txt', tables)
+        column = tables['trips.txt'][0].index('trip_id')
+        trips = [row[column] for row in tables['trips.txt'][1:]]
+        # 06:00 to 09:00 every 10 minutes, 23:30 and 24:00
+        self.assertEqual(len(trips), 20)
+        self.assertIn('R1-0-T0-085000', trips)
+        self.assertNotIn('R1-0-T0-090000', trips)
+        header = tables['stop_times.txt'][0]
+        columns = [header.index(name) for name in
+                   ('trip_id', 'arrival_time', 'departure_time')]
+        stoptimes = [tuple(row[i] for i in columns)
+                     for row in tables['stop_times.txt'][1:]]
+        self.assertEqual(len(stoptimes), 60)
+        self.assertEqual(
+            [row[1:] for row in stoptimes if row[0] == 'X-240000'],
+            [('24:00:00', '24:00:00'), ('24:15:00', '24:15:00'),
+             ('24:20:00', '24:22:00')])
+        self.assertIn(('X-233000', '23:50:00', '23:52:00'), stoptimes)
+
+
+class DeparturesTest(FeedTestCase):
+
+    def add_night_trips(self):
+        """X of add_night_trip() and N, once from 23:50 to 00:10"""
+        trip = Trip.objects.create(
+            company=self.company, route=Route.objects.get(),
+            service=Calendar.objects.get(), trip_id='N')
+        for seq, (arrival, departure) in enumerate([
+                (time(23, 50), time(23, 50)), (time(0, 5), time(0, 5)),
+                (time(0, 10), time(0, 10))]):
+            StopTime.objects.create(
+                company=self.company, trip=trip, stop=self.stops[seq],
+                arrival=arrival, departure=departure, sequence=seq + 1)
+        commit()
+
+    def night_departures(self):
+        url = '/v1/stop/%d/departures?date=2018-03-%s&limit=5'
+        response = self.client.get(url % (self.stops[1].pk, '01&after=23:00'))
+        # past 24:00:00 on the day the trips start
+        self.assertEqual(
+            [(row['departure'], row['trip_id'])
+             for row in response.data['departures']],
+            [('23:45:00', 'X-233000'), ('24:05:00', 'N'),
+             ('24:15:00', 'X-240000')])
+        # the service of the day before, still running
+        response = self.client.get(url % (self.stops[1].pk, '02'))
+        self.assertEqual(
+            [(row['departure'], row['trip_id'])
+             for row in response.data['departures']],
+            [('00:05:00', 'N'), ('00:15:00', 'X-240000')])
+        response = self.client.get(url % (self.stops[0].pk, '01&after=23:00'))
+        self.assertEqual(
+            [(row['departure'], row['trip_id'])
+             for row in response.data['departures']],
+            [('23:30:00', 'X-233000'), ('23:50:00', 'N'),
+             ('24:00:00', 'X-240000')])
+
+    def test_night(self):
+        self.add_night_trip()
+        self.add_night_trips()
+        self.night_departures()
+        # from the database, no snapshot was built for it
+        self.assertEqual(snapshot._snapshots, {})
+        with override_settings(GTFS_TIMETABLE_SNAPSHOT=True):
+            self.night_departures()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""Mapbox Vector Tiles of stops and route shapes
+
+    content = Tiles(company).tile(z, x, y)
+
+Tiles are rendered by postgis (`ST_AsMVT`, postgis >= 2.4) in a single
+query with two layers, `routes` (the shapes, simplified to a pixel of
+the zoom level) and `stops` (from MIN_STOP_ZOOM on). The tile envelope
+is computed here so ST_TileEnvelope (postgis 3) is not needed.
+
+Rendered tiles are kept in the django cache under the `TableVersion`
+counters of stops, routes and shapes, any change of those moves every
+tile of the company to a new key.
+"""
+from __future__ import unicode_literals
+import hashlib
+
+from django.core.cache import cache
+from django.db import connection
+
+from .models import Stop, Route, TableVersion
+
+# half the width of the web mercator square in metres
+ORIGIN_SHIFT = 20037508.342789244
+EXTENT = 4096
+BUFFER = 64
+MAX_ZOOM = 22
+# stops are left out of tiles below this zoom level
+MIN_STOP_ZOOM = 12
+CACHE_TIMEOUT = 24 * 3600
+CONTENT_TYPE = 'application/vnd.mapbox-vector-tile'
+# tables the tiles are drawn from
+TILE_TABLES = (TableVersion.ALL, Stop.gtfs_table, Route.gtfs_table,
+               'shapes.txt')
+
+
+class TileNotSupported(Exception):
+    pass
+
+
+def tile_bounds(z, x, y):
+    """(xmin, ymin, xmax, ymax) of tile z/x/y in EPSG:3857"""
+    size = 2 * ORIGIN_SHIFT / (1 << z)
+    xmin = -ORIGIN_SHIFT + x * size
+    ymax = ORIGIN_SHIFT - y * size
+    return (xmin, ymax - size, xmin + size, ymax)
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < (1 << z) and 0 <= y < (1 << z)
+
+
+class Tiles(object):
+    """Vector tiles of `company`, or of every company when None"""
+
+    def __init__(self, company=None):
+        self.company = company
+
+    def version(self):
+        """Token that changes with any geometry the tiles show"""
+        if self.company is not None:
+            companies = [self.company.pk]
+        else:
+            companies = TableVersion.objects.values('company')
+        versions = TableVersion.versions(companies)
+        return '-'.join(str(sum(v for (t, r), v in versions.items()
+                                if t == table))
+                        for table in TILE_TABLES)
+
+    def key(self, z, x, y, version=None):
+        if version is None:
+            version = self.version()
+        source = '%s:%s/%s/%s:%s' % (
+            self.company.pk if self.company is not None else '*',
+            z, x, y, version)
+        return 'gtfs:tile:%s' % hashlib.sha1(
+            source.encode('utf-8')).hexdigest()
+
+    def sql(self, z):
+        qn = connection.ops.quote_name
+        stop, route = Stop._meta, Route._meta
+        company = ''
+        if self.company is not None:
+            company = 'AND t.%s = %%(company)s' % qn('company_id')
+        layers = ['''
+            (SELECT COALESCE(ST_AsMVT(r, 'routes', %(extent)s, 'geom'),
+                             ''::bytea)
+             FROM (
+                SELECT t.{id}, t.{route_id}, t.{short_name},
+                       t.{route_type}, t.{route_color},
+                       ST_AsMVTGeom(
+                           ST_Simplify(ST_Transform(t.{shapes}, 3857),
+                                       %(tolerance)s),
+                           b.geom, %(extent)s, %(buffer)s, true) AS geom
+                FROM {route_table} t, bounds b
+                WHERE t.{shapes} && b.wgs84 {company}
+             ) r WHERE r.geom IS NOT NULL)
+        '''.format(
+            id=qn('id'), route_id=qn('route_id'),
+            short_name=qn('short_name'), route_type=qn('route_type'),
+            route_color=qn('route_color'), shapes=qn('shapes'),
+            route_table=qn(route.db_table), company=company)]
+        if z >= MIN_STOP_ZOOM:
+            layers.append('''
+                (SELECT COALESCE(ST_AsMVT(s, 'stops', %(extent)s, 'geom'),
+                                 ''::bytea)
+                 FROM (
+                    SELECT t.{id}, t.{stop_id}, t.{name},
+                           t.{location_type},
+                           ST_AsMVTGeom(ST_Transform(t.{location}, 3857),
+                                        b.geom, %(extent)s, %(buffer)s,
+                                        true) AS geom
+                    FROM {stop_table} t, bounds b
+                    WHERE t.{location} && b.wgs84 {company}
+                 ) s WHERE s.geom IS NOT NULL)
+            '''.format(
+                id=qn('id'), stop_id=qn('stop_id'), name=qn('name'),
+                location_type=qn('location_type'),
+                location=qn('location'), stop_table=qn(stop.db_table),
+                company=company))
+        return '''
+            WITH bounds AS (
+                SELECT geom, ST_Transform(geom, 4326) AS wgs84
+                FROM (SELECT ST_MakeEnvelope(
+                    %(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 3857) AS geom
+                ) e
+            )
+            SELECT {layers}
+        '''.format(layers=' || '.join(layers))
+
+    def render(self, z, x, y):
+        """Tile z/x/y as bytes, straight from the database"""
+        if connection.vendor != 'postgresql':
+            raise TileNotSupported('vector tiles need postgis')
+        xmin, ymin, xmax, ymax = tile_bounds(z, x, y)
+        params = {
+            'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax,
+            'extent': EXTENT, 'buffer': BUFFER,
+            # one pixel of this zoom level
+            'tolerance': (xmax - xmin) / EXTENT,
+            'company': self.company.pk if self.company is not None else None,
+        }
+        with connection.cursor() as cursor:
+            cursor.execute(self.sql(z), params)
+            row = cursor.fetchone()
+        return bytes(row[0]) if row and row[0] else b''
+
+    def tile(self, z, x, y, version=None):
+        """Cached `render()`"""
+        key = self.key(z, x, y, version)
+        content = cache.get(key)
+        if content is None:
+            content = self.render(z, x, y)
+            cache.set(key, content, CACHE_TIMEOUT)
+        return content
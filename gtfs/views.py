@@ -1,25 +1,68 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-from django.db.models import Q
-from rest_framework import filters, viewsets, status
+import calendar
+from django.db.models import Q, Prefetch
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_date
+from django.utils import timezone
+from django.utils.http import http_date
+from rest_framework import filters, viewsets, status, permissions
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.throttling import ScopedRateThrottle
+from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet as _ModelViewset
 
+from people.models import Company
+
 from .models import Agency, Stop, Route, Trip, Calendar, CalendarDate, \
     FareAttribute, FareRule, StopTime, Frequency
 from .serializers import AgencySerializer, StopSerializer, RouteSerializer, \
     TripSerializer, CalendarSerializer, CalendarDateSerializer, \
     FareAttributeSerializer, FareRuleSerializer, StopTimeSerializer, \
-    FrequencySerializer
+    FrequencySerializer, BulkStopTimeSerializer, geometry_mode
+from .export import FeedExporter, select_routes
+from .filters import LocationFilter, StopSearchFilter, parse_floats
+from .renderers import GeoJSONRenderer, IgnoreClientContentNegotiation
+from .tiles import (
+    Tiles, TileNotSupported, valid_tile, CONTENT_TYPE as TILE_CONTENT_TYPE
+)
+from .departures import stop_departures
+from .feedcache import FeedCache
+from .frequencies import format_time
+from .planner import day_planner
+from .services import ServiceDays
+from .snapshot import timetable_snapshot, enabled as snapshot_enabled
+from .shapes import default_tolerance
 
 
 class ModelViewSet(_ModelViewset):
+    """Rows of a single company
+
+    Writes only ever see the company of the user. Reads are of the
+    company given by `?company=<slug>`, else of the company of the user,
+    else (anonymous) of every company.
+    """
     filter_backends = (filters.SearchFilter, )
     custom_get_param = None
     custom_fk_field = ''
     custom_fk_field_rel = ''
 
+    def filter_company(self, qs):
+        request = self.request
+        slug = request.query_params.get('company')
+        if slug and request.method in permissions.SAFE_METHODS:
+            return qs.filter(company__slug=slug)
+        if request.user.is_authenticated():
+            # None when the user has no company, which matches nothing
+            return qs.filter(company_id=request.user.company_pk)
+        return qs
+
     def get_queryset(self):
-        qs = super(ModelViewSet, self).get_queryset()
+        qs = self.filter_company(super(ModelViewSet, self).get_queryset())
         has_custom_req_query = self.custom_get_param is not None and \
             len(self.custom_fk_field) > 0 and \
             len(self.custom_fk_field_rel) > 0
@@ -38,6 +81,67 @@ class ModelViewSet(_ModelViewset):
         return qs
 
 
+class SnapshotMixin(object):
+    """List served from the `TimetableSnapshot` of the company
+
+    Only with GTFS_TIMETABLE_SNAPSHOT on, for a request of a single
+    company without other parameters than `snapshot_params`, anything
+    else goes to the database. See gtfs.snapshot.
+    """
+    snapshot_params = ()
+    # understood by every list
+    common_params = ('limit', 'offset', 'count', 'company', 'geometry',
+                     'format')
+
+    def request_company_pk(self):
+        slug = self.request.query_params.get('company')
+        if slug:
+            return Company.objects.filter(slug=slug) \
+                .values_list('pk', flat=True).first()
+        if self.request.user.is_authenticated():
+            return self.request.user.company_pk
+        return None
+
+    def get_snapshot(self):
+        if not snapshot_enabled():
+            return None
+        params = set(self.request.query_params)
+        if params - set(self.common_params + self.snapshot_params):
+            return None
+        company = self.request_company_pk()
+        if company is None:
+            return None
+        return timetable_snapshot(company)
+
+    def snapshot_rows(self, snapshot):
+        raise NotImplementedError
+
+    def snapshot_data(self, snapshot, row):
+        raise NotImplementedError
+
+    def list(self, request, *args, **kwargs):
+        snapshot = self.get_snapshot()
+        if snapshot is None:
+            return super(SnapshotMixin, self).list(request, *args, **kwargs)
+        rows = self.snapshot_rows(snapshot)
+        page = self.paginate_queryset(rows)
+        if page is None:
+            return Response([self.snapshot_data(snapshot, i) for i in rows])
+        return self.get_paginated_response(
+            [self.snapshot_data(snapshot, i) for i in page])
+
+
+def with_trip_details(trips):
+    """`trips` with everything TripSerializer shows fetched up front
+
+    The service with its calendar dates, the frequencies and the
+    `TripSummary` of the stop times come along, so a page takes the same
+    number of queries whatever its size.
+    """
+    return trips.select_related('service', 'summary') \
+        .prefetch_related('frequency_set', 'service__calendardate_set')
+
+
 class AgencyViewSet(ModelViewSet):
     queryset = Agency.objects.all()
     serializer_class = AgencySerializer
@@ -45,29 +149,148 @@ class AgencyViewSet(ModelViewSet):
     search_fields = ('slug', 'tags', 'agency_id')
 
 
-class StopViewSet(ModelViewSet):
+class StopViewSet(SnapshotMixin, ModelViewSet):
+    """Stops, also as one GeoJSON FeatureCollection with ?format=geojson
+
+    /v1/stop/?bbox=min_lon,min_lat,max_lon,max_lat&format=geojson
+    /v1/stop/?near=lat,lon&radius=metres
+    /v1/stop/?search=term
+    /v1/stop/{id}/departures?date=YYYY-MM-DD&after=HH:MM&limit=10
+
+    See gtfs.filters.LocationFilter and StopSearchFilter.
+    """
     queryset = Stop.objects.all()
     serializer_class = StopSerializer
-    search_fields = (
-        'stop_id',
-        'name',
-        'stop_code',
-        'stoptime__trip__route__agency__name',
-        'stoptime__trip__route__short_name',
-        'stoptime__trip__route__route_id',
-    )
+    # stop_id, name, stop_code and agency name, short_name and route_id
+    # of the routes serving the stop
+    filter_backends = (StopSearchFilter, LocationFilter)
+    renderer_classes = tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (
+        GeoJSONRenderer, )
+    # features in a single unpaginated GeoJSON response
+    max_features = 10000
+    max_departures = 100
+
+    def list(self, request, *args, **kwargs):
+        if request.accepted_renderer.format != 'geojson':
+            return super(StopViewSet, self).list(request, *args, **kwargs)
+        qs = self.filter_queryset(self.get_queryset())
+        return Response(self.feature_collection(qs))
+
+    def snapshot_rows(self, snapshot):
+        return snapshot.stops()
+
+    def snapshot_data(self, snapshot, row):
+        return snapshot.stop_data(row, geometry_mode(self.request))
+
+    @action(detail=True)
+    def departures(self, request, pk=None):
+        """Next departures at the stop, from the timetable snapshot when
+        it is on, else from the database (see gtfs.departures)
+
+        `date` and `after` default to now, `after` to midnight when
+        `date` is given.
+        """
+        stop = self.get_object()
+        params = request.query_params
+        day, after = parse_moment(params, 'after')
+        try:
+            limit = max(min(int(params.get('limit', 10)),
+                            self.max_departures), 1)
+        except ValueError:
+            raise ValidationError({'limit': 'Expected a number.'})
+
+        return Response({
+            'stop': stop.pk,
+            'date': day,
+            'after': format_time(after),
+            'departures': stop_departures(stop, day, after, limit),
+        })
+
+    def feature_collection(self, queryset):
+        fields = ['pk', 'stop_id', 'name', 'stop_code', 'zone_id',
+                  'location_type', 'location']
+        if 'distance' in queryset.query.annotations:
+            fields.append('distance')
+        rows = list(queryset.values_list(*fields)[:self.max_features + 1])
+        features = []
+        for row in rows[:self.max_features]:
+            properties = dict(zip(fields[1:], row[1:]))
+            location = properties.pop('location')
+            if 'distance' in properties:
+                properties['distance'] = round(properties['distance'].m, 1)
+            features.append({
+                'type': 'Feature',
+                'id': row[0],
+                'geometry': {
+                    'type': 'Point',
+                    'coordinates': list(location.coords),
+                },
+                'properties': properties,
+            })
+        return {
+            'type': 'FeatureCollection',
+            'features': features,
+            'truncated': len(rows) > self.max_features,
+        }
 
 
 class RouteViewSet(ModelViewSet):
-    queryset = Route.objects.all()
+    """Routes, `?geometry=none|simplified|full` for their geojson"""
+    queryset = Route.objects.prefetch_related(
+        Prefetch('trip_set', queryset=with_trip_details(Trip.objects.all())),
+        'farerule_set')
     serializer_class = RouteSerializer
     custom_get_param = 'agency'
     custom_fk_field = 'agency'
     custom_fk_field_rel = 'agency_id'
 
+    def get_queryset(self):
+        qs = super(RouteViewSet, self).get_queryset()
+        if geometry_mode(self.request) == 'none':
+            # shapes are only ever shown as geojson
+            qs = qs.defer('shapes')
+        return qs
+
+
+def parse_day(value, name):
+    try:
+        day = parse_date(value)
+    except ValueError:
+        day = None
+    if day is None:
+        raise ValidationError({name: 'Expected YYYY-MM-DD.'})
+    return day
+
+
+def parse_time(value, name):
+    """Seconds of HH:MM[:SS], hours may go past 24"""
+    try:
+        parts = [int(i) for i in value.split(':')]
+    except ValueError:
+        parts = []
+    if len(parts) not in (2, 3) or min(parts) < 0 or max(parts[1:]) > 59:
+        raise ValidationError({name: 'Expected HH:MM[:SS].'})
+    return sum(i * j for i, j in zip(parts, (3600, 60, 1)))
+
+
+def parse_moment(params, name):
+    """(date, seconds) of `?date=` and the time parameter `name`, now by
+    default, midnight when only the date is given"""
+    current = timezone.localtime()
+    if params.get('date'):
+        day, seconds = parse_day(params['date'], 'date'), 0
+    else:
+        day, seconds = current.date(), (
+            current.hour * 3600 + current.minute * 60 + current.second)
+    if params.get(name):
+        seconds = parse_time(params[name], name)
+    return day, seconds
 
-class TripViewSet(ModelViewSet):
-    queryset = Trip.objects.all()
+
+class TripViewSet(SnapshotMixin, ModelViewSet):
+    """Trips, of the services running on a day with `?active_on=YYYY-MM-DD`
+    (see gtfs.services), of a single company"""
+    queryset = with_trip_details(Trip.objects.all())
     serializer_class = TripSerializer
     custom_get_param = 'route'
     custom_fk_field = 'route'
@@ -76,20 +299,119 @@ class TripViewSet(ModelViewSet):
         'route__agency__name',
         'route__agency__agency_id',
     )
+    snapshot_params = ('route', 'active_on')
+
+    def get_queryset(self):
+        qs = super(TripViewSet, self).get_queryset()
+        params = self.request.query_params
+        if params.get('active_on'):
+            day = parse_day(params['active_on'], 'active_on')
+            # the services of every company would not fit in a query
+            company = self.request_company_pk()
+            if company is None:
+                if params.get('company') or \
+                        self.request.user.is_authenticated():
+                    return qs.none()
+                raise ValidationError(
+                    {'active_on': 'Expected ?company= as well.'})
+            services = ServiceDays.of_company(company).active(day)
+            qs = qs.filter(service__in=services)
+        return qs
+
+    def snapshot_rows(self, snapshot):
+        params = self.request.query_params
+        routes = services = None
+        if params.get('route') is not None:
+            try:
+                routes = [int(params['route'])]
+            except ValueError:
+                routes = [pk for pk, route_id in snapshot.route_ids.items()
+                          if route_id == params['route']]
+        if params.get('active_on'):
+            day = parse_day(params['active_on'], 'active_on')
+            services = ServiceDays.of_company(snapshot.company_id) \
+                .active(day)
+        return snapshot.trips(routes, services)
+
+    def snapshot_data(self, snapshot, row):
+        return snapshot.trip_data(row)
+
+    @action(detail=True, methods=['post'], url_path='stoptimes/bulk')
+    def bulk_stoptimes(self, request, pk=None):
+        """Replace the stop times of the trip with the posted list
+
+        POST /v1/trip/{id}/stoptimes/bulk
+        [{"stop": 12, "arrival": "08:00:00"},
+         {"stop": "S2", "arrival": "08:04:00", "departure": "08:05:00"}]
+
+        `stop` is a pk, a stop_id or a stop object, the list may also be
+        sent as {"stoptimes": [...]}. See BulkStopTimeListSerializer.
+        """
+        trip = self.get_object()
+        data = request.data
+        if isinstance(data, dict):
+            data = data.get('stoptimes')
+        serializer = BulkStopTimeSerializer(
+            data=data, many=True, context={'trip': trip})
+        serializer.is_valid(raise_exception=True)
+        stoptimes = trip.replace_stoptimes(serializer.validated_data)
+        return Response(StopTimeSerializer(stoptimes, many=True).data)
 
 
-class StopTimeViewSet(ModelViewSet):
+class StopTimeViewSet(SnapshotMixin, ModelViewSet):
     queryset = StopTime.objects.all()
     serializer_class = StopTimeSerializer
+    # ?cursor= pages through a trip after another, see gtfs.pagination.
+    # DRF's CursorPagination keys on trip_id alone, the cursor is a trip
+    # plus an offset into it: a page starting within a trip OFFSETs over
+    # the stop times of that trip read already, at most the longest trip
+    cursor_ordering = ('trip_id', 'sequence')
     custom_get_param = 'trip'
     custom_fk_field = 'trip'
     custom_fk_field_rel = 'trip_id'
+    snapshot_params = ('trip', )
+
+    def snapshot_rows(self, snapshot):
+        trip = self.request.query_params.get('trip')
+        if trip is None:
+            return snapshot.stoptimes()
+        try:
+            trips = [snapshot.trip_index[int(trip)]]
+        except ValueError:
+            trips = snapshot.trips_by_id.get(trip, [])
+        except KeyError:
+            trips = []
+        return snapshot.stoptimes(trips)
+
+    def snapshot_data(self, snapshot, row):
+        return snapshot.stoptime_data(row, geometry_mode(self.request))
 
 
 class CalendarViewSet(ModelViewSet):
     queryset = Calendar.objects.all()
     serializer_class = CalendarSerializer
 
+    @action(detail=True)
+    def dates(self, request, pk=None):
+        """Every date the service runs on, exceptions applied
+
+        GET /v1/calendar/{id}/dates?from=2018-01-01&to=2018-12-31
+        """
+        service = self.get_object()
+        days = ServiceDays.of_company(service.company_id)
+        dates = days.dates(service.pk)
+        if request.query_params.get('from'):
+            start = parse_day(request.query_params['from'], 'from')
+            dates = [day for day in dates if day >= start]
+        if request.query_params.get('to'):
+            end = parse_day(request.query_params['to'], 'to')
+            dates = [day for day in dates if day <= end]
+        return Response({
+            'id': service.pk,
+            'service_id': service.service_id,
+            'dates': dates,
+        })
+
 
 class CalendarDateViewSet(ModelViewSet):
     queryset = CalendarDate.objects.all()
@@ -118,3 +440,156 @@ class FareRuleViewSet(ModelViewSet):
     custom_get_param = 'route'
     custom_fk_field = 'route'
     custom_fk_field_rel = 'route_id'
+
+
+class FeedView(APIView):
+    """GTFS zip of the given routes, or of the routes of the given agencies
+
+    /v1/feed/?route=R1,R2
+    /v1/feed/?agency=bmta&company=<slug>
+
+    The zip is built while it is sent, so the first byte goes out right
+    away and memory stays flat. It is kept in the feed cache on the way,
+    later downloads of unchanged data are served from there and honour
+    If-None-Match/If-Modified-Since.
+    """
+
+    def get(self, request, format=None):
+        params = request.query_params
+        routes = select_routes(
+            params['route'].split(',') if params.get('route') else None,
+            params['agency'].split(',') if params.get('agency') else None,
+            params.get('company'))
+        if routes is None:
+            return Response({'detail': 'route or agency is required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not routes.exists():
+            return Response({'detail': 'Route could not be found'},
+                            status=status.HTTP_404_NOT_FOUND)
+
+        cache = FeedCache()
+        entry = cache.entry(routes, simplify=default_tolerance())
+        etag = '"%s"' % entry.key
+        last_modified = None
+        if entry.last_modified is not None:
+            last_modified = calendar.timegm(
+                entry.last_modified.utctimetuple())
+        not_modified = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        path = cache.get(entry)
+        if path is not None:
+            response = FileResponse(open(path, 'rb'),
+                                    content_type='application/zip')
+        else:
+            chunks = FeedExporter(routes).iter_zip()
+            response = StreamingHttpResponse(
+                cache.tee(entry, chunks), content_type='application/zip')
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        response['Content-Disposition'] = 'attachment; filename="gtfs.zip"'
+        return response
+
+
+class PlanView(APIView):
+    """Journeys between two stops or points of a company, see gtfs.planner
+
+    /v1/plan?from=<stop id>&to=<stop id>&date=YYYY-MM-DD&time=HH:MM
+    /v1/plan?from=lat,lon&to=lat,lon&company=<slug>
+
+    The company is `company`, else the company of the user, else the
+    company of the `from` stop. `date` and `time` default to now.
+    """
+
+    def get(self, request, format=None):
+        params = request.query_params
+        places = {}
+        for name in ('from', 'to'):
+            value = params.get(name, '')
+            if not value:
+                raise ValidationError({name: 'This parameter is required.'})
+            if ',' in value:
+                lat, lon = parse_floats(value, 2, name)
+                places[name] = (None, lon, lat)
+            elif value.isdigit():
+                places[name] = (int(value), None, None)
+            else:
+                raise ValidationError({name: 'Expected a stop id or lat,lon.'})
+        day, departure = parse_moment(params, 'time')
+
+        if params.get('company'):
+            company_id = Company.objects.filter(
+                slug=params['company']).values_list('pk', flat=True).first()
+        elif request.user.is_authenticated():
+            company_id = request.user.company_pk
+        else:
+            company_id = Stop.objects.filter(pk=places['from'][0]) \
+                .values_list('company', flat=True).first()
+        if company_id is None:
+            return Response({'detail': 'Company could not be found'},
+                            status=status.HTTP_404_NOT_FOUND)
+
+        planner = day_planner(company_id, day)
+        network, stops = planner.network, planner.snapshot.stop_index
+        around = {}
+        for name, (pk, lon, lat) in places.items():
+            if pk is None:
+                around[name] = network.around(lon, lat)
+            elif pk in stops:
+                around[name] = network.around_stop(stops[pk])
+            else:
+                return Response({'detail': 'Stop could not be found'},
+                                status=status.HTTP_404_NOT_FOUND)
+        return Response({
+            'date': day,
+            'time': format_time(departure),
+            'journeys': planner.plan(around['from'], around['to'],
+                                     departure),
+        })
+
+
+class TileView(APIView):
+    """Mapbox Vector Tile of route shapes and stops, postgis only
+
+    /v1/tiles/{z}/{x}/{y}.mvt
+    /v1/tiles/{z}/{x}/{y}.mvt?company=<slug>
+
+    Tiles are cached until the stops, routes or shapes change, which is
+    also their ETag. See gtfs.tiles.
+    """
+    # errors are JSON, the map client may only accept tiles
+    content_negotiation_class = IgnoreClientContentNegotiation
+    # a map view loads dozens of tiles at once
+    throttle_scope = 'tiles'
+    throttle_classes = (ScopedRateThrottle, )
+
+    def get(self, request, z, x, y, format=None):
+        z, x, y = int(z), int(x), int(y)
+        if not valid_tile(z, x, y):
+            return Response({'detail': 'Tile could not be found'},
+                            status=status.HTTP_404_NOT_FOUND)
+        company = None
+        if request.query_params.get('company'):
+            company = Company.objects.filter(
+                slug=request.query_params['company']).first()
+            if company is None:
+                return Response({'detail': 'Company could not be found'},
+                                status=status.HTTP_404_NOT_FOUND)
+
+        tiles = Tiles(company)
+        version = tiles.version()
+        etag = '"%s"' % tiles.key(z, x, y, version).rsplit(':', 1)[-1]
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+        try:
+            content = tiles.tile(z, x, y, version)
+        except TileNotSupported as e:
+            return Response({'detail': str(e)},
+                            status=status.HTTP_501_NOT_IMPLEMENTED)
+        response = HttpResponse(content, content_type=TILE_CONTENT_TYPE)
+        response['ETag'] = etag
+        return response
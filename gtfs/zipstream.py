@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""One pass zip writer
+
+`zipfile` in python2 can only add a member from a file on disk or from a
+string already in memory. `ZipStream` compresses an iterable of byte chunks
+into an entry as they come and never seeks, so a feed can go straight to a
+file, a socket or a `StreamingHttpResponse`.
+
+    with open('feed.zip', 'wb') as f:
+        write_zip(f, [('agency.txt', chunks), ...], compresslevel=9)
+
+Sizes and CRC are written in a data descriptor after each entry. ZIP64
+records are added to the central directory when the archive needs them;
+`zip64=True` also makes every entry ZIP64 so a single member may exceed
+4 GiB, `zip64=False` refuses to write them at all.
+"""
+import struct
+import time
+import zlib
+from zipfile import ZIP_STORED, ZIP_DEFLATED, LargeZipFile
+
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP32_COUNT_LIMIT = 0xFFFF
+
+_LOCAL_HEADER = struct.Struct(str('<IHHHHHIIIHH'))
+_DESCRIPTOR = struct.Struct(str('<IIII'))
+_DESCRIPTOR64 = struct.Struct(str('<IIQQ'))
+_CENTRAL_HEADER = struct.Struct(str('<IHHHHHHIIIHHHHHII'))
+_END = struct.Struct(str('<IHHHHIIH'))
+_END64 = struct.Struct(str('<IQHHIIQQQQ'))
+_END64_LOCATOR = struct.Struct(str('<IIQI'))
+_EXTRA64_HEADER = struct.Struct(str('<HH'))
+
+_FLAG_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+
+
+def _dos_time(date_time):
+    year, month, day, hour, minute, second = date_time[:6]
+    return (
+        (hour << 11) | (minute << 5) | (second // 2),
+        ((year - 1980) << 9) | (month << 5) | day,
+    )
+
+
+class _Entry(object):
+
+    def __init__(self, name, flags, method, date_time, offset, zip64):
+        self.name = name
+        self.flags = flags
+        self.method = method
+        self.dos_time, self.dos_date = _dos_time(date_time)
+        self.offset = offset
+        self.zip64 = zip64
+        self.crc = 0
+        self.compress_size = 0
+        self.file_size = 0
+
+
+class ZipStream(object):
+    """Produce a zip archive as an iterator of bytes
+
+    compression      zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED
+    compresslevel    zlib level 0-9, 0 always means ZIP_STORED
+    zip64            None: only when needed, True: always, False: never
+    """
+
+    def __init__(self, compression=ZIP_DEFLATED, compresslevel=6,
+                 zip64=None):
+        if compression not in (ZIP_STORED, ZIP_DEFLATED):
+            raise ValueError('unsupported compression %r' % compression)
+        if compresslevel == 0:
+            compression = ZIP_STORED
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self.zip64 = zip64
+        self.entries = []
+        self.offset = 0
+
+    def _emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def entry(self, arcname, chunks, date_time=None):
+        """Yield the bytes of one member holding the concatenated `chunks`"""
+        if isinstance(arcname, bytes):
+            name, flags = arcname, _FLAG_DESCRIPTOR
+        else:
+            name, flags = arcname.encode('utf-8'), _FLAG_DESCRIPTOR
+            try:
+                arcname.encode('ascii')
+            except UnicodeError:
+                flags |= _FLAG_UTF8
+        zip64 = bool(self.zip64)
+        entry = _Entry(name, flags, self.compression,
+                       date_time or time.localtime(), self.offset, zip64)
+
+        if zip64:
+            extra = _EXTRA64_HEADER.pack(1, 16) + struct.pack(str('<QQ'), 0, 0)
+            size = ZIP32_LIMIT
+        else:
+            extra, size = b'', 0
+        yield self._emit(_LOCAL_HEADER.pack(
+            0x04034b50, 45 if zip64 else 20, entry.flags, entry.method,
+            entry.dos_time, entry.dos_date, 0, size, size, len(name),
+            len(extra)) + name + extra)
+
+        if entry.method == ZIP_DEFLATED:
+            compressor = zlib.compressobj(
+                self.compresslevel, zlib.DEFLATED, -15)
+        else:
+            compressor = None
+        for chunk in chunks:
+            if not chunk:
+                continue
+            entry.file_size += len(chunk)
+            entry.crc = zlib.crc32(chunk, entry.crc) & 0xFFFFFFFF
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            entry.compress_size += len(chunk)
+            yield self._emit(chunk)
+        if compressor is not None:
+            chunk = compressor.flush()
+            entry.compress_size += len(chunk)
+            yield self._emit(chunk)
+
+        if zip64:
+            descriptor = _DESCRIPTOR64.pack(
+                0x08074b50, entry.crc, entry.compress_size, entry.file_size)
+        else:
+            if max(entry.file_size, entry.compress_size) > ZIP32_LIMIT:
+                raise LargeZipFile(
+                    '%s is larger than 4 GiB, ZIP64 is required' % arcname)
+            descriptor = _DESCRIPTOR.pack(
+                0x08074b50, entry.crc, entry.compress_size, entry.file_size)
+        self.entries.append(entry)
+        yield self._emit(descriptor)
+
+    def _central_header(self, entry):
+        file_size, compress_size, offset = \
+            entry.file_size, entry.compress_size, entry.offset
+        needs_zip64 = entry.zip64 or \
+            max(file_size, compress_size, offset) > ZIP32_LIMIT
+        if needs_zip64 and self.zip64 is False:
+            raise LargeZipFile('archive is larger than 4 GiB, '
+                               'ZIP64 is required')
+        if needs_zip64:
+            extra = _EXTRA64_HEADER.pack(1, 24) + \
+                struct.pack(str('<QQQ'), file_size, compress_size, offset)
+            file_size = compress_size = offset = ZIP32_LIMIT
+            version = 45
+        else:
+            extra, version = b'', 20
+        return _CENTRAL_HEADER.pack(
+            0x02014b50, version | (3 << 8), version, entry.flags,
+            entry.method, entry.dos_time, entry.dos_date, entry.crc,
+            compress_size, file_size, len(entry.name), len(extra), 0, 0, 0,
+            0o100644 << 16, offset) + entry.name + extra
+
+    def finish(self):
+        """Yield the central directory, nothing can be added afterwards"""
+        start = self.offset
+        for entry in self.entries:
+            yield self._emit(self._central_header(entry))
+        size = self.offset - start
+        count = len(self.entries)
+
+        needs_zip64 = self.zip64 or count >= ZIP32_COUNT_LIMIT or \
+            max(start, size) >= ZIP32_LIMIT
+        if needs_zip64 and self.zip64 is False:
+            raise LargeZipFile('too many entries or central directory '
+                               'too large, ZIP64 is required')
+        if needs_zip64:
+            end64_offset = self.offset
+            yield self._emit(_END64.pack(
+                0x06064b50, _END64.size - 12, 45 | (3 << 8), 45, 0, 0,
+                count, count, size, start))
+            yield self._emit(_END64_LOCATOR.pack(
+                0x07064b50, 0, end64_offset, 1))
+            count = min(count, ZIP32_COUNT_LIMIT)
+            size = min(size, ZIP32_LIMIT)
+            start = min(start, ZIP32_LIMIT)
+        yield self._emit(_END.pack(
+            0x06054b50, 0, 0, count, count, size, start, 0))
+
+    def stream(self, files):
+        """Yield a whole archive of `files`, pairs of (arcname, chunks)"""
+        for arcname, chunks in files:
+            for data in self.entry(arcname, chunks):
+                yield data
+        for data in self.finish():
+            yield data
+
+
+def write_zip(fileobj, files, **kwargs):
+    """Write `files`, pairs of (arcname, chunks), as a zip into `fileobj`"""
+    for data in ZipStream(**kwargs).stream(files):
+        fileobj.write(data)
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""JWT carrying the company of the user
+
+The pk of `User.company` goes into the payload of every token issued or
+refreshed, and comes back on the user of every request authenticated by
+it, so `user.company_pk` costs no query.
+"""
+from __future__ import unicode_literals
+from rest_framework_jwt import authentication, utils
+
+
+def jwt_payload_handler(user):
+    payload = utils.jwt_payload_handler(user)
+    payload['company_id'] = user.company_pk
+    return payload
+
+
+class JSONWebTokenAuthentication(authentication.JSONWebTokenAuthentication):
+
+    def authenticate_credentials(self, payload):
+        user = super(JSONWebTokenAuthentication,
+                     self).authenticate_credentials(payload)
+        if payload.get('company_id') is not None:
+            user._company_pk = payload['company_id']
+        return user
@@ -17,10 +17,35 @@ class User(AbstractUser):
 
     @property
     def company(self):
-        try:
-            return self.company_set.all()[0]
-        except:
-            return None
+        """The company of the user, looked up once per instance
+
+        `company_pk` may already be known from the JWT payload (see
+        people.authentication), the company is then fetched by its pk
+        among those of the user. A user no longer in that company gets
+        the first of their companies like any other user.
+        """
+        if not hasattr(self, '_company'):
+            company = None
+            if getattr(self, '_company_pk', None) is not None:
+                company = self.company_set.filter(
+                    pk=self._company_pk).first()
+            if company is None:
+                company = self.company_set.order_by('pk').first()
+            self.company = company
+        return self._company
+
+    @company.setter
+    def company(self, company):
+        self._company = company
+        self._company_pk = company.pk if company is not None else None
+
+    @property
+    def company_pk(self):
+        """pk of `company`, without a query when it came with the JWT"""
+        if getattr(self, '_company_pk', None) is None:
+            company = self.company
+            self._company_pk = company.pk if company is not None else None
+        return self._company_pk
 
 
 @python_2_unicode_compatible
@@ -17,8 +17,6 @@ class HomeView(TemplateView):
 
     def dispatch(self, request, *args, **kwargs):
         user = request.user
-        if user.is_authenticated():
-            companies = user.company_set.count()
-            if companies == 0:
-                create_user_company(user)
+        if user.is_authenticated() and user.company is None:
+            user.company = create_user_company(user)
         return super(HomeView, self).dispatch(request, *args, **kwargs)